@@ -7,6 +7,7 @@ import os
 
 # Third-party imports
 from celery import Celery
+from celery.signals import worker_process_init
 
 # Django imports
 # set the default Django settings module
@@ -18,6 +19,12 @@ app = Celery('data_import_tool')
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+@worker_process_init.connect
+def reset_warehouse_pool(**kwargs):
+    # Each worker process needs connections to the data warehouse of its own
+    from .warehouse import reset
+    reset()
+
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/1.10/ref/settings/
 # Standard library imports
 import sys
 import os
+import tempfile
 import ConfigParser
 
 # Django imports
@@ -93,6 +94,13 @@ DATABASES['default']['OPTIONS'] = {
     'init_command': 'SET sql_mode="STRICT_TRANS_TABLES"' 
 }
 DATA_WAREHOUSE_URL = config.get('databases', 'data_warehouse_url')
+# Connections to the data warehouse are pooled once per process (see
+# data_import_tool/warehouse.py). Recycle them before MySQL's wait_timeout
+# closes them on the server side
+WAREHOUSE_POOL_SIZE = 5
+WAREHOUSE_MAX_OVERFLOW = 10
+WAREHOUSE_POOL_TIMEOUT = 30
+WAREHOUSE_POOL_RECYCLE = 3600
 
 # Creating a local sqlite DB in memory for testing is a lot faster than 
 # using MySQL
@@ -149,8 +157,76 @@ CELERY_RESULT_BACKEND = config.get('redis', 'redis_url')
 if 'test' in sys.argv:
     CELERY_ALWAYS_EAGER = True  # Run Celery tasks in the same thread if testing
 
+# Task progress
+# Celery tasks publish progress to Redis, and the browser gets it as
+# server-sent events. Each stream is held open for at most
+# PROGRESS_STREAM_TIMEOUT seconds before the browser reconnects, with a
+# heartbeat every PROGRESS_HEARTBEAT seconds to keep proxies from closing it
+PROGRESS_REDIS_URL = config.get('redis', 'redis_url')
+PROGRESS_STREAM_TIMEOUT = 60
+PROGRESS_HEARTBEAT = 15
+# Progress within a stage (bytes downloaded, rows loaded) is sent at most
+# once every PROGRESS_INTERVAL seconds
+PROGRESS_INTERVAL = 1
+
+# Upload pipeline
+# Every upload and every load task gets its own scratch directory under
+# UPLOAD_WORKSPACE_ROOT, so concurrent uploads never touch each other's files
+UPLOAD_WORKSPACE_ROOT = os.path.join(tempfile.gettempdir(), 'data-portal')
+# Chunked uploads that haven't finished after UPLOAD_EXPIRY seconds, and
+# workspaces left behind by requests or tasks that died, are removed by
+# ./manage.py expire_uploads
+UPLOAD_EXPIRY = 60 * 60 * 24
+# Set INFERENCE_SAMPLE_SIZE to a number of rows to infer column types from a
+# sample of very large files instead of reading every row
+INFERENCE_SAMPLE_SIZE = None
+# Set LOAD_PARALLEL_THRESHOLD to a size in bytes to split files at least that
+# big into LOAD_CHUNK_SIZE chunks and load them straight into the table over
+# LOAD_PARALLEL_WORKERS connections at once. MyISAM locks the whole table
+# during a load, so the loads mostly take turns, and the row IDs follow the
+# order the chunks finish in. Compare load_infile and load_infile_parallel
+# with benchmark_ingest on your warehouse before turning it on
+LOAD_PARALLEL_THRESHOLD = None
+LOAD_CHUNK_SIZE = 64 * 1024 * 1024
+LOAD_PARALLEL_WORKERS = 4
+
+# Search
+# Tables are searched in parallel on SEARCH_WORKERS threads. MySQL kills a
+# search of any one table after SEARCH_TABLE_TIMEOUT seconds, and the search
+# returns whatever finished within SEARCH_DEADLINE seconds
+# Up to SEARCH_BATCH_SIZE tables are searched with a single UNION ALL
+# statement (needs MySQL 5.7.8+ for JSON_ARRAY), which gets
+# SEARCH_TABLE_TIMEOUT seconds for each table in it. The tables of a batch
+# that timed out are searched one at a time for SEARCH_CACHE_TTL seconds
+SEARCH_WORKERS = 8
+SEARCH_BATCH_SIZE = 20
+SEARCH_TABLE_TIMEOUT = 5
+SEARCH_DEADLINE = 10
+# A search's matches are counted in the background once per
+# SEARCH_COUNT_TIMEOUT seconds at most, until the count is cached
+SEARCH_COUNT_TIMEOUT = 60 * 10
+# Statements search sends to the warehouse that take longer than
+# SEARCH_SLOW_QUERY_SECONDS are saved with their EXPLAIN output, in the
+# search QueryLog admin
+SEARCH_SLOW_QUERY_SECONDS = 1.0
+# Search results are cached in the celery Redis for SEARCH_CACHE_TTL seconds,
+# keeping at most SEARCH_CACHE_MAX_ENTRIES of them
+SEARCH_CACHE_URL = config.get('redis', 'redis_url')
+SEARCH_CACHE_TTL = 60 * 60
+SEARCH_CACHE_MAX_ENTRIES = 10000
+# Full search results are exported to S3 in the background, and the links
+# to download them expire after EXPORT_URL_EXPIRY seconds
+EXPORT_URL_EXPIRY = 60 * 60 * 24
+# Whole-table exports that are still building after EXPORT_BUILD_TIMEOUT
+# seconds are assumed to have died with their worker, and are built again
+EXPORT_BUILD_TIMEOUT = 60 * 60 * 2
+
 # AWS
 AWS_ACCESS_KEY = config.get('s3', 'aws_access_key')
 AWS_SECRET_KEY = config.get('s3', 'aws_secret_key')
 S3_BUCKET = config.get('s3', 's3_bucket')
+# Browsers upload files straight to S3 in parts of at least this size. S3
+# allows at most 10,000 parts per upload, so parts grow for files over ~80GB
+S3_PART_SIZE = 8 * 1024 * 1024
+S3_MAX_PARTS = 10000
 
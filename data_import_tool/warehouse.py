@@ -0,0 +1,127 @@
+"""
+A registry of pooled sqlalchemy engines for the data warehouse. Every
+process (each gunicorn worker and each celery worker) builds its engines
+once, the first time they're needed, and every query after that borrows a
+connection from the pool instead of opening a new one.
+
+Example usage:
+    from data_import_tool import warehouse
+
+    connection = warehouse.connect()
+    try:
+        rows = connection.execute('SELECT 1').fetchall()
+    finally:
+        connection.close()  # Returns the connection to the pool
+"""
+# Stdlib imports
+from __future__ import absolute_import
+import os
+import threading
+
+# Django imports
+from django.conf import settings
+
+# Third party imports
+import sqlalchemy
+from sqlalchemy import event, exc, select
+from sqlalchemy.engine.url import make_url
+
+# Every table in the warehouse gets a hidden auto-increment primary key, so
+# that search results can be paged through in order without OFFSET scans
+ROW_ID = '_row_id'
+
+# Tables that have been updated in place also get a hash of each row, so that
+# a new version of the file can be compared with them row by row
+ROW_HASH = '_row_hash'
+
+_engines = {}
+_pid = None
+_lock = threading.Lock()
+
+
+def _ping(connection, branch):
+    """
+    Make sure a connection is still alive before handing it out, so that
+    connections the server timed out get replaced instead of raising an
+    error in the middle of a search. This is the "pessimistic" recipe from
+    the sqlalchemy docs; versions before 1.2 don't have pool_pre_ping.
+    """
+    if branch:
+        return
+
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as e:
+        # If the connection was dead sqlalchemy has already invalidated it
+        # and the pool, so trying again reconnects
+        if e.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+def _make_engine(url):
+    engine = sqlalchemy.create_engine(
+        url,
+        pool_size=settings.WAREHOUSE_POOL_SIZE,
+        max_overflow=settings.WAREHOUSE_MAX_OVERFLOW,
+        pool_timeout=settings.WAREHOUSE_POOL_TIMEOUT,
+        pool_recycle=settings.WAREHOUSE_POOL_RECYCLE
+    )
+    event.listen(engine, 'engine_connect', _ping)
+    return engine
+
+
+def get_engine(local_infile=False):
+    """
+    Get the engine for the data warehouse, creating it the first time it's
+    needed in this process
+
+    Args:
+        local_infile (bool): Whether connections should accept LOAD DATA
+        LOCAL INFILE statements. These get a pool of their own.
+
+    Returns:
+        engine (sqlalchemy.engine.Engine): A pooled engine
+    """
+    global _pid
+    url = make_url(settings.DATA_WAREHOUSE_URL)
+    if local_infile:
+        # Keep any options already in the URL's query string
+        url.query['local_infile'] = '1'
+    url = str(url)
+
+    with _lock:
+        # A forked child can't share its parent's sockets, so start over
+        # with empty pools in any new process
+        if _pid != os.getpid():
+            _engines.clear()
+            _pid = os.getpid()
+
+        if url not in _engines:
+            _engines[url] = _make_engine(url)
+
+        return _engines[url]
+
+
+def connect(local_infile=False):
+    """
+    Borrow a connection from the pool. Close it to give it back.
+    """
+    return get_engine(local_infile).connect()
+
+
+def reset():
+    """
+    Forget every engine built in this process without closing their
+    connections. Called in each new celery worker process, whose inherited
+    connections belong to the parent.
+    """
+    global _pid
+    with _lock:
+        _engines.clear()
+        _pid = os.getpid()
@@ -1,3 +1,35 @@
+from datetime import timedelta
+
 from django.contrib import admin
+from django.utils import timezone
+
+from .models import QueryLog
+from . import querylog
+
+REPORT_DAYS = 30
+
+
+class QueryLogAdmin(admin.ModelAdmin):
+    """
+    The slow statements search sent to the warehouse, with a report of the
+    worst tables and statements from the last REPORT_DAYS days above them
+    """
+    list_display = ('created', 'kind', 'tables', 'duration', 'rows', 'full_scan')
+    list_filter = ('kind', 'full_scan')
+    search_fields = ('tables', 'sql')
+    readonly_fields = ('created', 'kind', 'tables', 'sql', 'fingerprint',
+                       'duration', 'rows', 'error', 'explain', 'full_scan')
+
+    def has_add_permission(self, request):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        since = timezone.now() - timedelta(days=REPORT_DAYS)
+        extra_context = dict(extra_context or {},
+                             report_days=REPORT_DAYS,
+                             worst_tables=querylog.worst_tables(since),
+                             worst_queries=querylog.worst_queries(since))
+        return super(QueryLogAdmin, self).changelist_view(request, extra_context)
+
 
-# Register your models here.
+admin.site.register(QueryLog, QueryLogAdmin)
@@ -5,3 +5,7 @@ from django.apps import AppConfig
 
 class SearchConfig(AppConfig):
     name = 'search'
+
+    def ready(self):
+        # Invalidate cached search results whenever the catalog changes
+        from . import signals  # noqa
@@ -0,0 +1,242 @@
+# Stdlib imports
+import json
+import hashlib
+import logging
+import time
+
+# Django imports
+from django.conf import settings
+
+# Third-party imports
+import redis
+
+# Constants
+PREFIX = 'search-cache'
+CATALOG_VERSION = PREFIX + ':catalog-version'
+INDEX = PREFIX + ':index'  # Sorted set of cached keys by the time they were set
+
+logger = logging.getLogger(__name__)
+_client = None
+
+
+def get_redis():
+    """
+    Get a client for the Redis server we already run for celery. The client
+    keeps its own connection pool, which is safe to share between threads.
+    """
+    global _client
+    if _client is None:
+        _client = redis.StrictRedis.from_url(settings.SEARCH_CACHE_URL)
+    return _client
+
+
+def normalize(query):
+    """
+    MySQL's full-text search ignores case and extra whitespace, so searches
+    that only differ in those should share cache entries
+    """
+    return ' '.join(query.lower().split())
+
+
+class SearchCache(object):
+    """
+    This module caches search results in Redis. Entries are keyed on a
+    version number that is bumped whenever the catalog changes: searches of
+    the whole warehouse on the version of the whole catalog, and searches of
+    a single table on the version of that table. When a table is added or
+    removed, whole-warehouse searches miss, but the results for every table
+    that didn't change are still cached, so only the changed ones are
+    searched again.
+
+    If Redis is unavailable every lookup is a miss, so search keeps working,
+    just without the cache.
+
+    Args:
+        client (redis.StrictRedis): A Redis client. Defaults to the shared one
+    """
+    def __init__(self, client=None):
+        self.redis = client or get_redis()
+        self.ttl = settings.SEARCH_CACHE_TTL
+        self.max_entries = settings.SEARCH_CACHE_MAX_ENTRIES
+
+    def key(self, *parts):
+        digest = hashlib.sha1(json.dumps(parts)).hexdigest()
+        return '{}:{}'.format(PREFIX, digest)
+
+    def catalog_version(self):
+        try:
+            return int(self.redis.get(CATALOG_VERSION) or 0)
+        except redis.RedisError as e:
+            logger.warning('Search cache unavailable: %s', e)
+            return None
+
+    def table_versions(self, tables):
+        """
+        Get the current version of each of a list of tables
+
+        Args:
+            tables (string[]): Table names
+
+        Returns:
+            A list with the version of each table, or None if Redis is down
+        """
+        if not tables:
+            return []
+        try:
+            keys = ['{}:table-version:{}'.format(PREFIX, t) for t in tables]
+            return [int(v or 0) for v in self.redis.mget(keys)]
+        except redis.RedisError as e:
+            logger.warning('Search cache unavailable: %s', e)
+            return None
+
+    def bump(self, table):
+        """
+        Invalidate cached results for a table, and for every search of the
+        whole warehouse
+
+        Args:
+            table (string): The name of the table that changed
+        """
+        try:
+            pipe = self.redis.pipeline()
+            pipe.incr(CATALOG_VERSION)
+            pipe.incr('{}:table-version:{}'.format(PREFIX, table))
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning('Unable to invalidate search cache: %s', e)
+
+    def get_many(self, keys):
+        """
+        Look up several keys at once
+
+        Returns:
+            A list with a two-tuple for each key: whether it was found, and
+            the cached value
+        """
+        if not keys:
+            return []
+        try:
+            values = self.redis.mget(keys)
+        except redis.RedisError as e:
+            logger.warning('Search cache unavailable: %s', e)
+            values = [None] * len(keys)
+
+        found = [(v is not None, json.loads(v) if v is not None else None)
+                 for v in values]
+        hits = len([f for f, v in found if f])
+        self._count(hits, len(keys) - hits)
+        return found
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set_many(self, entries):
+        """
+        Cache several values at once, then evict the oldest entries if
+        there are more than SEARCH_CACHE_MAX_ENTRIES
+
+        Args:
+            entries (dict): A map of keys to JSON-serializable values
+        """
+        if not entries:
+            return
+        now = time.time()
+        try:
+            pipe = self.redis.pipeline()
+            for key, value in entries.items():
+                pipe.setex(key, self.ttl, json.dumps(value))
+                pipe.zadd(INDEX, now, key)
+            # Entries older than the TTL have already expired
+            pipe.zremrangebyscore(INDEX, 0, now - self.ttl)
+            pipe.zcard(INDEX)
+            size = pipe.execute()[-1]
+
+            if size > self.max_entries:
+                oldest = self.redis.zrange(INDEX, 0, size - self.max_entries - 1)
+                if oldest:
+                    self.redis.delete(*oldest)
+                    self.redis.zrem(INDEX, *oldest)
+        except redis.RedisError as e:
+            logger.warning('Unable to write to search cache: %s', e)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def claim(self, key, ttl):
+        """
+        Atomically mark some work as started, so that concurrent requests
+        don't all start it. The mark expires after ttl seconds, in case the
+        work dies before it's done.
+
+        Args:
+            key (string): A key for the work, from SearchCache.key
+            ttl (int): How long the mark lasts, in seconds
+
+        Returns:
+            True if this caller claimed the work, or False if someone already
+            has, or Redis is down
+        """
+        try:
+            return bool(self.redis.set(key + ':claimed', 1, ex=ttl, nx=True))
+        except redis.RedisError as e:
+            logger.warning('Search cache unavailable: %s', e)
+            return False
+
+    def mark_slow(self, tables):
+        """
+        Remember tables whose batched search timed out, so that they're
+        searched on their own for the next SEARCH_CACHE_TTL seconds
+
+        Args:
+            tables (string[]): Table names
+        """
+        if not tables:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            for table in tables:
+                pipe.setex('{}:slow:{}'.format(PREFIX, table), self.ttl, 1)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning('Unable to write to search cache: %s', e)
+
+    def slow_tables(self, tables):
+        """
+        Find which of a list of tables were marked slow by mark_slow
+
+        Returns:
+            A set of table names, which is empty if Redis is down
+        """
+        if not tables:
+            return set()
+        try:
+            values = self.redis.mget(['{}:slow:{}'.format(PREFIX, t) for t in tables])
+        except redis.RedisError as e:
+            logger.warning('Search cache unavailable: %s', e)
+            return set()
+        return set(t for t, v in zip(tables, values) if v is not None)
+
+    def _count(self, hits, misses):
+        try:
+            pipe = self.redis.pipeline()
+            if hits:
+                pipe.incr(PREFIX + ':hits', hits)
+            if misses:
+                pipe.incr(PREFIX + ':misses', misses)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+    def stats(self):
+        """
+        Returns:
+            A dict with the number of hits and misses and the number of
+            entries currently cached
+        """
+        pipe = self.redis.pipeline()
+        pipe.get(PREFIX + ':hits')
+        pipe.get(PREFIX + ':misses')
+        pipe.zcard(INDEX)
+        hits, misses, entries = pipe.execute()
+        return {'hits': int(hits or 0), 'misses': int(misses or 0),
+                'entries': entries}
@@ -0,0 +1,100 @@
+# Stdlib imports
+import threading
+
+# Local imports
+from upload.models import Column
+from .cache import SearchCache
+
+_catalog = None
+_version = None
+_lock = threading.Lock()
+
+
+def _build():
+    """
+    Read every column of every table whose indexes are ready, and index the
+    searchable ones by information type. The type is the last part of a
+    column's information_type, so "first_name" and "last_name" are both
+    "name".
+
+    Returns:
+        A two-tuple with (1) a dict of every table by id, with its name and
+        all of its columns in order, and (2) a dict mapping each information
+        type to the tables with columns of that type, and those columns
+    """
+    tables = {}
+    types = {}
+    # Tables without FULLTEXT indexes can't be searched yet
+    rows = (Column.objects.filter(table__index_status='ready')
+            .order_by('id')
+            .values_list('table_id', 'table__table', 'column', 'information_type'))
+    for table_id, table, column, information_type in rows:
+        t = tables.setdefault(table_id, {'id': table_id, 'table': table,
+                                         'columns': []})
+        t['columns'].append(column)
+
+        if information_type is not None:
+            data_type = information_type.split('_')[-1]
+            types.setdefault(data_type, {}).setdefault(table_id, []).append(column)
+
+    return (tables, types)
+
+
+def invalidate():
+    """
+    Forget the catalog in this process. Other processes notice the change
+    through the catalog version in the search cache.
+    """
+    global _catalog
+    with _lock:
+        _catalog = None
+
+
+def get_catalog():
+    """
+    Get the catalog for this process, building it again if the catalog
+    version has changed since it was built. If the version can't be read,
+    build it every time rather than risk searching a stale catalog.
+    """
+    global _catalog, _version
+    # Read the version before the catalog, so that a change made while it's
+    # being built leaves it out of date instead of looking current
+    version = SearchCache().catalog_version()
+    with _lock:
+        if _catalog is None or version is None or version != _version:
+            _catalog = _build()
+            _version = version
+        return _catalog
+
+
+def searchable_tables(filter):
+    """
+    Find the tables with columns of any of the given information types,
+    without touching the Django DB if nothing has changed
+
+    Arguments:
+        filter (string[]): Information types, e.g. ["name", "address"]
+
+    Returns:
+        An array of dicts, sorted by table name, each with the table's name,
+        id, all of its columns, and the columns to search formatted for a
+        MATCH clause
+    """
+    tables, types = get_catalog()
+
+    matches = {}
+    for data_type in filter:
+        for table_id, columns in types.get(data_type, {}).items():
+            matches.setdefault(table_id, set()).update(columns)
+
+    results = []
+    for table_id, search_columns in matches.items():
+        table = tables[table_id]
+        # Keep the columns in the same order they have in the table
+        search_columns = [c for c in table['columns'] if c in search_columns]
+        results.append({'table': table['table'],
+                        'id': table_id,
+                        'columns': list(table['columns']),
+                        'search_columns': '`{}`'.format('`,`'.join(search_columns))})
+
+    return sorted(results, key=lambda t: t['table'])
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('kind', models.CharField(choices=[('search', 'Search of one table'), ('batch', 'Search of a batch of tables'), ('count', 'Count of matches'), ('query', 'Query'), ('stream', 'Streamed query'), ('export', 'Bulk export')], max_length=20)),
+                ('tables', models.TextField(blank=True)),
+                ('sql', models.TextField()),
+                ('fingerprint', models.CharField(db_index=True, max_length=32)),
+                ('duration', models.FloatField()),
+                ('rows', models.IntegerField(null=True)),
+                ('error', models.TextField(blank=True)),
+                ('explain', models.TextField(blank=True)),
+                ('full_scan', models.BooleanField(default=False)),
+            ],
+            options={
+                'ordering': ('-created',),
+            },
+        ),
+    ]
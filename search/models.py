@@ -1,5 +1,44 @@
 from __future__ import unicode_literals
 
+import json
+
 from django.db import models
 
-# Create your models here.
+
+class QueryLog(models.Model):
+    """
+    A statement search sent to the data warehouse that took longer than
+    SEARCH_SLOW_QUERY_SECONDS, with how MySQL said it would run it
+    """
+    KIND_CHOICES = (
+        ("search","Search of one table"),
+        ("batch","Search of a batch of tables"),
+        ("count","Count of matches"),
+        ("query","Query"),
+        ("stream","Streamed query"),
+        ("export","Bulk export")
+    )
+
+    created = models.DateTimeField(auto_now_add=True)
+    kind = models.CharField(choices=KIND_CHOICES, max_length=20)
+    tables = models.TextField(blank=True)  # Comma-separated
+    sql = models.TextField()
+    fingerprint = models.CharField(max_length=32, db_index=True)  # The same for every search of the same shape
+    duration = models.FloatField()  # Seconds
+    rows = models.IntegerField(null=True)
+    error = models.TextField(blank=True)
+    explain = models.TextField(blank=True)  # JSON array of the EXPLAIN rows, or the error it gave
+    full_scan = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ('-created',)
+
+    @property
+    def explain_rows(self):
+        try:
+            return json.loads(self.explain)
+        except ValueError:
+            return []
+
+    def __unicode__(self):
+        return '{} ({:.2f}s)'.format(self.tables, self.duration)
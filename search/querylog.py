@@ -0,0 +1,198 @@
+"""
+Timing for the statements search sends to the data warehouse. Every
+statement's duration and row count is logged to the search.queries logger,
+and statements slower than SEARCH_SLOW_QUERY_SECONDS are saved as QueryLogs
+along with their EXPLAIN output, so that tables missing an index or with a
+pathological FULLTEXT index can be found without turning on MySQL's slow
+query log for the whole server.
+
+Example usage:
+    connection = warehouse.connect()
+    try:
+        with querylog.timed(connection, 'query', sql_query) as timing:
+            rows = connection.execute(sql_query).fetchall()
+            timing.rows = len(rows)
+    finally:
+        connection.close()
+"""
+# Stdlib imports
+from __future__ import absolute_import
+import re
+import json
+import time
+import hashlib
+import logging
+from contextlib import contextmanager
+
+# Django imports
+from django.conf import settings
+from django.db.models import Avg, Count, Max, Sum
+
+# Third-party imports
+from sqlalchemy import exc, text
+
+# Local imports
+from .models import QueryLog
+
+logger = logging.getLogger('search.queries')
+
+TABLE_NAME = re.compile(r'imports\.`?(\w+)')
+# Optimizer hints, string literals and numbers, which vary between
+# otherwise identical statements
+HINT = re.compile(r"/\*\+.*?\*/")
+VARIABLE = re.compile(r"'(?:[^'\\]|\\.)*'|\b\d+\b")
+# Statements that read every row of a search or table on purpose. They're
+# slow because of how much they read, not because of a missing index, so
+# they're logged but never saved as slow queries
+BULK_KINDS = ('export',)
+
+
+def fingerprint(sql_query):
+    """
+    Hash a statement with its search terms, limits and row IDs left out, so
+    that every search of a table with the same shape groups together
+    """
+    shape = ' '.join(VARIABLE.sub('?', HINT.sub('', sql_query)).split())
+    return hashlib.md5(shape.encode('utf-8')).hexdigest()
+
+
+def explain(connection, sql_query, params=None):
+    """
+    Ask MySQL how it runs a statement, with params bound to its :name
+    placeholders if it has any
+
+    Returns:
+        A two-tuple with the EXPLAIN output as JSON (or the error MySQL gave
+        instead), and whether any table in it is read with a full scan
+    """
+    if not sql_query.strip().upper().startswith('SELECT'):
+        return ('', False)
+
+    try:
+        if params:
+            result = connection.execute(text('EXPLAIN ' + sql_query), **params)
+        else:
+            result = connection.execute('EXPLAIN ' + sql_query)
+        headers = result.keys()
+        rows = [dict(zip(headers, row)) for row in result.fetchall()]
+    except exc.SQLAlchemyError as e:
+        return (str(e), False)
+
+    full_scan = any(row.get('type') == 'ALL' for row in rows)
+    return (json.dumps(rows, default=unicode), full_scan)
+
+
+class QueryTiming(object):
+    """
+    What a timed statement returned. Set rows to the number of rows read.
+    Statements whose rows are read a batch at a time by a consumer that
+    does its own work in between can set elapsed to only the time spent
+    waiting on MySQL; otherwise the whole block is timed.
+    """
+    def __init__(self):
+        self.rows = None
+        self.elapsed = None
+
+
+@contextmanager
+def timed(connection, kind, sql_query, params=None):
+    """
+    Time a statement and save it if it was slow. Call this before the
+    connection is closed, since slow statements are explained on it.
+
+    Arguments:
+        connection (sqlalchemy.engine.Connection): The connection the
+            statement runs on
+        kind (string): What the statement was for, from QueryLog.KIND_CHOICES
+        sql_query (string): The statement
+        params (dict): Values bound to the statement's :name placeholders.
+            They're needed to explain it, but the saved statement keeps its
+            placeholders
+    """
+    timing = QueryTiming()
+    error = None
+    start = time.time()
+    try:
+        yield timing
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        duration = time.time() - start if timing.elapsed is None else timing.elapsed
+        _finish(connection, kind, sql_query, params, timing.rows, duration,
+                error)
+
+
+def _finish(connection, kind, sql_query, params, rows, duration, error):
+    tables = sorted(set(TABLE_NAME.findall(sql_query)))
+    slow = (kind not in BULK_KINDS and
+            duration >= settings.SEARCH_SLOW_QUERY_SECONDS)
+    logger.info(json.dumps({'event': 'search.query', 'kind': kind,
+                            'tables': tables, 'seconds': duration,
+                            'rows': rows, 'slow': slow,
+                            'error': error is not None}, sort_keys=True))
+    if not slow:
+        return
+
+    plan, full_scan = explain(connection, sql_query, params)
+    # Written by a task so that searches on worker threads don't each open
+    # a connection to the Django DB. Imported here because the tasks module
+    # imports SearchManager, which imports this one
+    from .tasks import record_slow_query
+    try:
+        record_slow_query.delay(kind=kind, tables=','.join(tables),
+                                sql=sql_query, fingerprint=fingerprint(sql_query),
+                                duration=duration, rows=rows,
+                                error=str(error) if error else '',
+                                explain=plan, full_scan=full_scan)
+    # Losing a log entry is better than failing the search
+    except Exception as e:
+        logger.warning('Could not save a slow query: %s', e)
+
+
+def worst_queries(since=None, limit=10):
+    """
+    Group slow statements by fingerprint
+
+    Returns:
+        An array of dicts, the most total time first, each with a
+        statement's fingerprint and an example of it, how many times it was
+        slow, and its total, average and worst durations
+    """
+    logs = QueryLog.objects.all()
+    if since:
+        logs = logs.filter(created__gte=since)
+    return list(logs.values('fingerprint')
+                .annotate(count=Count('id'), total=Sum('duration'),
+                          average=Avg('duration'), worst=Max('duration'),
+                          tables=Max('tables'), example=Max('sql'))
+                .order_by('-total')[:limit])
+
+
+def worst_tables(since=None, limit=10):
+    """
+    Add up the slow statements on each table. A statement that searched
+    several tables at once counts against each of them.
+
+    Returns:
+        An array of dicts, the most total time first, each with a table's
+        name, how many slow statements touched it, their total and worst
+        durations, and how many of them were full scans or failed
+    """
+    logs = QueryLog.objects.all()
+    if since:
+        logs = logs.filter(created__gte=since)
+
+    tables = {}
+    rows = logs.values_list('tables', 'duration', 'full_scan', 'error')
+    for names, duration, full_scan, error in rows.iterator():
+        for name in filter(None, names.split(',')):
+            t = tables.setdefault(name, {'table': name, 'count': 0, 'total': 0.0,
+                                         'worst': 0.0, 'full_scans': 0, 'errors': 0})
+            t['count'] += 1
+            t['total'] += duration
+            t['worst'] = max(t['worst'], duration)
+            t['full_scans'] += int(full_scan)
+            t['errors'] += int(bool(error))
+
+    return sorted(tables.values(), key=lambda t: -t['total'])[:limit]
@@ -0,0 +1,33 @@
+# Django imports
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+# Local imports
+from upload.models import Table, Column
+from .cache import SearchCache
+from . import catalog
+
+
+@receiver([post_save, post_delete], sender=Table)
+def invalidate_table(sender, instance, **kwargs):
+    """
+    Searches of the whole warehouse change whenever a table is added,
+    removed or edited, and so do the results for that table
+    """
+    catalog.invalidate()
+    SearchCache().bump(instance.table)
+
+
+@receiver([post_save, post_delete], sender=Column)
+def invalidate_column(sender, instance, **kwargs):
+    """
+    Which columns of a table get searched depends on their information
+    types, so changing a column changes the results for its table
+    """
+    catalog.invalidate()
+    try:
+        table = instance.table
+    except Table.DoesNotExist:
+        # The whole table was deleted, which invalidates it anyway
+        return
+    SearchCache().bump(table.table)
@@ -0,0 +1,66 @@
+# Stdlib imports
+from __future__ import absolute_import
+import re
+
+# Django imports
+from django.conf import settings
+
+# Third party imports
+from sqlalchemy import exc # error handling
+from celery import shared_task
+
+# Local module imports
+from upload.tasks import ProgressTracker
+from upload.utils import S3Manager
+from .utils import SearchManager
+from .models import QueryLog
+
+# Constants
+BUCKET_NAME = settings.S3_BUCKET
+
+
+@shared_task(bind=True)
+def export_results(self, sql_query, params=None):
+    """
+    A celery task that runs a search query, with params bound to its :name
+    placeholders, and writes every matching row to S3 as a gzipped CSV, then
+    returns a presigned URL to download it.
+    """
+    tracker = ProgressTracker(self, total=3)
+    tracker.forward('Running search query')
+    rows = SearchManager().stream_query(sql_query, kind='export', params=params)
+
+    tracker.forward('Compressing results and uploading them to S3')
+    def progress(n):
+        tracker.update('Uploaded {:,} rows to S3'.format(n))
+
+    key = 'exports/{}/search-results.csv.gz'.format(self.request.id)
+    s3 = S3Manager(None, None, BUCKET_NAME)
+    try:
+        url, count = s3.download_query_results(rows, key, progress=progress)
+    # Store only the relevant part of the error
+    except exc.SQLAlchemyError as e:
+        r = re.compile(r'\(.+?\)')
+        messages = r.findall(str(e))
+        message = messages[1] if len(messages) > 1 else str(e)
+        return {'error': {'error': True, 'errorMessage': message}}
+
+    tracker.forward('Finished exporting {:,} rows'.format(count))
+    return {'error': False, 'url': url, 'rows': count}
+
+
+@shared_task
+def count_matches(query, table, search_columns):
+    """
+    A celery task that counts every row of a table matching a search, so
+    that the detail page can show an exact count without waiting for it
+    """
+    return SearchManager().count_matches(query, table, search_columns)
+
+
+@shared_task
+def record_slow_query(**fields):
+    """
+    A celery task that saves a slow warehouse statement to the query log
+    """
+    QueryLog.objects.create(**fields)
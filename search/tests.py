@@ -1,3 +1,647 @@
-from django.test import TestCase
+# Stdlib imports
+import json
+import time
 
-# Create your tests here.
+# Django imports
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.urls import reverse
+
+# Third party imports
+from mock import patch, MagicMock
+from sqlalchemy import exc
+
+# Local module imports
+from .utils import SearchManager
+from .cache import SearchCache
+from .models import QueryLog
+from . import catalog, querylog
+from upload.models import Table, Column
+
+
+# MOCK CLASSES
+class MockRedis(object):
+    """
+    Just enough of redis.StrictRedis, kept in memory, for the search cache
+    """
+    def __init__(self):
+        self.data = {}
+        self.zsets = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(k) for k in keys]
+
+    def incr(self, key, amount=1):
+        self.data[key] = int(self.data.get(key, 0)) + amount
+        return self.data[key]
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def delete(self, *keys):
+        for k in keys:
+            self.data.pop(k, None)
+
+    def zadd(self, key, score, member):
+        self.zsets.setdefault(key, {})[member] = score
+
+    def zcard(self, key):
+        return len(self.zsets.get(key, {}))
+
+    def zrange(self, key, start, end):
+        members = sorted(self.zsets.get(key, {}).items(), key=lambda m: m[1])
+        return [m for m, score in members][start:end + 1]
+
+    def zrem(self, key, *members):
+        for m in members:
+            self.zsets.get(key, {}).pop(m, None)
+
+    def zremrangebyscore(self, key, low, high):
+        zset = self.zsets.get(key, {})
+        for m, score in zset.items():
+            if low <= score <= high:
+                del zset[m]
+
+    def pipeline(self):
+        return MockPipeline(self)
+
+
+class MockPipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        return lambda *args: self.calls.append((method, args))
+
+    def execute(self):
+        return [method(*args) for method, args in self.calls]
+
+
+class SearchManagerTestCase(TestCase):
+    """
+    Test the queries SearchManager sends to the data warehouse
+    """
+    def setUp(self):
+        self.redis = MockRedis()
+        patcher = patch('search.cache.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        catalog.invalidate()
+
+    @patch('search.utils.warehouse')
+    def test_simple_query(self, mock_warehouse):
+        """
+        simple_query should fetch the results and give the connection back to
+        the pool
+        """
+        connection = mock_warehouse.connect.return_value
+        result = connection.execute.return_value
+        result.keys.return_value = ['id', 'name']
+        result.fetchall.return_value = [(1, 'test')]
+
+        headers, rows = SearchManager().simple_query('SELECT * FROM imports.t')
+
+        self.assertEqual(headers, ['id', 'name'])
+        self.assertEqual(rows, [(1, 'test')])
+        self.assertTrue(connection.close.called)
+
+    @patch('search.utils.warehouse')
+    def test_stream_query(self, mock_warehouse):
+        """
+        stream_query should read from a server-side cursor in batches, and
+        give the connection back once it's done
+        """
+        connection = mock_warehouse.connect.return_value
+        streaming = connection.execution_options.return_value
+        result = streaming.execute.return_value
+        result.keys.return_value = ['id', 'name']
+        result.fetchmany.side_effect = [[(1, 'a'), (2, 'b')], [(3, 'c')], []]
+
+        rows = list(SearchManager().stream_query('SELECT * FROM imports.t', 2))
+
+        connection.execution_options.assert_called_with(stream_results=True)
+        self.assertEqual(rows, [['id', 'name'], (1, 'a'), (2, 'b'), (3, 'c')])
+        self.assertTrue(connection.close.called)
+
+        # A saved search binds its term to the query
+        result.fetchmany.side_effect = [[]]
+        list(SearchManager().stream_query('SELECT * FROM imports.t WHERE MATCH(`name`) '
+                                          'AGAINST(:query IN BOOLEAN MODE)',
+                                          params={'query': 'cox'}))
+        self.assertEqual(streaming.execute.call_args[1], {'query': 'cox'})
+
+    @patch('search.utils.warehouse')
+    def test_table_search_pages(self, mock_warehouse):
+        """
+        Pages should be found by row ID instead of OFFSET, and the row IDs
+        kept out of the results
+        """
+        class Row(dict):
+            def keys(self):
+                return ['name', '_row_id']
+
+            def values(self):
+                return [self['name'], self['_row_id']]
+
+            def __getitem__(self, key):
+                return self.values()[key] if isinstance(key, int) else dict.__getitem__(self, key)
+
+        connection = mock_warehouse.connect.return_value
+        connection.execute.return_value.fetchall.side_effect = lambda: [
+            Row(name='Cox, J', _row_id=101), Row(name='Cox, K', _row_id=102)]
+
+        manager = SearchManager()
+        sql, result = manager.table_search('cox', 'donors', '`name`',
+                                           preview=2, after=100)
+
+        page_query = str(connection.execute.call_args[0][0])
+        self.assertIn('AND _row_id > 100 ORDER BY _row_id LIMIT 2', page_query)
+        self.assertNotIn('LIMIT', sql)
+        # The search term is bound, never written into the statement
+        self.assertIn('AGAINST(:query IN BOOLEAN MODE)', sql)
+        self.assertEqual(connection.execute.call_args[1], {'query': 'cox'})
+        self.assertEqual(result['preview']['headers'], ['name'])
+        self.assertEqual(result['preview']['data'], [['Cox, J'], ['Cox, K']])
+        self.assertEqual((result['first_row'], result['last_row']), (101, 102))
+
+        # Earlier pages are read backwards, then put back in order
+        sql, result = manager.table_search('cox', 'donors', '`name`',
+                                           preview=2, before=101)
+        page_query = str(connection.execute.call_args[0][0])
+        self.assertIn('AND _row_id < 101 ORDER BY _row_id DESC LIMIT 2', page_query)
+        self.assertEqual(result['preview']['data'], [['Cox, K'], ['Cox, J']])
+
+    @patch('search.utils.warehouse')
+    def test_count_matches(self, mock_warehouse):
+        """
+        Counts should be cached until the table changes
+        """
+        connection = mock_warehouse.connect.return_value
+        connection.execute.return_value.scalar.return_value = 1234
+
+        manager = SearchManager()
+        self.assertEqual(manager.cached_count('cox', 'donors', '`name`'), None)
+        self.assertEqual(manager.count_matches('Cox', 'donors', '`name`'), 1234)
+        self.assertEqual(manager.cached_count('cox', 'donors', '`name`'), 1234)
+
+        # A term with a quote in it is bound as it is
+        manager.count_matches("o'brien' OR '1", 'donors', '`name`')
+        count_query = str(connection.execute.call_args[0][0])
+        self.assertIn('AGAINST(:query IN BOOLEAN MODE)', count_query)
+        self.assertNotIn('brien', count_query)
+        self.assertEqual(connection.execute.call_args[1], {'query': "o'brien' OR '1"})
+
+        SearchCache().bump('donors')
+        self.assertEqual(manager.cached_count('cox', 'donors', '`name`'), None)
+
+    def _catalog(self, mock_warehouse, names):
+        """
+        Add tables to the Django DB
+        """
+        user = User.objects.create_user(username='jonathan', password='mock_pw')
+        tables = []
+        for name in names:
+            t = Table.objects.create(table=name, user=user, source='test',
+                                     index_status='ready')
+            Column.objects.create(table=t, column='name', mysql_type='varchar',
+                                  information_type='full_name')
+            Column.objects.create(table=t, column='city', mysql_type='varchar')
+            tables.append({'table': name, 'id': t.id, 'search_columns': '`name`'})
+
+        return tables
+
+    @override_settings(SEARCH_DEADLINE=0.5, SEARCH_BATCH_SIZE=1)
+    @patch('search.utils.warehouse')
+    def test_warehouse_search(self, mock_warehouse):
+        """
+        Slow and broken tables should be reported without holding up the
+        others
+        """
+        tables = self._catalog(mock_warehouse, ['fast', 'slow', 'broken', 'empty'])
+
+        def search_batch(query, batch):
+            table = batch[0]['table']
+            if table == 'slow':
+                time.sleep(2)
+            if table == 'broken':
+                raise exc.ProgrammingError('SELECT', {}, Exception("Can't find FULLTEXT index"))
+            if table == 'empty':
+                return ([], [])
+            return ([{'table': table, 'id': batch[0]['id']}], [])
+
+        manager = SearchManager()
+        with patch.object(manager, '_search_batch', side_effect=search_batch):
+            start = time.time()
+            results, incomplete = manager.warehouse_search('cox', ['name'])
+
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertEqual([r['table'] for r in results], ['fast'])
+        self.assertEqual(incomplete, [
+            {'table': 'broken', 'id': tables[2]['id'], 'reason': 'error'},
+            {'table': 'slow', 'id': tables[1]['id'], 'reason': 'timeout'}
+        ])
+
+    @patch('search.utils.warehouse')
+    def test_batched_search(self, mock_warehouse):
+        """
+        Tables should be searched with one UNION ALL statement, and the rows
+        split back up by table
+        """
+        self._catalog(mock_warehouse, ['contracts', 'donors', 'voters'])
+        connection = mock_warehouse.connect.return_value
+        connection.execute.return_value.fetchall.side_effect = [
+            [{'_table': 'donors', '_row': '["Jonathan Cox", "Atlanta"]'},
+             {'_table': 'contracts', '_row': '["Cox Enterprises", null]'},
+             {'_table': 'donors', '_row': '["Cox, J", "Decatur"]'}]
+        ]
+
+        results, incomplete = SearchManager().warehouse_search('cox', ['name'])
+
+        batch_query = str(connection.execute.call_args[0][0])
+        self.assertEqual(batch_query.count('UNION ALL'), 2)
+        self.assertEqual(batch_query.count('AGAINST(:query IN BOOLEAN MODE)'), 3)
+        self.assertEqual(connection.execute.call_args[1], {'query': 'cox'})
+        self.assertEqual(incomplete, [])
+        self.assertEqual([r['table'] for r in results], ['contracts', 'donors'])
+        self.assertEqual(results[1]['preview']['headers'], ['name', 'city'])
+        self.assertEqual(results[1]['preview']['data'][1], ['Cox, J', 'Decatur'])
+        self.assertEqual(results[1]['count'], 2)
+
+    @patch('search.utils.warehouse')
+    def test_batched_search_fallback(self, mock_warehouse):
+        """
+        If a batch fails, its tables should be searched one at a time
+        """
+        self._catalog(mock_warehouse, ['contracts', 'broken'])
+        connection = mock_warehouse.connect.return_value
+        error = exc.ProgrammingError('SELECT', {}, Exception("Can't find FULLTEXT index"))
+        connection.execute.return_value.fetchall.side_effect = [error]
+
+        manager = SearchManager()
+        def search_one(query, table):
+            if table['table'] == 'broken':
+                raise error
+            return {'table': table['table'], 'id': table['id']}
+
+        with patch.object(manager, '_search_one', side_effect=search_one):
+            results, incomplete = manager.warehouse_search('cox', ['name'])
+
+        self.assertEqual([r['table'] for r in results], ['contracts'])
+        self.assertEqual([m['table'] for m in incomplete], ['broken'])
+
+    @override_settings(SEARCH_BATCH_SIZE=2)
+    @patch('search.utils.warehouse')
+    def test_slow_batch_split_up(self, mock_warehouse):
+        """
+        Once a batch times out, its tables should be searched one at a time,
+        each with a timeout of its own
+        """
+        self._catalog(mock_warehouse, ['contracts', 'donors', 'voters'])
+        batches = []
+        def search_batch(query, batch):
+            batches.append([t['table'] for t in batch])
+            if len(batch) > 1:
+                raise exc.OperationalError('SELECT', {}, Exception(
+                    'Query execution was interrupted, maximum statement execution time exceeded'))
+            return ([], [])
+
+        manager = SearchManager()
+        with patch.object(manager, '_search_batch', side_effect=search_batch):
+            results, incomplete = manager.warehouse_search('cox', ['name'])
+            self.assertEqual(sorted(m['table'] for m in incomplete),
+                             ['contracts', 'donors'])
+            self.assertEqual(set(m['reason'] for m in incomplete), set(['timeout']))
+
+            del batches[:]
+            results, incomplete = manager.warehouse_search('cox', ['name'])
+
+        self.assertEqual(sorted(batches), [['contracts'], ['donors']])
+        self.assertEqual(incomplete, [])
+
+    @patch('search.utils.warehouse')
+    def test_search_cache(self, mock_warehouse):
+        """
+        A repeated search should be served from the cache, and adding a table
+        should only send the new table to the warehouse
+        """
+        self._catalog(mock_warehouse, ['contracts', 'donors'])
+        connection = mock_warehouse.connect.return_value
+        rows = [{'_table': 'donors', '_row': '["Jonathan Cox", "Atlanta"]'}]
+        connection.execute.return_value.fetchall.side_effect = [rows]
+
+        manager = SearchManager()
+        results, incomplete = manager.warehouse_search('Cox', ['name'])
+        self.assertEqual([r['table'] for r in results], ['donors'])
+
+        # Case and whitespace don't change a full-text search
+        connection.execute.reset_mock()
+        cached, incomplete = manager.warehouse_search(' cox ', ['name'])
+        self.assertEqual(cached, results)
+        self.assertFalse(connection.execute.called)
+
+        user = User.objects.get(username='jonathan')
+        voters = Table.objects.create(table='voters', user=user,
+                                      source='test', index_status='ready')
+        Column.objects.create(table=voters, column='name', mysql_type='varchar',
+                              information_type='full_name')
+        rows = [{'_table': 'voters', '_row': '["Cox, J", "Decatur"]'}]
+        connection.execute.return_value.fetchall.side_effect = [rows]
+
+        results, incomplete = manager.warehouse_search('cox', ['name'])
+
+        batch_query = str(connection.execute.call_args[0][0])
+        self.assertIn('imports.voters', batch_query)
+        self.assertNotIn('imports.donors', batch_query)
+        self.assertNotIn('imports.contracts', batch_query)
+        self.assertEqual(sorted(r['table'] for r in results), ['donors', 'voters'])
+
+        stats = SearchCache().stats()
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 5)
+
+    def test_searchable_tables(self):
+        """
+        The catalog should find the columns of each information type without
+        querying the Django DB again until something changes
+        """
+        user = User.objects.create_user(username='jonathan', password='mock_pw')
+        t = Table.objects.create(table='donors', user=user, source='test',
+                                 index_status='ready')
+        Column.objects.create(table=t, column='first', mysql_type='varchar',
+                              information_type='first_name')
+        Column.objects.create(table=t, column='street', mysql_type='varchar',
+                              information_type='street_address')
+        Column.objects.create(table=t, column='last', mysql_type='varchar',
+                              information_type='last_name')
+
+        self.assertEqual(catalog.searchable_tables(['name']), [{
+            'table': 'donors',
+            'id': t.id,
+            'columns': ['first', 'street', 'last'],
+            'search_columns': '`first`,`last`'
+        }])
+        with self.assertNumQueries(0):
+            tables = catalog.searchable_tables(['name', 'address'])
+        self.assertEqual(tables[0]['search_columns'], '`first`,`street`,`last`')
+        self.assertEqual(catalog.searchable_tables(['phone']), [])
+
+        # Tables aren't searchable until their indexes are built
+        t.index_status = 'building'
+        t.save()
+        self.assertEqual(catalog.searchable_tables(['name']), [])
+
+        # Another process changed the catalog
+        SearchCache().bump('voters')
+        with self.assertNumQueries(1):
+            catalog.searchable_tables(['name'])
+
+    @override_settings(SEARCH_CACHE_MAX_ENTRIES=2)
+    def test_search_cache_eviction(self):
+        """
+        The oldest entries should be evicted once the cache is full
+        """
+        cache = SearchCache()
+        keys = [cache.key('test', i) for i in range(3)]
+        for i, key in enumerate(keys):
+            cache.set(key, i)
+            time.sleep(0.01)
+
+        self.assertEqual(cache.get(keys[0]), (False, None))
+        self.assertEqual(cache.get(keys[2]), (True, 2))
+        self.assertEqual(cache.stats()['entries'], 2)
+
+
+class GetAllResultsViewTestCase(TestCase):
+    @patch('search.utils.warehouse')
+    def test_get_all_results(self, mock_warehouse):
+        """
+        The results should be streamed as a CSV with a header row
+        """
+        result = mock_warehouse.connect.return_value.execution_options.return_value.execute.return_value
+        result.keys.return_value = ['name', 'city']
+        result.fetchmany.side_effect = [[(u'Jos\xe9 Cox', 'Atlanta')], []]
+
+        session = self.client.session
+        session['sql_search_query'] = 'SELECT * FROM imports.donors'
+        session.save()
+
+        response = self.client.get(reverse('get_all_results'))
+
+        self.assertTrue(response.streaming)
+        content = ''.join(response.streaming_content)
+        self.assertEqual(content, 'name,city\r\nJos\xc3\xa9 Cox,Atlanta\r\n')
+
+    def test_get_all_results_without_search(self):
+        response = self.client.get(reverse('get_all_results'))
+        self.assertEqual(response.status_code, 400)
+
+
+class ExportViewTestCase(TestCase):
+    @patch('search.views.export_results')
+    def test_start_export(self, mock_export):
+        """
+        Starting an export should queue the task for the last search
+        """
+        mock_export.delay.return_value.id = 'abc'
+        session = self.client.session
+        session['sql_search_query'] = 'SELECT * FROM imports.donors'
+        session['sql_search_params'] = {'query': 'cox'}
+        session.save()
+
+        response = self.client.post(reverse('start_export'))
+
+        self.assertEqual(json.loads(response.content), {'task_id': 'abc'})
+        mock_export.delay.assert_called_with('SELECT * FROM imports.donors',
+                                             {'query': 'cox'})
+        self.assertEqual(self.client.session['export_task_ids'], ['abc'])
+
+    @patch('search.views.AsyncResult')
+    def test_export_status(self, mock_result):
+        """
+        Users should only be able to check on their own exports
+        """
+        mock_result.return_value.status = 'SUCCESS'
+        mock_result.return_value.result = {'error': False, 'rows': 10,
+                                           'url': 'http://test-url.com'}
+        session = self.client.session
+        session['export_task_ids'] = ['abc']
+        session.save()
+
+        response = self.client.get(reverse('export_status'), {'task_id': 'abc'})
+        self.assertEqual(json.loads(response.content)['result']['url'],
+                         'http://test-url.com')
+
+        response = self.client.get(reverse('export_status'), {'task_id': 'xyz'})
+        self.assertEqual(response.status_code, 400)
+
+
+class SearchDetailViewTestCase(TestCase):
+    def setUp(self):
+        patcher = patch('search.cache.get_redis', return_value=MockRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('search.views.count_matches')
+    @patch('search.views.SearchManager.table_search')
+    def test_search_detail(self, mock_search, mock_count):
+        """
+        The detail page should show a page of matches, save the unpaged search
+        for downloading, and start counting every match
+        """
+        data = [['Cox, J']] * 50
+        mock_search.return_value = ('SELECT * FROM imports.donors', {
+            'table': 'donors', 'search_columns': '`name`', 'count': 50,
+            'first_row': 51, 'last_row': 100,
+            'preview': {'headers': ['name'], 'data': data}})
+
+        response = self.client.post('/search/detail/', {
+            'query': 'cox', 'table': 'donors', 'search_columns': '`name`',
+            'after': 50, 'page': 2})
+
+        mock_search.assert_called_with(query='cox', table='donors',
+                                       search_columns='`name`', preview=50,
+                                       after=50)
+        mock_count.delay.assert_called_with('cox', 'donors', '`name`')
+        self.assertEqual(self.client.session['sql_search_query'],
+                         'SELECT * FROM imports.donors')
+        self.assertEqual(self.client.session['sql_search_params'], {'query': 'cox'})
+        self.assertTrue(response.context['has_next'])
+        self.assertTrue(response.context['has_previous'])
+        self.assertEqual(response.context['count'], None)
+
+        # Paging on while the count runs shouldn't queue it again
+        self.client.post('/search/detail/', {
+            'query': 'cox', 'table': 'donors', 'search_columns': '`name`',
+            'after': 100, 'page': 3})
+        self.assertEqual(mock_count.delay.call_count, 1)
+
+    @patch('search.views.count_matches')
+    @patch('search.views.SearchManager.table_search')
+    def test_search_detail_bad_page(self, mock_search, mock_count):
+        """
+        Malformed paging should be a 400 rather than a 500
+        """
+        for data in ({'page': 'two'}, {'page': 0}, {'after': 'x'},
+                     {'before': '-5'}):
+            data.update({'query': 'cox', 'table': 'donors',
+                         'search_columns': '`name`'})
+            response = self.client.post('/search/detail/', data)
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(mock_search.called)
+        self.assertFalse(mock_count.delay.called)
+
+
+class QueryLogTestCase(TestCase):
+    """
+    Test that slow warehouse statements are saved with their EXPLAIN output
+    """
+    def _execute(self, sql_query, *args):
+        result = MagicMock()
+        if sql_query.startswith('EXPLAIN'):
+            result.keys.return_value = ['table', 'type', 'rows']
+            result.fetchall.return_value = [('donors', 'ALL', 50000)]
+        else:
+            result.keys.return_value = ['name']
+            result.fetchall.return_value = [('Cox, J',), ('Cox, K',)]
+        return result
+
+    @override_settings(SEARCH_SLOW_QUERY_SECONDS=0)
+    @patch('search.utils.warehouse')
+    def test_slow_query_logged(self, mock_warehouse):
+        connection = mock_warehouse.connect.return_value
+        connection.execute.side_effect = self._execute
+
+        SearchManager().simple_query("SELECT * FROM imports.donors WHERE name = 'Cox'")
+
+        log = QueryLog.objects.get()
+        self.assertEqual((log.kind, log.tables, log.rows), ('query', 'donors', 2))
+        self.assertEqual(log.explain_rows, [{'table': 'donors', 'type': 'ALL', 'rows': 50000}])
+        self.assertTrue(log.full_scan)
+        self.assertEqual(log.error, '')
+        self.assertTrue(connection.close.called)
+
+    @override_settings(SEARCH_SLOW_QUERY_SECONDS=0)
+    @patch('search.utils.warehouse')
+    def test_failed_query_logged(self, mock_warehouse):
+        connection = mock_warehouse.connect.return_value
+        connection.execute.side_effect = exc.OperationalError(
+            'SELECT', {}, "Can't find FULLTEXT index matching the column list")
+
+        with self.assertRaises(exc.OperationalError):
+            SearchManager().count_matches('cox', 'donors', '`name`')
+
+        log = QueryLog.objects.get()
+        self.assertEqual((log.kind, log.tables), ('count', 'donors'))
+        self.assertIn('FULLTEXT', log.error)
+        self.assertIn('FULLTEXT', log.explain)
+        self.assertFalse(log.full_scan)
+
+    @override_settings(SEARCH_SLOW_QUERY_SECONDS=0)
+    @patch('search.utils.warehouse')
+    def test_export_not_logged(self, mock_warehouse):
+        """
+        Exports read every row on purpose, so they're never slow queries
+        """
+        connection = mock_warehouse.connect.return_value
+        connection.execute.side_effect = self._execute
+        result = connection.execution_options.return_value.execute.return_value
+        result.keys.return_value = ['name']
+        result.fetchmany.side_effect = [[('Cox, J',)], []]
+        list(SearchManager().stream_query('SELECT * FROM imports.donors',
+                                          kind='export'))
+        self.assertEqual(QueryLog.objects.count(), 0)
+
+    @patch('search.utils.warehouse')
+    def test_fast_query_not_logged(self, mock_warehouse):
+        mock_warehouse.connect.return_value.execute.side_effect = self._execute
+        SearchManager().simple_query('SELECT * FROM imports.donors')
+        self.assertEqual(QueryLog.objects.count(), 0)
+
+    def test_fingerprint(self):
+        """
+        Searches that only differ in their terms, limits and hints should
+        group together
+        """
+        a = querylog.fingerprint("SELECT /*+ MAX_EXECUTION_TIME(5000) */ * FROM imports.donors "
+                                 "WHERE MATCH(`name`) AGAINST('cox' IN BOOLEAN MODE) LIMIT 5")
+        b = querylog.fingerprint("SELECT * FROM imports.donors\n"
+                                 "WHERE MATCH(`name`) AGAINST('o\\'brien' IN BOOLEAN MODE) LIMIT 50")
+        c = querylog.fingerprint("SELECT * FROM imports.voters "
+                                 "WHERE MATCH(`name`) AGAINST('cox' IN BOOLEAN MODE) LIMIT 5")
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+    def test_report(self):
+        def log(tables, duration, full_scan=False, sql='SELECT 1'):
+            QueryLog.objects.create(kind='batch', tables=tables, sql=sql,
+                                    fingerprint=querylog.fingerprint(sql),
+                                    duration=duration, full_scan=full_scan)
+        log('donors,voters', 4.0, sql='SELECT 2')
+        log('donors', 3.0, full_scan=True)
+        log('voters', 1.0)
+
+        tables = querylog.worst_tables()
+        self.assertEqual([t['table'] for t in tables], ['donors', 'voters'])
+        self.assertEqual((tables[0]['count'], tables[0]['total'], tables[0]['worst'],
+                          tables[0]['full_scans']), (2, 7.0, 4.0, 1))
+
+        queries = querylog.worst_queries()
+        self.assertEqual([(q['example'], q['count']) for q in queries],
+                         [('SELECT 2', 3)])
+
+        user = User.objects.create_superuser('admin', 'admin@ajc.com', 'mock_pw')
+        self.client.force_login(user)
+        response = self.client.get(reverse('admin:search_querylog_changelist'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['worst_tables'][0]['table'], 'donors')
@@ -6,5 +6,8 @@ urlpatterns = [
     url(r'^$', views.search),
     url(r'^detail/$', views.search_detail),
     url(r'^get-all-results/$', views.get_all_results, name='get_all_results'),
+    url(r'^count/$', views.match_count, name='match_count'),
+    url(r'^export/$', views.start_export, name='start_export'),
+    url(r'^export-status/$', views.export_status, name='export_status'),
 ]
 
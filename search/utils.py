@@ -1,13 +1,40 @@
+# Stdlib imports
+import json
+import time
+import logging
+
 # Django imports
 from django.conf import settings
 
 # Third-party imports
-from sqlalchemy import create_engine
+from concurrent.futures import ThreadPoolExecutor, wait
+from sqlalchemy import exc, text
+
+# Local imports
+from data_import_tool import warehouse
+from data_import_tool.warehouse import ROW_ID
+from .cache import SearchCache, normalize
+from . import catalog, querylog
 
 # Constants
 DATA_WAREHOUSE_URL = settings.DATA_WAREHOUSE_URL
 BUCKET_NAME = settings.S3_BUCKET
 
+logger = logging.getLogger(__name__)
+
+
+def _jsonable(value):
+    """
+    Convert a value from MySQL (e.g. a Decimal or a date) into one that
+    survives a round trip through the JSON in the search cache
+    """
+    if value is None or isinstance(value, (bool, int, long, float, unicode)):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
 class SearchManager(object):
     """
     This module handles generating search queries for all the tables in the
@@ -22,17 +49,84 @@ class SearchManager(object):
             sql_query (string): A raw SQL query
 
         Returns:
-            search_result (string[][]): An array of arrays with the results of
-            the query
+            A two-tuple with the column names and an array of arrays with the
+            results of the query
         """
         connection = self.connect_to_db()
-        search_result = connection.execute(sql_query)
-        connection.close
+        try:
+            with querylog.timed(connection, 'query', sql_query) as timing:
+                search_result = connection.execute(sql_query)
+                headers = search_result.keys()
+                rows = search_result.fetchall()
+                timing.rows = len(rows)
+        finally:
+            connection.close()
 
-        return search_result
+        return (headers, rows)
 
+    def stream_query(self, sql_query, batch_size=1000, kind='stream',
+                     params=None):
+        """
+        This method executes a SQL query on a server-side cursor, so rows are
+        sent over as they're read instead of all being buffered in memory
+        first. The connection goes back to the pool once the generator is
+        exhausted or closed.
 
-    def table_search(self, query, table, search_columns, preview=None):
+        Arguments:
+            sql_query (string): A raw SQL query
+            batch_size (int): How many rows to fetch from the cursor at a time
+            kind (string): What the query is for, from QueryLog.KIND_CHOICES.
+                Pass 'export' for downloads of every row, which are never
+                logged as slow queries
+            params (dict): Values to bind to the query's :name placeholders
+
+        Returns:
+            A generator that yields the column names, then each row
+        """
+        connection = self.connect_to_db()
+        try:
+            with querylog.timed(connection, kind, sql_query, params) as timing:
+                # Only time the waits on MySQL, not whatever the consumer
+                # does with each row
+                start = time.time()
+                streaming = connection.execution_options(stream_results=True)
+                if params:
+                    result = streaming.execute(text(sql_query), **params)
+                else:
+                    result = streaming.execute(sql_query)
+                timing.elapsed = time.time() - start
+                timing.rows = 0
+
+                # Leave out the hidden row IDs
+                headers = result.keys()
+                row_id = headers.index(ROW_ID) if ROW_ID in headers else None
+                if row_id is not None:
+                    del headers[row_id]
+                yield headers
+
+                try:
+                    while True:
+                        start = time.time()
+                        rows = result.fetchmany(batch_size)
+                        timing.elapsed += time.time() - start
+                        timing.rows += len(rows)
+                        if not rows:
+                            break
+                        for row in rows:
+                            if row_id is not None:
+                                row = list(row)
+                                del row[row_id]
+                            yield row
+                finally:
+                    # The cursor has to be closed before a slow query can be
+                    # explained on the same connection
+                    result.close()
+        finally:
+            connection.close()
+
+
+    def table_search(self, query, table, search_columns, preview=None,
+                     timeout=None, cache=True, after=None, before=None):
         """
         This method performs a search on a subset of columns within a given
         table, and returns matching rows.
@@ -44,10 +138,20 @@ class SearchManager(object):
             to be searched
             preview (int): If None, the method will return all matching rows.
             Otherwise, it will return the number of rows passed to this argument
+            timeout (float): If set, the number of seconds MySQL is allowed to
+            spend on the query before it's killed
+            cache (bool): Whether to look for the result in the search cache,
+            and save it there
+            after (int): Return the page of matches right after the row with
+            this row ID. Pass 0 for the first page
+            before (int): Return the page of matches right before the row with
+            this row ID
 
         Returns:
-            A two-tuple with the search SQL query generated by the function, and
-            the resulting rows as an array of string[] arrays.
+            A two-tuple with the search SQL query generated by the function
+            (without any paging, so it finds every match), and the resulting
+            rows as an array of string[] arrays. The search term is bound to
+            the query's :query placeholder rather than written into it.
         """
 
         # Uncomment the lines below if you want to treat spaces as logical ANDs
@@ -56,28 +160,161 @@ class SearchManager(object):
         # query = re.sub(r, '+' + r.match(query).group(1), query)
         # query = re.sub(r'\s', ' +', query) # MySQL treats + as logical AND
 
+        # MAX_EXECUTION_TIME is a MySQL 5.7 optimizer hint. Older servers treat
+        # it as a comment
+        hint = ''
+        if timeout:
+            hint = '/*+ MAX_EXECUTION_TIME({}) */ '.format(int(timeout * 1000))
+
         sql_query = '''
-            SELECT * FROM imports.{table}
+            SELECT {hint}* FROM imports.{table}
             WHERE MATCH({search_columns})
-            AGAINST('{query}' IN BOOLEAN MODE)
-            '''.format(table=table, search_columns=search_columns, query=query)
+            AGAINST(:query IN BOOLEAN MODE)
+            '''.format(hint=hint, table=table, search_columns=search_columns)
+
+        # Page through the matches by row ID rather than with OFFSET, so that
+        # MySQL never reads the rows on earlier pages just to skip them. It
+        # still finds every match of the FULLTEXT search before it applies
+        # the row ID range, so later pages don't cost less than the first
+        page_query = sql_query
+        if after is not None:
+            page_query += 'AND {} > {} ORDER BY {} '.format(ROW_ID, int(after), ROW_ID)
+        elif before is not None:
+            page_query += 'AND {} < {} ORDER BY {} DESC '.format(ROW_ID, int(before), ROW_ID)
 
         if preview:
-            sql_query+='LIMIT {}'.format(str(preview))
+            page_query+='LIMIT {}'.format(str(preview))
+
+        key = None
+        if cache:
+            search_cache = SearchCache()
+            versions = search_cache.table_versions([table])
+            if versions is not None:
+                key = search_cache.key('table_search', table, versions[0],
+                                       normalize(query), search_columns,
+                                       preview, after, before)
+                found, result = search_cache.get(key)
+                if found:
+                    return (sql_query, result) if result else None
 
         connection = self.connect_to_db()
-        search_result = connection.execute(sql_query).fetchall()
-        connection.close()
+        try:
+            with querylog.timed(connection, 'search', page_query,
+                                {'query': query}) as timing:
+                search_result = connection.execute(text(page_query),
+                                                   query=query).fetchall()
+                timing.rows = len(search_result)
+        finally:
+            connection.close()
+
+        if before is not None:
+            search_result.reverse()
+
+        matches = self._format_matches(table, search_columns, search_result)
+        if key:
+            search_cache.set(key, matches)
+
+        return (sql_query, matches) if matches else None
+
+    def _count_key(self, search_cache, query, table, search_columns):
+        versions = search_cache.table_versions([table])
+        if versions is None:
+            return None
+        return search_cache.key('count', table, versions[0], normalize(query),
+                                search_columns)
+
+    def cached_count(self, query, table, search_columns):
+        """
+        Look up how many rows of a table match a search, if count_matches has
+        already counted them since the table last changed
+
+        Returns:
+            The number of matching rows, or None if they haven't been counted
+        """
+        search_cache = SearchCache()
+        key = self._count_key(search_cache, query, table, search_columns)
+        if key is None:
+            return None
+        found, count = search_cache.get(key)
+        return count if found else None
+
+    def claim_count(self, query, table, search_columns):
+        """
+        Claim counting the matches of a search, so that the count_matches
+        task is queued once per search rather than once for every page of
+        results requested while it runs
+
+        Returns:
+            True if the caller should queue the count
+        """
+        search_cache = SearchCache()
+        key = self._count_key(search_cache, query, table, search_columns)
+        if key is None:
+            return False
+        return search_cache.claim(key, settings.SEARCH_COUNT_TIMEOUT)
+
+    def count_matches(self, query, table, search_columns):
+        """
+        Count every row of a table that matches a search, and cache the count
+        until the table changes. This can take a while on big tables, so it
+        runs in the count_matches task rather than in a request.
+
+        Returns:
+            The number of matching rows
+        """
+        sql_query = '''
+            SELECT COUNT(*) FROM imports.{table}
+            WHERE MATCH({search_columns})
+            AGAINST(:query IN BOOLEAN MODE)
+            '''.format(table=table, search_columns=search_columns)
+
+        # Get the key first, so that a table that changes while we count
+        # doesn't get its new version's count from the old rows
+        search_cache = SearchCache()
+        key = self._count_key(search_cache, query, table, search_columns)
+
+        connection = self.connect_to_db()
+        try:
+            with querylog.timed(connection, 'count', sql_query,
+                                {'query': query}) as timing:
+                count = connection.execute(text(sql_query), query=query).scalar()
+                timing.rows = 1
+        finally:
+            connection.close()
 
+        if key is not None:
+            search_cache.set(key, count)
+        return count
+
+    def _format_matches(self, table, search_columns, search_result):
+        """
+        Turn the rows a table search returned into a result dict, with every
+        value converted to something that can be cached as JSON. The hidden
+        row IDs are left out of the rows, but the first and last are kept for
+        paging.
+
+        Returns:
+            A result dict, or None if there weren't any rows
+        """
         if len(search_result) > 0:
             result = { 'table' : table,
                        'search_columns' : search_columns}
             result['preview']={}
-            result['preview']['headers'] = search_result[0].keys()
+            headers = search_result[0].keys()
+
+            row_id = headers.index(ROW_ID) if ROW_ID in headers else None
+            if row_id is not None:
+                result['first_row'] = search_result[0][row_id]
+                result['last_row'] = search_result[-1][row_id]
+                del headers[row_id]
+            result['preview']['headers'] = headers
 
             values = []
             for row in search_result:
-                values.append(row.values())
+                row = [_jsonable(v) for v in row.values()]
+                if row_id is not None:
+                    del row[row_id]
+                values.append(row)
 
             result['preview']['data'] = values
 
@@ -86,71 +323,275 @@ class SearchManager(object):
             else:
                 result['count'] = 'more than 50'
 
-            return (sql_query, result)
+            return result
 
         else:
             return None
 
 
+    def _search_one(self, query, table):
+        """
+        Search the first few rows of a single table on a worker thread
+
+        Returns:
+            A result dict, or None if there weren't any matches
+        """
+        params = {
+            'query': query,
+            'table': table['table'],
+            'search_columns': table['search_columns'],
+            'preview': 5,
+            'timeout': settings.SEARCH_TABLE_TIMEOUT,
+            'cache': False  # warehouse_search caches each table itself
+        }
+        matches = self.table_search(**params)
+        if not matches:
+            return None
+
+        throwaway, result = matches
+        result['id'] = int(table['id'])
+        return result
+
+    def _batch_query(self, batch, preview, timeout):
+        """
+        Generate a single UNION ALL statement that searches every table in a
+        batch. Tables have different columns, so each row comes back as a
+        JSON array tagged with the name of its table. Every table is
+        searched for the term bound to :query.
+        """
+        selects = []
+        for table in batch:
+            columns = ','.join('`{}`'.format(c) for c in table['columns'])
+            selects.append('''(
+                SELECT '{table}' AS _table, JSON_ARRAY({columns}) AS _row
+                FROM imports.{table}
+                WHERE MATCH({search_columns})
+                AGAINST(:query IN BOOLEAN MODE)
+                LIMIT {preview})'''.format(table=table['table'],
+                                          columns=columns,
+                                          search_columns=table['search_columns'],
+                                          preview=preview))
+
+        return '''
+            SELECT /*+ MAX_EXECUTION_TIME({timeout}) */ _table, _row FROM (
+            {selects}
+            ) AS batch'''.format(timeout=int(timeout * 1000),
+                                 selects='\nUNION ALL\n'.join(selects))
+
+    def _search_batch(self, query, batch):
+        """
+        Search the first few rows of a batch of tables in one round trip, on
+        a worker thread. If the batch fails (e.g. one of its tables has no
+        FULLTEXT index), search its tables one at a time so that the broken
+        one doesn't take the others down with it.
+
+        Returns:
+            A two-tuple with an array of result dicts for the tables that had
+            matches, and an array of the tables that failed
+        """
+        timeout = min(settings.SEARCH_TABLE_TIMEOUT * len(batch),
+                      settings.SEARCH_DEADLINE)
+        sql_query = self._batch_query(batch, 5, timeout)
+
+        connection = self.connect_to_db()
+        try:
+            with querylog.timed(connection, 'batch', sql_query,
+                                {'query': query}) as timing:
+                rows = connection.execute(text(sql_query), query=query).fetchall()
+                timing.rows = len(rows)
+        except exc.SQLAlchemyError as e:
+            if len(batch) == 1 or 'maximum statement execution time' in str(e):
+                raise
+            logger.warning('Batched search failed, searching tables one at a time: %s', e)
+            rows = None
+        finally:
+            connection.close()
+
+        if rows is None:
+            return self._search_separately(query, batch)
+
+        matches = {}
+        for row in rows:
+            matches.setdefault(row['_table'], []).append(json.loads(row['_row']))
+
+        results = []
+        for table in batch:
+            values = matches.get(table['table'])
+            if values:
+                results.append({'table': table['table'],
+                                'id': int(table['id']),
+                                'search_columns': table['search_columns'],
+                                'preview': {'headers': table['columns'],
+                                            'data': values},
+                                'count': len(values)})
+
+        return (results, [])
+
+    def _search_separately(self, query, batch):
+        results = []
+        failed = []
+        for table in batch:
+            try:
+                result = self._search_one(query, table)
+            except exc.SQLAlchemyError as e:
+                logger.warning('Search failed on table %s: %s', table['table'], e)
+                failed.append(table)
+                continue
+
+            if result:
+                results.append(result)
+
+        return (results, failed)
+
     def warehouse_search(self, query, filter):
         """
         This method performs a search of columns within the Django DB and returns
         information about which tables contain columns matching the given datatype,
         and returns an array with rows matching the query
 
+        The tables are grouped into batches of SEARCH_BATCH_SIZE, each
+        searched with a single UNION ALL statement, and the batches run in
+        parallel on SEARCH_WORKERS threads. MySQL kills a batch after
+        SEARCH_TABLE_TIMEOUT seconds per table in it, and the search returns
+        whatever has finished after SEARCH_DEADLINE seconds, so one slow or
+        broken table can't hold up the rest. The tables of a batch that timed
+        out are searched one at a time, each with a timeout of its own, for
+        SEARCH_CACHE_TTL seconds afterwards, so that a slow table only costs
+        its own results.
+
+        Complete searches are cached until the catalog changes, and so is
+        the result for each table (including finding nothing) until that
+        table changes, so only new or changed tables are searched again.
+
         Arguments:
             query (string): The term being searched for
             filter (string): The data_type the user is interested in (eg address)
 
         Returns:
-            An array of string[] arrays with the specified number of rows
-            matching the query.
-        """
-        if len(query)>0:
-            connection = self.connect_to_db()
-            filter = filter or ['name'] # Default to searching by name
-            data_type = '("{}")'.format(('","').join(filter))
-
-            #SQL statement below pulls unique database-table-columns combos
-            #to feed into a search. The SUBSTRING_INDEX query converts
-            # "first_name" to just "name" to facilitate searching
-            fquery = '''SELECT t.table, t.id,
-                CONCAT('`',GROUP_CONCAT(c.column SEPARATOR '`,`'),'`') AS search_columns
-                FROM data_import_tool.upload_table t
-                JOIN data_import_tool.upload_column c
-                ON t.id=c.table_id
-                WHERE SUBSTRING_INDEX(c.information_type,"_",-1) IN {}
-                GROUP BY 1'''.format(data_type)
-
-            tables_to_search = connection.execute(fquery).fetchall()
-            connection.close()
+            A two-tuple with (1) an array of results with the specified number
+            of rows matching the query from each table, and (2) an array of
+            the tables that couldn't be searched, each with the reason
+            ("timeout" or "error")
+        """
+        if not query:
+            return ([], [])
 
-            results = []
-            for table in tables_to_search:
-                # Wrap this in a try-except becase if there are zero matches
-                # trying to iterate through tables_to_search will throw an error
-                try:
-                    params = {
-                        'query': query,
-                        'table': table['table'],
-                        'search_columns': table['search_columns'],
-                        'preview': 5
-                    }
-                    throwaway, result = self.table_search(**params)
-
-                    if result:
-                        result['id'] = int(table['id'])
-                        results.append(result)
-                except TypeError:
-                    continue
-
-            return results
+        filter = filter or ['name'] # Default to searching by name
+
+        search_cache = SearchCache()
+        normalized = normalize(query)
+        version = search_cache.catalog_version()
+        search_key = None
+        if version is not None:
+            search_key = search_cache.key('warehouse_search', version,
+                                          normalized, sorted(filter))
+            found, results = search_cache.get(search_key)
+            if found:
+                return (results, [])
+
+        # The catalog maps information types (e.g. "name" for "first_name"
+        # and "last_name") to the tables with columns of that type, and is
+        # only read from the Django DB again when a table or column changes
+        tables = catalog.searchable_tables(filter)
+        if not tables:
+            return ([], [])
+
+        # Reuse the result for any table that hasn't changed since it was
+        # last searched for the same thing
+        results = []
+        table_keys = {}
+        versions = search_cache.table_versions([t['table'] for t in tables])
+        if versions is not None:
+            for table, v in zip(tables, versions):
+                table_keys[table['table']] = search_cache.key(
+                    'table', table['table'], v, normalized,
+                    table['search_columns'])
+
+            cached = search_cache.get_many([table_keys[t['table']] for t in tables])
+            misses = []
+            for table, (found, result) in zip(tables, cached):
+                if not found:
+                    misses.append(table)
+                elif result:
+                    results.append(dict(result, id=int(table['id'])))
+            tables = misses
+
+        if not tables:
+            if search_key:
+                search_cache.set(search_key, results)
+            return (results, [])
+
+        # Group the tables into batches so that each round trip to MySQL
+        # searches several of them at once. Tables from a batch that timed
+        # out recently get a batch of their own
+        slow = search_cache.slow_tables([t['table'] for t in tables])
+        batched = [t for t in tables if t['table'] not in slow]
+        size = settings.SEARCH_BATCH_SIZE
+        batches = [batched[i:i + size] for i in range(0, len(batched), size)]
+        batches.extend([t] for t in tables if t['table'] in slow)
+
+        workers = min(settings.SEARCH_WORKERS, len(batches))
+        pool = ThreadPoolExecutor(workers)
+        futures = [(batch, pool.submit(self._search_batch, query, batch))
+                   for batch in batches]
+
+        # Don't wait for stragglers past the deadline. Their threads finish on
+        # their own once MySQL kills the query
+        wait([f for b, f in futures], timeout=settings.SEARCH_DEADLINE)
+        pool.shutdown(wait=False)
+
+        incomplete = []
+        fresh = {}
+        timed_out_batches = []
+        for batch, future in futures:
+            missed = [{'table': t['table'], 'id': int(t['id'])} for t in batch]
+            if not future.done():
+                future.cancel()
+                incomplete.extend(dict(m, reason='timeout') for m in missed)
+                timed_out_batches.append(batch)
+                continue
+
+            try:
+                batch_results, failed = future.result()
+            except exc.SQLAlchemyError as e:
+                # MySQL error 3024 means MAX_EXECUTION_TIME ran out
+                timed_out = 'maximum statement execution time' in str(e)
+                reason = 'timeout' if timed_out else 'error'
+                incomplete.extend(dict(m, reason=reason) for m in missed)
+                if timed_out:
+                    timed_out_batches.append(batch)
+                logger.warning('Search failed on tables %s: %s',
+                               ', '.join(t['table'] for t in batch), e)
+                continue
+
+            results.extend(batch_results)
+            incomplete.extend({'table': t['table'], 'id': int(t['id']),
+                               'reason': 'error'} for t in failed)
+
+            failed = set(t['table'] for t in failed)
+            matched = dict((r['table'], r) for r in batch_results)
+            for table in batch:
+                name = table['table']
+                if name in table_keys and name not in failed:
+                    fresh[table_keys[name]] = matched.get(name)
+
+        # There's no telling which table held up a batch, so the next
+        # searches try each of them on its own
+        search_cache.mark_slow([t['table'] for batch in timed_out_batches
+                                if len(batch) > 1 for t in batch])
+
+        search_cache.set_many(fresh)
+        # Partial results aren't cached, so the next search tries again
+        if search_key and not incomplete:
+            search_cache.set(search_key, results)
+
+        return (results, incomplete)
 
     def connect_to_db(self):
         """
-        This method connects to the MySQL database and returns a sqlAlchemy
-        connection object
+        This method borrows a connection to the MySQL database from the
+        process-wide pool and returns it as a sqlAlchemy connection object.
+        Close it to return it to the pool.
         """
-        engine = create_engine(DATA_WAREHOUSE_URL)
-        return engine.connect()
+        return warehouse.connect()
 
@@ -1,19 +1,37 @@
 # Stdlib imports
-import os
 import csv
-import re
 
 # Django imports
 from django.utils.html import escape
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse, HttpResponseBadRequest, JsonResponse
+from django.views.decorators.http import require_POST
 from django.conf import settings
 
+# Third party imports
+from celery.result import AsyncResult
+
 # Local module imports
 from .utils import SearchManager
+from .tasks import export_results, count_matches
 
 BUCKET_NAME = settings.S3_BUCKET
-TMP_PATH = os.path.join('/tmp', 'data-upload-tmp.csv')
+PAGE_SIZE = 50
+
+
+class Echo(object):
+    """
+    A file-like object that hands back whatever is written to it, so that
+    csv.writer can format rows for a streaming response without a buffer
+    """
+    def write(self, value):
+        return value
+
+
+def _encode(row):
+    # The csv module in python 2 only writes bytes
+    return [v.encode('utf-8') if isinstance(v, unicode) else v for v in row]
+
 
 def search(request):
     results = []
@@ -41,7 +59,8 @@ def search(request):
             context['filter'] = filter_names[filters[0]]
 
             searchManager = SearchManager()
-            res = searchManager.warehouse_search(query, filters)
+            res, incomplete = searchManager.warehouse_search(query, filters)
+            context['incomplete'] = incomplete
 
             if not res:
                 context['error'] = '''No results found for "{}".'''.format(query)
@@ -54,47 +73,143 @@ def search(request):
 
 def get_all_results(request):
     sql_query = request.session.get('sql_search_query')
+    if not sql_query:
+        return HttpResponseBadRequest('Search for something before downloading the results')
 
+    # Stream the rows straight from a server-side cursor into the response,
+    # so memory use stays flat no matter how many rows match
     searchManager = SearchManager()
-    search_result = searchManager.simple_query(sql_query)
-
-    # Add error handling here for cases where the search results array is empty
-    with open(TMP_PATH, 'wb') as f:
-        # fields = search_result[0].keys()
-        writer = csv.writer(f, delimiter=',')
-        writer.writerows([row.values() for row in search_result])
+    rows = searchManager.stream_query(sql_query, kind='export',
+                                      params=request.session.get('sql_search_params'))
+    writer = csv.writer(Echo(), delimiter=',')
 
-    # Generate an HttpResponse that prompts the user to download the CSV
-    response = HttpResponse(file(TMP_PATH), content_type='text/csv')
+    # Generate a response that prompts the user to download the CSV
+    response = StreamingHttpResponse((writer.writerow(_encode(row)) for row in rows),
+                                     content_type='text/csv')
     response['Content-Disposition'] = 'attachment; filename=search-results.csv'
     return response
 
-def search_detail(request):
-    results = []
+@require_POST
+def start_export(request):
+    """
+    Start exporting every result of the last search to S3 in the background,
+    and return the ID of the task so the page can poll for progress
+    """
+    sql_query = request.session.get('sql_search_query')
+    if not sql_query:
+        return HttpResponseBadRequest('Search for something before downloading the results')
+
+    task = export_results.delay(sql_query,
+                                request.session.get('sql_search_params'))
+
+    # Only let users check on their own exports, since the result holds a
+    # link to the data
+    request.session['export_task_ids'] = request.session.get('export_task_ids', []) + [task.id]
+    return JsonResponse({'task_id': task.id})
+
+
+def export_status(request):
+    """
+    Check the progress of an export task. Once it's finished the result has
+    a presigned URL to download the CSV from.
+    """
+    task_id = request.GET.get('task_id')
+    if task_id not in request.session.get('export_task_ids', []):
+        return HttpResponseBadRequest('Unknown export')
+
+    response = AsyncResult(task_id)
+    data = {
+        'status': response.status,
+        'result': response.result
+    }
+
+    # If response isn't JSON serializable then it's an error message.
+    # Convert it to a string and return it
+    try:
+        return JsonResponse(data)
+    except TypeError:
+        data['result'] = str(data['result'])
+        return JsonResponse(data)
+
+
+def _int_param(request, name, default, minimum):
+    """
+    Read an integer from the POST data
+
+    Returns:
+        The integer, the default if it's missing, or None if it's malformed
+    """
+    value = request.POST.get(name)
+    if not value:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        return None
+    return value if value >= minimum else None
+
 
+def search_detail(request):
     if request.method == 'POST':
         query = request.POST.get('query', None)
         table = request.POST.get('table', None)
         search_columns = request.POST.get('search_columns', None)
-
-        # Return a maximum of 50 rows and create a link to download a CSV
-        # with all the search results
+        after = _int_param(request, 'after', 0, 0)
+        before = _int_param(request, 'before', 0, 0)
+        page = _int_param(request, 'page', 1, 1)
+        if None in (after, before, page):
+            return HttpResponseBadRequest('Invalid page')
+
+        # Show a page of up to PAGE_SIZE rows at a time, starting after (or
+        # ending before) the row IDs of the last page, and create a link to
+        # download a CSV with all the search results
         searchManager = SearchManager()
         params = {'query': query, 'table': table,
-                  'search_columns': search_columns, 'preview': 50}
-        sql_query, search_result = searchManager.table_search(**params)
-        results.append(search_result)
-
-        # Strip the LIMIT clause out of the SQL query and save it to session
-        # storage
-        r = re.compile(r'LIMIT \d+$')
-        sql_query = r.sub('', sql_query)
-        request.session['sql_search_query'] = sql_query
-
-        context = {'query': query, 'result': results[0], 'detail': True}
+                  'search_columns': search_columns, 'preview': PAGE_SIZE}
+        if before:
+            params['before'] = before
+        else:
+            params['after'] = after
+        matches = searchManager.table_search(**params)
+
+        result = None
+        if matches:
+            # Save the search without paging to session storage, along
+            # with the term to bind to it
+            sql_query, result = matches
+            request.session['sql_search_query'] = sql_query
+            request.session['sql_search_params'] = {'query': query}
+
+        # Counting every match can take a while on big tables, so do it in
+        # the background and let the page ask for it
+        count = searchManager.cached_count(query, table, search_columns)
+        if count is None and searchManager.claim_count(query, table,
+                                                       search_columns):
+            count_matches.delay(query, table, search_columns)
+
+        context = {'query': query,
+                   'table': table,
+                   'search_columns': search_columns,
+                   'result': result,
+                   'count': count,
+                   'page': page,
+                   'has_previous': page > 1,
+                   'has_next': bool(result) and len(result['preview']['data']) == PAGE_SIZE,
+                   'detail': True}
 
     else:
         context = {'results': []}
 
     return render(request,'search/detail.html', context)
 
+
+def match_count(request):
+    """
+    Return the number of rows of a table that match a search once the
+    count_matches task has counted them, or null until then
+    """
+    searchManager = SearchManager()
+    count = searchManager.cached_count(request.GET.get('query'),
+                                       request.GET.get('table'),
+                                       request.GET.get('search_columns'))
+    return JsonResponse({'count': count})
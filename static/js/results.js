@@ -5,7 +5,7 @@ function getResult(cb) {
     success: function(res) {
       if (cb(res) === 'incomplete') {
         // Poll the server every half second until a result is received
-        setTimeout(getResult(checkResponseStatus), 500)
+        setTimeout(function() { getResult(checkResponseStatus); }, 500)
       }
     },
     error: function(res) {
@@ -14,6 +14,41 @@ function getResult(cb) {
   });
 };
 
+// Listen for progress on the load_infile task as it's pushed from the
+// server. Once the task is over, get the result from check_task_status. If
+// the browser can't stream events, or the stream keeps failing, poll instead
+function watchProgress() {
+  if (!window.EventSource) {
+    getResult(checkResponseStatus);
+    return;
+  }
+
+  var source = new EventSource('/task-progress/');
+  var failures = 0;
+
+  source.onmessage = function(e) {
+    failures = 0;
+    var res = JSON.parse(e.data);
+    if (res.status === 'PROGRESS') {
+      checkResponseStatus(res);
+    }
+    else if (res.status !== 'PENDING') {
+      source.close();
+      getResult(checkResponseStatus);
+    }
+  };
+
+  // The stream closes every minute or so and the browser reconnects on its
+  // own, so only give up after several errors in a row
+  source.onerror = function() {
+    failures += 1;
+    if (failures > 3) {
+      source.close();
+      getResult(checkResponseStatus);
+    }
+  };
+};
+
 // Poll the check_status view for progress on the load_infile task.
 // Once the task is complete, render a sample of the data uploaded and, if
 // necessary, any warnings that were returned. If the task fails, render an
@@ -62,6 +97,12 @@ function checkResponseStatus(res) {
         </div>
       `)
       $('#progress-message').html('Finished')
+      if (res.result.mode) {
+        $('#message .alert p:first').html(`
+          <span class="glyphicon glyphicon-ok-circle"></span>
+          Table <strong>${res.result.table}</strong> was updated:
+          ${res.result.inserted} new rows, ${res.result.updated} changed rows.`)
+      }
       generateTable(res.result);
 
       // Append warnings
@@ -133,4 +174,4 @@ function generateTable(res) {
   $('#details').html(markup)
 }
 
-getResult(checkResponseStatus);
+watchProgress();
@@ -7,10 +7,90 @@ function getCSV() {
   window.location.href='/search/get-all-results/';
 };
 
+// Export the full results to S3 in the background and poll for progress.
+// When the export is done, download the file from its presigned URL. If the
+// export can't be started, stream the CSV straight from Django instead
+function exportCSV() {
+  $.ajax({
+    type: 'POST',
+    url: '/search/export/',
+    data: {csrfmiddlewaretoken: $('input[name=csrfmiddlewaretoken]').val()},
+    success: function(res) {
+      $('#export-progress').show();
+      checkExport(res.task_id);
+    },
+    error: getCSV
+  });
+};
+
+function checkExport(taskId) {
+  $.ajax({
+    type: 'GET',
+    url: '/search/export-status/',
+    data: {task_id: taskId},
+    success: function(res) {
+      if (res.status === 'PROGRESS') {
+        $('#export-progress-bar').css('width', (100 * res.result.current / res.result.total) + '%');
+        $('#export-message').html(res.result.message);
+      }
+      else if (res.status === 'SUCCESS' && !res.result.error) {
+        $('#export-progress-bar').css('width', '100%').removeClass('active');
+        $('#export-message').html(`Finished. <a href="${res.result.url}">Download the CSV</a> if it didn't start automatically.`);
+        $downloadButton.button('reset');
+        window.location.href = res.result.url;
+        return;
+      }
+      else if (res.status === 'SUCCESS' || res.status === 'FAILURE') {
+        var message = res.result.error ? res.result.error.errorMessage : res.result;
+        $('#export-progress-bar').removeClass('active').addClass('progress-bar-danger');
+        $('#export-message').html('The export failed: ' + message);
+        $downloadButton.button('reset');
+        return;
+      }
+
+      // Poll the server every half second until the export is done
+      setTimeout(function() { checkExport(taskId); }, 500);
+    },
+    error: function(res) {
+      console.log('request failed')
+    }
+  });
+};
+
+// The exact number of matches is counted in the background. Poll for it
+// every second, for up to a minute
+function getCount(tries) {
+  var $count = $('#match-count');
+  $.ajax({
+    type: 'GET',
+    url: '/search/count/',
+    data: {
+      query: $count.data('query'),
+      table: $count.data('table'),
+      search_columns: $count.data('search-columns')
+    },
+    success: function(res) {
+      if (res.count !== null) {
+        $count.html(res.count.toLocaleString());
+      }
+      else if (tries < 60) {
+        setTimeout(function() { getCount(tries + 1); }, 1000);
+      }
+      else {
+        $count.html('many');
+      }
+    }
+  });
+};
+
 function main() {
+  if ($('#match-count').data('pending')) {
+    getCount(0);
+  }
+
   $downloadButton.on('click', function() {
     $(this).button('loading');
-    getCSV();
+    exportCSV();
   })
   $('#toggle-filters').on('click', function() {
     $('#search-filters').toggle();
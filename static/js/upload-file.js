@@ -12,6 +12,7 @@ function showCategorize(data) {
     return `<option value="${cat[0]}">${cat[1]}</option>`;
   })
   var headers = data.headers.map(function(header) {
+    var proposed = header.proposed_type ? ` (${header.proposed_type})` : '';
     return (`
       <tr>
         <td><strong>${header.name}</strong></td>
@@ -21,6 +22,12 @@ function showCategorize(data) {
             ${options.join('\n')}
           </select>
         </td>
+        <td>
+          <select name="type:${header.name}">
+            <option value="auto" selected>Automatic${proposed}</option>
+            <option value="text">Text</option>
+          </select>
+        </td>
       </tr>`
     );
   });
@@ -46,6 +53,11 @@ function showModal(data) {
     $(this).on('click', function(e) {
       e.preventDefault();
       e.stopPropagation();
+      // Updates of an existing table go straight to the progress page
+      if ($('#metadata-form').attr('action')) {
+        $('#metadata-form')[0].submit();
+        return;
+      }
       var data = new FormData($('#metadata-form')[0]);
       ajaxPost('/add-metadata/', data, showCategorize);
     })
@@ -61,15 +73,234 @@ function addUploadHandler(callback) {
     e.stopPropagation();
     // Get the data from the form and send it as an AJAX post request
     var data = new FormData($('#upload-form')[0]);
-    callback('/upload-file/', data, showModal);
+    var file = $('#id_data_file')[0].files[0];
 
     // Defined as a global so that we can enable/disable from within multiple
     // functions
     $btn = $(this).button('loading');
+
+    // Send the file straight to S3. If that fails (e.g. the bucket doesn't
+    // allow uploads from this origin), fall back to sending it through
+    // Django in resumable chunks
+    if (!file) {
+      return callback('/upload-file/', data, showModal);
+    }
+    var csrf = data.get('csrfmiddlewaretoken');
+    directUpload(file, csrf, showModal, function() {
+      chunkedUpload(file, csrf, showModal);
+    });
   });
   return;
 }
 
+var PARALLEL_PARTS = 4; // Number of parts to send to S3 at once
+var SIGN_BATCH = 20; // Number of part URLs to ask Django for at a time
+
+// Upload a file to S3 in parts, a few at a time. Django only signs a URL for
+// each part and stitches them together when they've all arrived
+function directUpload(file, csrf, callback, fallback) {
+  $.post('/start-direct-upload/', {
+    filename: file.name,
+    size: file.size,
+    csrfmiddlewaretoken: csrf
+  }).done(function(res) {
+    uploadParts(file, res, csrf, callback, fallback);
+  }).fail(function(res) {
+    addErrorMessages(JSON.parse(res.responseJSON));
+    $btn.button('reset');
+  });
+}
+
+var CHUNK_RETRIES = 3; // Number of times to resend a chunk before giving up
+
+// Send a file through Django one chunk at a time. The ID of the upload is
+// saved in localStorage, so if the connection drops the user can hit upload
+// again and only the chunks the server doesn't have yet are sent
+function chunkedUpload(file, csrf, callback) {
+  var storageKey = 'chunked-upload:' + [file.name, file.size, file.lastModified].join(':');
+  var uploadId = window.localStorage && localStorage.getItem(storageKey);
+
+  function start() {
+    $.post('/start-chunked-upload/', {
+      filename: file.name,
+      size: file.size,
+      csrfmiddlewaretoken: csrf
+    }).done(function(res) {
+      uploadId = res.id;
+      if (window.localStorage) localStorage.setItem(storageKey, uploadId);
+      sendChunks(res, []);
+    }).fail(showError);
+  }
+
+  function showError(res) {
+    addErrorMessages(JSON.parse(res.responseJSON));
+    $btn.button('reset');
+  }
+
+  function checksum(blob) {
+    // SubtleCrypto is only available on secure origins. Without it, S3's
+    // own MD5 check on the way from Django is all we get
+    if (!(window.crypto && crypto.subtle)) {
+      return $.Deferred().resolve('');
+    }
+    var d = $.Deferred();
+    var reader = new FileReader();
+    reader.onload = function() {
+      crypto.subtle.digest('SHA-256', reader.result).then(function(hash) {
+        d.resolve(Array.prototype.map.call(new Uint8Array(hash), function(b) {
+          return ('0' + b.toString(16)).slice(-2);
+        }).join(''));
+      }, function() { d.resolve(''); });
+    };
+    reader.readAsArrayBuffer(blob);
+    return d;
+  }
+
+  function sendChunks(upload, received) {
+    var remaining = [];
+    for (var n = 1; n <= upload.parts; n++) {
+      if (received.indexOf(n) === -1) remaining.push(n);
+    }
+    var total = upload.parts;
+
+    function next(attempt) {
+      if (remaining.length === 0) {
+        return complete();
+      }
+      var n = remaining[0];
+      var start = (n - 1) * upload.chunk_size;
+      var blob = file.slice(start, Math.min(start + upload.chunk_size, file.size));
+
+      checksum(blob).done(function(hash) {
+        var data = new FormData();
+        data.append('id', uploadId);
+        data.append('part', n);
+        data.append('sha256', hash);
+        data.append('chunk', blob);
+        data.append('csrfmiddlewaretoken', csrf);
+
+        $.ajax({
+          url: '/upload-chunk/',
+          type: 'POST',
+          data: data,
+          processData: false,
+          contentType: false
+        }).done(function() {
+          remaining.shift();
+          $btn.text('Uploading... ' + Math.floor(100 * (total - remaining.length) / total) + '%');
+          next(0);
+        }).fail(function(res) {
+          if (attempt + 1 < CHUNK_RETRIES) return next(attempt + 1);
+          showError(res);
+        });
+      });
+    }
+
+    next(0);
+  }
+
+  function complete() {
+    $.post('/complete-chunked-upload/', {
+      id: uploadId,
+      csrfmiddlewaretoken: csrf
+    }).done(function(res) {
+      if (window.localStorage) localStorage.removeItem(storageKey);
+      callback(res);
+    }).fail(showError);
+  }
+
+  // Resume an earlier attempt at uploading the same file if there was one
+  if (uploadId) {
+    $.get('/chunked-upload-status/', {id: uploadId}).done(function(res) {
+      sendChunks(res, res.received);
+    }).fail(start);
+  }
+  else {
+    start();
+  }
+}
+
+function uploadParts(file, upload, csrf, callback, fallback) {
+  var next = 1; // Next part to send
+  var urls = {};
+  var etags = [];
+  var active = 0;
+  var failed = false;
+  var signing = false;
+
+  function sign(first) {
+    var parts = [];
+    for (var n = first; n < first + SIGN_BATCH && n <= upload.parts; n++) {
+      parts.push(n);
+    }
+    return $.ajax({
+      url: '/sign-direct-upload/',
+      type: 'POST',
+      traditional: true,
+      data: {part: parts, csrfmiddlewaretoken: csrf}
+    }).done(function(res) {
+      $.extend(urls, res.urls);
+    });
+  }
+
+  function fail() {
+    if (failed) return;
+    failed = true;
+    $.post('/abort-direct-upload/', {csrfmiddlewaretoken: csrf});
+    fallback();
+  }
+
+  function send(n) {
+    active++;
+    var start = (n - 1) * upload.part_size;
+    var blob = file.slice(start, Math.min(start + upload.part_size, file.size));
+
+    $.ajax({
+      url: urls[n],
+      type: 'PUT',
+      data: blob,
+      processData: false,
+      contentType: false
+    }).done(function(res, status, xhr) {
+      active--;
+      etags.push({PartNumber: n, ETag: xhr.getResponseHeader('ETag')});
+      $btn.text('Uploading... ' + Math.floor(100 * etags.length / upload.parts) + '%');
+      pump();
+    }).fail(fail);
+  }
+
+  function pump() {
+    if (failed || signing) return;
+    if (etags.length === upload.parts) {
+      return complete();
+    }
+    while (active < PARALLEL_PARTS && next <= upload.parts) {
+      // Ask for the next batch of URLs once we've used up the last one
+      if (!urls[next]) {
+        signing = true;
+        sign(next).done(function() {
+          signing = false;
+          pump();
+        }).fail(fail);
+        return;
+      }
+      send(next++);
+    }
+  }
+
+  function complete() {
+    $.post('/complete-direct-upload/', {
+      parts: JSON.stringify(etags),
+      csrfmiddlewaretoken: csrf
+    }).done(callback).fail(function(res) {
+      addErrorMessages(JSON.parse(res.responseJSON));
+      $btn.button('reset');
+    });
+  }
+
+  pump();
+}
+
 
 function ajaxPost(url, data, callback) {
   $.ajax({
@@ -1,6 +1,20 @@
 from django.contrib import admin
 
-from .models import Table, Column
+from .models import Table, Column, LoadTiming
 
-admin.site.register(Table)
+
+class LoadTimingInline(admin.TabularInline):
+    model = LoadTiming
+    extra = 0
+    readonly_fields = ('stage', 'wall_seconds', 'cpu_seconds', 'max_rss_kb',
+                       'rss_growth_kb', 'bytes', 'rows')
+    exclude = ('position',)
+    can_delete = False
+
+
+class TableAdmin(admin.ModelAdmin):
+    inlines = [LoadTimingInline]
+
+
+admin.site.register(Table, TableAdmin)
 admin.site.register(Column)
@@ -0,0 +1,294 @@
+# Stdlib imports
+import io
+import csv
+import codecs
+import hashlib
+
+# Local imports
+from .inference import ColumnState, SAMPLE_STRIDE
+
+# Constants
+# The delimiters a file can be split on, in the order they're preferred when
+# sniffing can't tell them apart
+DELIMITERS = (
+    (',', 'comma'),
+    (';', 'semicolon'),
+    ('\t', 'tab'),
+    ('|', 'pipe')
+)
+QUOTECHAR = '"'
+# How much of the start of the file to read before guessing its dialect
+SNIFF_SIZE = 64 * 1024
+SAMPLE_ROWS = 5
+# The MySQL character sets to load each encoding as. MySQL's latin1 is
+# actually Windows-1252
+CHARSETS = {'utf-8': 'utf8', 'cp1252': 'latin1'}
+
+
+def _line_terminator(data):
+    """
+    Guess a file's line terminator from the first line break in it
+    """
+    n = data.find('\n')
+    r = data.find('\r')
+    if r == -1 or (n != -1 and n < r):
+        return '\n'
+    return '\r\n' if data[r + 1:r + 2] == '\n' else '\r'
+
+
+def _delimiter(data):
+    """
+    Guess a file's delimiter from its first few lines. If the sniffer can't
+    decide, pick the candidate that shows up most often in the header.
+    """
+    candidates = [d for d, name in DELIMITERS]
+    try:
+        return csv.Sniffer().sniff(data, delimiters=''.join(candidates)).delimiter
+    except csv.Error:
+        header = data.splitlines()[0] if data else ''
+        counts = [(header.count(d), -i) for i, d in enumerate(candidates)]
+        return candidates[-max(counts)[1]]
+
+
+class UploadAnalyzer(object):
+    """
+    This module reads a CSV once, as a stream of blocks, and collects
+    everything the rest of the upload needs to know about it: the dialect
+    (delimiter, line terminator and encoding), the headers, a few sample
+    rows, the number of rows, a hash of the contents and the state of every
+    column for type inference. Blocks can be fed to it as they're received,
+    so the file never has to be read again.
+
+    Records are only parsed once a line break outside a quoted field shows
+    they're complete, so a block can end anywhere, even in the middle of a
+    value with line breaks in it.
+
+    Example usage:
+        analyzer = UploadAnalyzer()
+        for block in blocks:
+            analyzer.feed(block)
+        summary = analyzer.finish()
+
+    Args:
+        sample_rows (int): The number of sample rows to keep
+        sample_size (int): If None, every row's values are inspected for
+            type inference. Otherwise, inspect the first sample_size rows and
+            then every sample_stride'th row. Every row is still counted.
+        sample_stride (int): How often to inspect rows past sample_size
+    """
+    def __init__(self, sample_rows=SAMPLE_ROWS, sample_size=None,
+                 sample_stride=SAMPLE_STRIDE):
+        self.sample_rows = sample_rows
+        self.sample_size = sample_size
+        self.sample_stride = sample_stride
+
+        self.delimiter = None
+        self.line_terminator = None
+        self.encoding = 'utf-8'
+        self.headers = None
+        self.sample = []
+        self.row_count = 0
+        self.sampled = False
+        self.size = 0
+        self.columns = []
+
+        self._hash = hashlib.sha256()
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._scanned = 0  # How much of the buffer has been checked for line breaks
+        self._quoted = False  # Whether the end of the scanned part is in quotes
+
+    @classmethod
+    def from_file(cls, path, complete=True, **kwargs):
+        """
+        Analyze a local file
+
+        Args:
+            path (string): The path to a local CSV
+            complete (bool): Whether the file is the whole CSV, or just the
+                start of it
+        """
+        analyzer = cls(**kwargs)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(SNIFF_SIZE), ''):
+                analyzer.feed(block)
+        return analyzer.finish(complete=complete)
+
+    def feed(self, data):
+        """
+        Analyze the next block of the file
+
+        Args:
+            data (string): The bytes that follow the ones already fed
+        """
+        self._hash.update(data)
+        self.size += len(data)
+        if self.encoding == 'utf-8':
+            try:
+                self._decoder.decode(data)
+            except UnicodeDecodeError:
+                self.encoding = 'cp1252'
+
+        self._buffer += data
+        # Wait for enough of the file to guess its dialect from
+        if self.delimiter is None:
+            if len(self._buffer) < SNIFF_SIZE:
+                return
+            self._sniff()
+
+        self._parse(self._complete_records())
+
+    def _sniff(self):
+        if self._buffer.startswith(codecs.BOM_UTF8):
+            self._buffer = self._buffer[len(codecs.BOM_UTF8):]
+
+        self.line_terminator = _line_terminator(self._buffer)
+        # Only sniff whole lines, so a cut-off line doesn't look like it has
+        # a different number of fields
+        end = self._buffer.rfind(self.line_terminator[-1])
+        sample = self._buffer[:end] if end > 0 else self._buffer
+        self.delimiter = _delimiter(sample)
+
+    def _complete_records(self):
+        """
+        Take every complete record off the front of the buffer. Each quote
+        flips whether we're in a quoted field, and escaped quotes ("") flip
+        it twice, so they cancel out.
+
+        Returns:
+            The records, as a string
+        """
+        newline = self.line_terminator[-1]
+        quoted = self._quoted
+        boundary = -1
+        position = self._scanned
+        parts = self._buffer[self._scanned:].split(QUOTECHAR)
+        for i, part in enumerate(parts):
+            if not quoted:
+                j = part.rfind(newline)
+                if j != -1:
+                    boundary = position + j + 1
+            position += len(part) + 1
+            if i < len(parts) - 1:
+                quoted = not quoted
+
+        if boundary == -1:
+            self._scanned = len(self._buffer)
+            self._quoted = quoted
+            return ''
+
+        # The quote state at the boundary is always "not quoted", so the
+        # rest of the buffer is scanned again from there next time
+        records = self._buffer[:boundary]
+        self._buffer = self._buffer[boundary:]
+        self._scanned = 0
+        self._quoted = False
+        return records
+
+    def _parse(self, records):
+        if not records:
+            return
+
+        # Files only break lines on \n, so a stray \r in a value stays put,
+        # unless \r is the line terminator
+        if self.line_terminator == '\r':
+            lines = records.splitlines(True)
+        else:
+            lines = io.BytesIO(records)
+        reader = csv.reader(lines, delimiter=self.delimiter, quotechar=QUOTECHAR)
+        if self.headers is None:
+            self.headers = next(reader, None)
+            if self.headers is None:
+                return
+            self.columns = [ColumnState(name) for name in self.headers]
+
+        n = len(self.columns)
+        for row in reader:
+            i = self.row_count
+            self.row_count += 1
+            if len(self.sample) < self.sample_rows:
+                self.sample.append(row)
+
+            if self.sample_size is not None and i >= self.sample_size:
+                self.sampled = True
+                if (i - self.sample_size) % self.sample_stride:
+                    continue
+
+            # Pad short rows with nulls and ignore any extra fields, the same
+            # way LOAD DATA INFILE does
+            if len(row) < n:
+                row = row + [''] * (n - len(row))
+
+            for column, value in zip(self.columns, row):
+                column.update(value)
+
+    def finish(self, complete=True):
+        """
+        Analyze whatever is left of the file
+
+        Args:
+            complete (bool): Whether everything fed was the whole file. If
+                it was only the start of it, the last record, which may have
+                been cut off, is left out, and so are the counts and hash,
+                which would only describe part of the file.
+
+        Returns:
+            A dict with the delimiter, line terminator, encoding (and the
+            MySQL character set to load it as), the raw headers and sample
+            rows, whether the file was complete, and the MySQL type, date
+            format and profile of each column. The types of an incomplete
+            file are only a proposal to show the user. For complete files it
+            also has the number of rows and the size and SHA-256 hash of the
+            file.
+        """
+        if self.delimiter is None:
+            self._sniff()
+
+        if complete:
+            self._parse(self._complete_records())
+            # The last record may not end in a line break
+            if self._buffer:
+                self._parse(self._buffer + self.line_terminator)
+                self._buffer = ''
+            try:
+                self._decoder.decode('', True)
+            except UnicodeDecodeError:
+                self.encoding = 'cp1252'
+        else:
+            self._parse(self._complete_records())
+
+        # The summary is kept in the session and passed to tasks as JSON, so
+        # decode everything read from the file
+        def decode(value):
+            if isinstance(value, str):
+                return value.decode(self.encoding, 'replace')
+            return value
+
+        summary = {
+            'delimiter': self.delimiter,
+            'quotechar': QUOTECHAR,
+            'line_terminator': self.line_terminator,
+            'encoding': self.encoding,
+            'charset': CHARSETS[self.encoding],
+            'headers': [decode(h) for h in self.headers or []],
+            'sample': [[decode(v) for v in row] for row in self.sample],
+            'complete': complete,
+            'sampled': False,
+            'row_count': None,
+            'size': None,
+            'sha256': None,
+            'columns': [{'name': decode(c.name),
+                         'sql_type': c.sql_type(sampled=self.sampled),
+                         'format': c.date_format,
+                         'profile': dict((k, decode(v)) for k, v in c.profile().items())}
+                        for c in self.columns]
+        }
+        if complete:
+            summary.update({
+                'row_count': self.row_count,
+                'size': self.size,
+                'sha256': self._hash.hexdigest(),
+                'sampled': self.sampled
+            })
+
+        return summary
@@ -0,0 +1,372 @@
+"""
+Micro-benchmarks for the ingest pipeline, run against seeded synthetic CSVs
+so that results can be compared from one commit to the next. MySQL and S3
+are replaced by local stand-ins, so what's timed is our own code: header
+cleaning, sampling, the single-pass upload analysis, type inference, query
+generation, splitting, and the load_infile task around them.
+
+Example usage:
+    $ ./manage.py benchmark_ingest --rows 1000000 --output results.json
+"""
+# Stdlib imports
+from __future__ import absolute_import
+import os
+import csv
+import json
+import time
+import random
+import shutil
+import platform
+import datetime
+import tempfile
+import traceback
+from contextlib import contextmanager
+
+# Django imports
+from django.conf import settings
+from django.test.utils import override_settings
+
+# Third party imports
+from mock import patch, MagicMock
+
+# Local imports
+from .utils import TableFormatter
+from .analyzer import UploadAnalyzer
+from . import tasks
+
+TYPES = ('int', 'float', 'text', 'date', 'bool', 'name')
+# Column counts and row counts for the preset shapes
+SHAPES = {
+    'long': {'columns': 8, 'rows': 200000},
+    'wide': {'columns': 400, 'rows': 5000}
+}
+FIRST_NAMES = ('James', 'Mary', 'Jose', 'Linda', 'Wei', 'Fatima', 'Ngozi', 'Olga')
+LAST_NAMES = ('Smith', "O'Brien", 'Nguyen', 'Garcia', 'Cox', 'Kemp', 'Lee', 'Patel')
+WORDS = ('contract', 'county', 'fund', 'vendor', 'payment', 'district', 'grant')
+
+
+class SyntheticCSV(object):
+    """
+    This module writes a CSV of random but reproducible data: the same
+    arguments always produce the same file.
+
+    Example usage:
+        SyntheticCSV(rows=1000, columns=20, seed=1).write('/tmp/x.csv')
+
+    Args:
+        rows (int): The number of rows, not counting the header
+        columns (int): The number of columns
+        types (string[]): The types to cycle through for the columns, from
+            TYPES
+        quote_rate (float): The share of text values that have to be quoted,
+            because they contain commas, quotes or line breaks
+        null_rate (float): The share of values left empty
+        seed (int): The seed for the random number generator
+    """
+    def __init__(self, rows, columns, types=TYPES, quote_rate=0.05,
+                 null_rate=0.02, seed=0):
+        self.rows = rows
+        self.columns = columns
+        self.types = [types[i % len(types)] for i in range(columns)]
+        self.quote_rate = quote_rate
+        self.null_rate = null_rate
+        self.seed = seed
+
+    def headers(self):
+        return ['{} {}'.format(t.title(), i) for i, t in enumerate(self.types)]
+
+    def _value(self, rng, data_type):
+        if rng.random() < self.null_rate:
+            return ''
+        if data_type == 'int':
+            return str(rng.randint(-100000, 10000000))
+        if data_type == 'float':
+            return '{:.2f}'.format(rng.uniform(-1000, 1000000))
+        if data_type == 'date':
+            day = datetime.date(1990, 1, 1) + datetime.timedelta(rng.randint(0, 12000))
+            return day.strftime('%m/%d/%Y')
+        if data_type == 'bool':
+            return rng.choice(('true', 'false'))
+        if data_type == 'name':
+            return '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+
+        value = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 6)))
+        if rng.random() < self.quote_rate:
+            value = rng.choice(('{}, {}', '{} "{}"', '{}\n{}')).format(value, rng.choice(WORDS))
+        return value
+
+    def write(self, path):
+        """
+        Returns:
+            The size of the file in bytes
+        """
+        rng = random.Random(self.seed)
+        with open(path, 'wb') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(self.headers())
+            for _ in xrange(self.rows):
+                writer.writerow([self._value(rng, t) for t in self.types])
+        return os.path.getsize(path)
+
+
+class StandInResult(object):
+    def __init__(self, rowcount=0):
+        self.rowcount = rowcount
+
+    def fetchall(self):
+        return []
+
+    def scalar(self):
+        return 1
+
+
+class StandInConnection(object):
+    """
+    Takes the place of a MySQL connection. Queries are recorded, and LOAD
+    DATA statements read the file they name and count its lines, so the disk
+    reads are still timed.
+    """
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, query, *args):
+        self.queries.append(query)
+        if 'LOAD DATA' not in query:
+            return StandInResult()
+
+        path = query.split('"')[1]
+        lines = 0
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), ''):
+                lines += block.count('\n')
+        return StandInResult(lines)
+
+    def close(self):
+        pass
+
+
+class StandInEngine(object):
+    def connect(self):
+        return StandInConnection()
+
+
+@contextmanager
+def stand_ins(csv_path):
+    """
+    Replace MySQL, S3 and the Django DB in the load_infile task with local
+    stand-ins. The "download" copies the synthetic CSV into the workspace.
+    """
+    def download(tracker, s3_path, workspace, analyzer=None):
+        local_path = workspace.path('data.csv')
+        with open(csv_path, 'rb') as src, open(local_path, 'wb') as dest:
+            for block in iter(lambda: src.read(1024 * 1024), ''):
+                dest.write(block)
+                if analyzer:
+                    analyzer.feed(block)
+        return local_path
+
+    engine = StandInEngine()
+    s3 = MagicMock()
+    s3.return_value.copy_final.return_value = 'benchmark/original/benchmark.csv'
+    table = MagicMock(id=0)
+
+    with patch.object(tasks.warehouse, 'get_engine', return_value=engine), \
+            patch.object(tasks, '_download', side_effect=download), \
+            patch.object(tasks, 'S3Manager', s3), \
+            patch.object(tasks, 'publish_progress'), \
+            patch.object(tasks, 'register_table', return_value=(table, True)), \
+            patch.object(tasks.load_infile, 'update_state'):
+        yield engine
+
+
+class NullTracker(object):
+    def __init__(self):
+        self.timer = tasks.StageTimer()
+
+    def forward(self, message):
+        pass
+
+    def advance(self, done, size=None, detail=None):
+        pass
+
+    def add_stages(self, n):
+        pass
+
+
+def _loader(path, headers):
+    with patch.object(tasks.warehouse, 'get_engine', return_value=StandInEngine()):
+        return tasks.Loader(NullTracker(), 'benchmark', headers, path)
+
+
+def _headers(path):
+    headers, sample = TableFormatter(path).get_column_data()
+    return [{'name': h['name'], 'category': None} for h in headers]
+
+
+def bench_clean_headers(path, generator, repeat=200):
+    names = generator.headers()
+    formatter = TableFormatter(path)
+    for _ in range(repeat):
+        formatter._clean(names)
+    return {'headers': len(names) * repeat}
+
+
+def bench_column_data(path, generator, repeat=200):
+    for _ in range(repeat):
+        TableFormatter(path).get_column_data()
+    return {'files': repeat}
+
+
+def bench_analyze(path, generator):
+    UploadAnalyzer.from_file(path)
+    return {'rows': generator.rows, 'bytes': os.path.getsize(path)}
+
+
+def bench_infer_types(path, generator):
+    loader = _loader(path, _headers(path))
+    loader._get_column_types()
+    return {'rows': generator.rows, 'bytes': os.path.getsize(path)}
+
+
+def bench_query_generation(path, generator, repeat=1000):
+    loader = _loader(path, _headers(path))
+    loader._get_column_types()
+    start = time.time()
+    for _ in range(repeat):
+        ', '.join('{name} {raw_type}'.format(**x) for x in loader.columns)
+        loader._make_load_table_q()
+    # Only time the queries, not the inference they need first
+    return {'queries': repeat, 'seconds': time.time() - start}
+
+
+def bench_load_infile(path, generator):
+    with stand_ins(path):
+        result = tasks.load_infile.apply(kwargs={
+            's3_path': 'tmp/benchmark/data.csv',
+            'table_name': 'benchmark',
+            'headers': _headers(path),
+            'user_id': 0
+        }).get()
+    if result['error']:
+        raise RuntimeError(result['error'])
+    return {'rows': generator.rows, 'bytes': os.path.getsize(path)}
+
+
+def bench_load_infile_parallel(path, generator):
+    # Split the file into four chunks and load them side by side, however
+    # big it is
+    chunk_size = max(os.path.getsize(path) // 4, 1)
+    with override_settings(LOAD_PARALLEL_THRESHOLD=0, LOAD_CHUNK_SIZE=chunk_size):
+        return bench_load_infile(path, generator)
+
+
+BENCHMARKS = [
+    ('clean_headers', bench_clean_headers),
+    ('column_data', bench_column_data),
+    ('analyze', bench_analyze),
+    ('infer_types', bench_infer_types),
+    ('query_generation', bench_query_generation),
+    ('load_infile', bench_load_infile),
+    ('load_infile_parallel', bench_load_infile_parallel),
+]
+
+
+def _run_in_child(function, path, generator):
+    """
+    Run one benchmark in a forked process, so that its peak memory is its
+    own and not the high-water mark of everything that ran before it
+
+    Returns:
+        A dict with the benchmark's counts, its time in seconds, and its
+        peak resident set size in kilobytes
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            start = time.time()
+            result = function(path, generator)
+            result.setdefault('seconds', time.time() - start)
+        except Exception:
+            result = {'error': traceback.format_exc()}
+        with os.fdopen(write_fd, 'w') as f:
+            f.write(json.dumps(result))
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = json.loads(f.read() or '{"error": "The benchmark process died"}')
+    _, status, usage = os.wait4(pid, 0)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 if platform.system() == 'Darwin' else 1
+    result['peak_rss_kb'] = usage.ru_maxrss // scale
+    return result
+
+
+def run(rows, columns, types=TYPES, quote_rate=0.05, seed=0, repeat=1,
+        only=None, workdir=None):
+    """
+    Generate a synthetic CSV and run each benchmark against it
+
+    Args:
+        rows, columns, types, quote_rate, seed: See SyntheticCSV
+        repeat (int): How many times to run each benchmark. The fastest run
+            is reported, along with every run's time
+        only (string[]): The names of the benchmarks to run. Defaults to all
+        workdir (string): Where to write the CSV. Defaults to a temp
+            directory, which is deleted afterwards
+
+    Returns:
+        A dict with the parameters, the environment and a result for each
+        benchmark, ready to be dumped as JSON
+    """
+    temporary = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='benchmark-')
+    generator = SyntheticCSV(rows, columns, types=types, quote_rate=quote_rate,
+                             seed=seed)
+    path = os.path.join(workdir, 'synthetic.csv')
+    try:
+        start = time.time()
+        size = generator.write(path)
+        report = {
+            'params': {'rows': rows, 'columns': columns, 'types': list(types),
+                       'quote_rate': quote_rate, 'seed': seed, 'repeat': repeat,
+                       'bytes': size},
+            'environment': {'python': platform.python_version(),
+                            'machine': platform.machine(),
+                            'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+                            'load_parallel_threshold': settings.LOAD_PARALLEL_THRESHOLD},
+            'generate_seconds': time.time() - start,
+            'results': []
+        }
+
+        for name, function in BENCHMARKS:
+            if only and name not in only:
+                continue
+            # Keep workspaces out of the real upload directory
+            with override_settings(UPLOAD_WORKSPACE_ROOT=os.path.join(workdir, 'workspaces')):
+                runs = [_run_in_child(function, path, generator) for _ in range(repeat)]
+
+            errors = [r['error'] for r in runs if 'error' in r]
+            if errors:
+                report['results'].append({'name': name, 'error': errors[0]})
+                continue
+
+            best = min(runs, key=lambda r: r['seconds'])
+            result = dict(best, name=name,
+                          runs=[r['seconds'] for r in runs],
+                          peak_rss_kb=max(r['peak_rss_kb'] for r in runs))
+            seconds = max(best['seconds'], 1e-9)
+            if 'rows' in best:
+                result['rows_per_second'] = best['rows'] / seconds
+            if 'bytes' in best:
+                result['mb_per_second'] = best['bytes'] / seconds / (1024 * 1024)
+            report['results'].append(result)
+
+        return report
+    finally:
+        if temporary:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            os.remove(path)
@@ -3,11 +3,11 @@ import re
 
 # Third party imports
 from django import forms
-from django.conf import settings
-import sqlalchemy
 
 # Local imports
-from .models import Contact
+from .models import Contact, TableUpdate
+from .utils import file_extension
+from data_import_tool import warehouse
 
 REPORTERS = (
     ('Jonathan Cox', 'Jonathan Cox'),
@@ -16,11 +16,6 @@ REPORTERS = (
     ('Saurabh Datar', 'Saurabh Datar')
 )
 
-DELIMITERS = (
-    (',', 'comma'),
-    (';', 'semicolon')
-)
-
 # 10MB = 10485760
 MAX_UPLOAD_SIZE = 10485760 * 2
 
@@ -32,24 +27,53 @@ class FileForm(forms.Form):
         super(FileForm, self).__init__(*args, **kwargs)
 
         # Set Bootstrap classes on form inputs
-        self.fields['data_file'].widget.attrs.update({'class': 'form-control'})
+        self.fields['data_file'].widget.attrs.update({'class': 'form-control',
+                                                      'accept': '.csv,.gz,.zip'})
 
-    # Ensure that the file isn't >20MB.
+    # Ensure that the file isn't >20MB, and is a CSV, compressed or not
     def clean_data_file(self):
         data = self.cleaned_data['data_file']
         if data._size > MAX_UPLOAD_SIZE:
             raise forms.ValidationError(
                 'Sorry, we can\'t handle files bigger than 10MB.'
             )
-        if not data.name.endswith('.csv'):
+        if not file_extension(data.name):
             raise forms.ValidationError(
-                'Please select a .csv file'
+                'Please select a .csv, .csv.gz or .zip file'
             )
         return data
 
     data_file = forms.FileField(label='File')
 
 
+class DirectUploadForm(forms.Form):
+    """
+    Handles validation of a file that the browser will upload straight to S3.
+    Django never sees the bytes, so there's no MAX_UPLOAD_SIZE here, only
+    S3's own limit on the size of an object.
+    """
+    MAX_SIZE = 5 * 1024 ** 4  # 5TB
+
+    filename = forms.CharField(max_length=300)
+    size = forms.IntegerField(min_value=1)
+
+    def clean_filename(self):
+        data = self.cleaned_data['filename']
+        if not file_extension(data):
+            raise forms.ValidationError(
+                'Please select a .csv, .csv.gz or .zip file'
+            )
+        return data
+
+    def clean_size(self):
+        data = self.cleaned_data['size']
+        if data > self.MAX_SIZE:
+            raise forms.ValidationError(
+                'Sorry, we can\'t handle files bigger than 5TB.'
+            )
+        return data
+
+
 class MetadataForm(forms.Form):
     """
     Handles validation of metadata about a table
@@ -76,16 +100,17 @@ class MetadataForm(forms.Form):
     def clean_table_name(self):
         input_name = self.cleaned_data['table_name']
 
-        engine = sqlalchemy.create_engine(settings.DATA_WAREHOUSE_URL)
-        connection = engine.connect()
-        names = [n[0] for n in connection.execute('SHOW TABLES IN imports;')]
+        connection = warehouse.connect()
+        try:
+            names = [n[0] for n in connection.execute('SHOW TABLES IN imports;')]
+        finally:
+            connection.close()
+
         if input_name in names:
             raise forms.ValidationError(
                 'A table with that name already exists in the database.'
             )
 
-        connection.close()
-
         data = self._sanitize(self.cleaned_data['table_name'])
         return data
 
@@ -109,3 +134,30 @@ class MetadataForm(forms.Form):
     press_contact_type = forms.ChoiceField(label='Type',
                                            choices=Contact.CONTACT_TYPE_CHOICES,
                                            required=True)
+
+
+class UpdateForm(forms.Form):
+    """
+    Handles validation of the options for loading a new version of a file
+    into an existing table
+
+    Args:
+        columns (string[]): The columns of the table being updated
+    """
+    def __init__(self, columns, *args, **kwargs):
+        super(UpdateForm, self).__init__(*args, **kwargs)
+        self.fields['key_columns'].choices = [(c, c) for c in columns]
+        self.fields['mode'].widget.attrs.update({'class': 'form-control'})
+
+    def clean(self):
+        cleaned_data = super(UpdateForm, self).clean()
+        if cleaned_data.get('mode') == 'upsert' and not cleaned_data.get('key_columns'):
+            raise forms.ValidationError(
+                'Choose the columns that identify a row to update rows on a key.'
+            )
+        return cleaned_data
+
+    mode = forms.ChoiceField(label='How to update', choices=TableUpdate.MODE_CHOICES,
+                             required=True)
+    key_columns = forms.MultipleChoiceField(label='Key columns', required=False,
+                                            widget=forms.CheckboxSelectMultiple)
@@ -0,0 +1,543 @@
+# Stdlib imports
+import csv
+import hashlib
+import math
+import re
+import struct
+import sys
+
+# Some of the files we get have enormous free-text fields, so raise the csv
+# module's default 128KB limit on the size of a single field
+csv.field_size_limit(sys.maxsize)
+
+# Constants
+# Same null tokens csvkit recognized, plus MySQL's own \N (lowercased)
+NULL_VALUES = ('', 'na', 'n/a', 'none', 'null', '.', '\\n')
+TRUE_VALUES = ('true', 't', 'yes', 'y')
+FALSE_VALUES = ('false', 'f', 'no', 'n')
+BOOL_VALUES = TRUE_VALUES + FALSE_VALUES
+
+# Integers with leading zeros (ZIP codes, FIPS codes, precinct IDs) are
+# treated as text so that we don't strip the zeros when we load them
+INT_RE = re.compile(r'^[-+]?(0|[1-9]\d*)$')
+FLOAT_RE = re.compile(r'^[-+]?(\d*)\.?(\d*)([eE][-+]?\d+)?$')
+
+# The date formats we recognize, in order of preference, each with the
+# format MySQL's STR_TO_DATE needs to read it. ISO dates are loaded as they
+# are. Slashed dates are read month first
+DATE_FORMATS = (
+    (re.compile(r'^(?P<y>\d{4})-(?P<m>\d{2})-(?P<d>\d{2})$'), None),
+    (re.compile(r'^(?P<m>\d{1,2})/(?P<d>\d{1,2})/(?P<y>\d{4})$'), '%m/%d/%Y')
+)
+DATETIME_FORMATS = (
+    (re.compile(r'^(?P<y>\d{4})-(?P<m>\d{2})-(?P<d>\d{2})'
+                r'([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$'), None),
+    (re.compile(r'^(?P<m>\d{1,2})/(?P<d>\d{1,2})/(?P<y>\d{4}) \d{1,2}:\d{2}:\d{2}$'),
+     '%m/%d/%Y %H:%i:%s'),
+    (re.compile(r'^(?P<m>\d{1,2})/(?P<d>\d{1,2})/(?P<y>\d{4}) \d{1,2}:\d{2}$'),
+     '%m/%d/%Y %H:%i'),
+    (re.compile(r'^(?P<m>\d{1,2})/(?P<d>\d{1,2})/(?P<y>\d{4}) \d{1,2}:\d{2}:\d{2} ?[AaPp][Mm]$'),
+     '%m/%d/%Y %h:%i:%s %p'),
+    (re.compile(r'^(?P<m>\d{1,2})/(?P<d>\d{1,2})/(?P<y>\d{4}) \d{1,2}:\d{2} ?[AaPp][Mm]$'),
+     '%m/%d/%Y %h:%i %p')
+)
+
+# The smallest integer type that holds every value is picked
+INT_TYPES = (
+    ('TINYINT', -128, 127),
+    ('SMALLINT', -32768, 32767),
+    ('MEDIUMINT', -8388608, 8388607),
+    ('INT', -2147483648, 2147483647)
+)
+MAX_BIGINT_DIGITS = 18
+# The digits each integer type can hold, for widening a column. INTEGER is
+# what older tables were created with
+INT_DIGITS = {'TINYINT': 3, 'SMALLINT': 5, 'MEDIUMINT': 7, 'INT': 10,
+              'INTEGER': 10, 'BIGINT': 19}
+# The most digits, and digits after the point, a DECIMAL can have
+MAX_PRECISION = 65
+MAX_SCALE = 30
+MAX_VARCHAR = 21844  # 65,535 bytes / 3 bytes per utf8 character
+MAX_TEXT = 65535
+
+# In sampling mode every row up to SAMPLE_SIZE is inspected, then one row in
+# every SAMPLE_STRIDE after that
+SAMPLE_STRIDE = 10
+
+# HyperLogLog uses 2 ** HLL_PRECISION one-byte registers per column. 4KB
+# gives distinct counts within about 2% of the truth
+HLL_PRECISION = 12
+
+# How often to report progress, in rows
+PROGRESS_ROWS = 10000
+
+# Profiles are stored in the Django DB, so keep long min/max values short
+MAX_PROFILE_LENGTH = 300
+
+# Candidate types in order of preference. A column is cast as the first type
+# that every value in it could be parsed as, or as text if there isn't one
+TYPES = ('bool', 'int', 'float', 'date', 'datetime')
+
+
+class HyperLogLog(object):
+    """
+    Estimates how many distinct values a column has in a fixed amount of
+    memory, however many rows there are. See Flajolet et al., "HyperLogLog:
+    the analysis of a near-optimal cardinality estimation algorithm" (2007).
+
+    Args:
+        p (int): The precision. The estimate uses 2 ** p registers
+    """
+    __slots__ = ('p', 'm', 'registers')
+
+    def __init__(self, p=HLL_PRECISION):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        # The first p bits of the hash pick a register, and the register keeps
+        # the longest run of leading zeros seen in the rest
+        x = struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+        j = x & (self.m - 1)
+        w = x >> self.p
+        rank = 64 - self.p - w.bit_length() + 1
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+
+        # Small cardinalities are more accurately estimated from the number
+        # of registers that are still empty
+        if estimate <= 2.5 * self.m:
+            zeros = self.registers.count(b'\x00')
+            if zeros:
+                estimate = self.m * math.log(float(self.m) / zeros)
+
+        return int(round(estimate))
+
+
+def text_type(max_length, sampled=False):
+    """
+    Generate a MySQL type for text values
+
+    Args:
+        max_length (int): The length of the longest value
+        sampled (bool): Whether only a sample of the values was seen. If so,
+        leave headroom for longer values
+
+    Returns:
+        A string such as "VARCHAR(20)" or "TEXT"
+    """
+    length = max(max_length, 1)
+    if sampled:
+        # Round up to the next power of two
+        length = 1 << (length - 1).bit_length()
+
+    if length > MAX_TEXT:
+        return 'LONGTEXT'
+    if length > MAX_VARCHAR:
+        return 'TEXT'
+    return 'VARCHAR({})'.format(length)
+
+
+def _parse_type(sql_type):
+    """
+    Split a MySQL type like "DECIMAL(7,2)" into its name and its sizes
+    """
+    m = re.match(r'(\w+)(?:\(([\d,]+)\))?', sql_type)
+    sizes = [int(x) for x in m.group(2).split(',')] if m.group(2) else []
+    return (m.group(1).upper(), sizes)
+
+
+def _digits(name, sizes):
+    """
+    The whole and fractional digits a numeric type can hold
+    """
+    if name in INT_DIGITS:
+        return (INT_DIGITS[name], 0)
+    precision, scale = (sizes + [10, 0])[:2]
+    return (precision - scale, scale)
+
+
+def _text_length(name, sizes):
+    """
+    The longest value a type can hold, as text
+    """
+    if name in ('VARCHAR', 'CHAR'):
+        return sizes[0] if sizes else 1
+    if name == 'TEXT':
+        return MAX_TEXT
+    if name == 'LONGTEXT':
+        return MAX_TEXT + 1
+    if name in INT_DIGITS:
+        return INT_DIGITS[name] + 1  # The sign
+    if name == 'DECIMAL':
+        return sum(_digits(name, sizes)) + 2  # The sign and the point
+    if name == 'DATE':
+        return 10
+    if name == 'DATETIME':
+        return 26
+    if name == 'BOOLEAN':
+        return 1
+    return 24  # DOUBLE, FLOAT
+
+
+def widen_type(current, proposed, max_length=0):
+    """
+    Pick a MySQL type that holds both the values already in a column and the
+    values of a new version of it. Numbers are widened to a bigger integer,
+    a DECIMAL with more digits, or a DOUBLE, dates to DATETIME, and columns
+    whose values no longer agree on a type become text.
+
+    Args:
+        current (string): The column's type, e.g. "SMALLINT"
+        proposed (string): The type the new values were inferred as
+        max_length (int): The length of the longest new value
+
+    Returns:
+        current, if it's already wide enough, or the type to change it to
+    """
+    name, sizes = _parse_type(current)
+    new_name, new_sizes = _parse_type(proposed)
+    if (name, sizes) == (new_name, new_sizes):
+        return current
+
+    numeric = set(INT_DIGITS) | set(['DECIMAL'])
+    if name in numeric and new_name in numeric:
+        if name in INT_DIGITS and new_name in INT_DIGITS:
+            return current if INT_DIGITS[name] >= INT_DIGITS[new_name] else proposed
+
+        whole, scale = [max(a, b) for a, b in zip(_digits(name, sizes),
+                                                  _digits(new_name, new_sizes))]
+        if whole + scale > MAX_PRECISION or scale > MAX_SCALE:
+            return 'DOUBLE'
+        widened = 'DECIMAL({},{})'.format(whole + scale, scale)
+        return current if _parse_type(widened) == (name, sizes) else widened
+
+    reals = set(['DOUBLE', 'FLOAT'])
+    if name in reals | numeric and new_name in reals | numeric:
+        return current if name == 'DOUBLE' else 'DOUBLE'
+
+    if set([name, new_name]) == set(['DATE', 'DATETIME']):
+        return 'DATETIME'
+
+    length = max(_text_length(name, sizes), _text_length(new_name, new_sizes),
+                 max_length)
+    if name in ('VARCHAR', 'CHAR', 'TEXT', 'LONGTEXT') and length <= _text_length(name, sizes):
+        return current
+    return text_type(length)
+
+
+def _check_formats(formats, value):
+    """
+    Narrow a list of date formats down to the ones a value is in
+
+    Returns:
+        The formats that match, with a real month and day
+    """
+    matching = []
+    for pattern, mysql_format in formats:
+        m = pattern.match(value)
+        if m and 1 <= int(m.group('m')) <= 12 and 1 <= int(m.group('d')) <= 31:
+            matching.append((pattern, mysql_format))
+    return matching
+
+
+class ColumnState(object):
+    """
+    Keeps the running state needed to pick a SQL type for a single column:
+    the types that are still possible, the longest value, how many values
+    were null, the range and precision of numeric values, and the formats
+    dates could be in. It also keeps a profile of the column: the smallest
+    and largest values and an estimate of how many are distinct. It never
+    holds on to the values themselves, so its size doesn't depend on the
+    size of the file.
+
+    Args:
+        name (string): The name of the column
+    """
+    __slots__ = ('name', 'candidates', 'max_length', 'null_count', 'count',
+                 'min_int', 'max_int', 'int_digits', 'scale', 'min_number',
+                 'max_number', 'min_text', 'max_text', 'distinct',
+                 'date_formats', 'datetime_formats')
+
+    def __init__(self, name):
+        self.name = name
+        self.candidates = list(TYPES)
+        self.max_length = 0
+        self.null_count = 0
+        self.count = 0
+        self.min_int = None
+        self.max_int = None
+        self.int_digits = 0
+        self.scale = 0
+        self.min_number = None
+        self.max_number = None
+        self.min_text = None
+        self.max_text = None
+        self.distinct = HyperLogLog()
+        self.date_formats = list(DATE_FORMATS)
+        self.datetime_formats = list(DATETIME_FORMATS)
+
+    @property
+    def nullable(self):
+        return self.null_count > 0
+
+    def update(self, value):
+        """
+        Narrow the candidate types for the column using a single value
+
+        Args:
+            value (string): A raw value from the CSV
+        """
+        self.count += 1
+        if not value or (len(value) < 5 and value.lower() in NULL_VALUES):
+            self.null_count += 1
+            return
+
+        length = len(value)
+        if length > self.max_length:
+            self.max_length = length
+
+        self.distinct.add(value)
+        if self.min_text is None or value < self.min_text:
+            self.min_text = value
+        if self.max_text is None or value > self.max_text:
+            self.max_text = value
+
+        # Once a column is text there is nothing left to check
+        if not self.candidates:
+            return
+
+        value = value.strip()
+        for t in list(self.candidates):
+            if not getattr(self, '_check_' + t)(value):
+                self.candidates.remove(t)
+
+    def _check_bool(self, value):
+        return value.lower() in BOOL_VALUES
+
+    def _check_int(self, value):
+        if not INT_RE.match(value):
+            return False
+
+        digits = len(value.lstrip('+-'))
+        if digits > MAX_BIGINT_DIGITS:
+            return False
+
+        n = int(value)
+        if self.min_int is None or n < self.min_int:
+            self.min_int = n
+        if self.max_int is None or n > self.max_int:
+            self.max_int = n
+        return True
+
+    def _check_float(self, value):
+        m = FLOAT_RE.match(value)
+        if not m:
+            return False
+
+        whole, fraction, exponent = m.groups()
+        if not (whole or fraction):
+            return False
+
+        if len(whole) > 1 and whole.startswith('0'):
+            return False
+
+        # Values in scientific notation can't be described by a precision and
+        # scale, so mark the column as unbounded
+        if exponent:
+            self.int_digits = None
+        elif self.int_digits is not None:
+            self.int_digits = max(self.int_digits, len(whole.lstrip('0')))
+            self.scale = max(self.scale, len(fraction))
+
+        n = float(value)
+        if self.min_number is None or n < self.min_number:
+            self.min_number = n
+        if self.max_number is None or n > self.max_number:
+            self.max_number = n
+        return True
+
+    def _check_date(self, value):
+        self.date_formats = _check_formats(self.date_formats, value)
+        return bool(self.date_formats)
+
+    def _check_datetime(self, value):
+        self.datetime_formats = _check_formats(self.datetime_formats, value)
+        return bool(self.datetime_formats)
+
+    @property
+    def type(self):
+        """
+        The best type for the column given the values seen so far, or None if
+        every value was null
+        """
+        if self.null_count == self.count:
+            return None
+
+        return self.candidates[0] if self.candidates else 'text'
+
+    @property
+    def date_format(self):
+        """
+        The format MySQL's STR_TO_DATE needs to read the values in a date or
+        datetime column, or None if they can be loaded as they are
+        """
+        if self.type == 'date':
+            return self.date_formats[0][1]
+        if self.type == 'datetime':
+            return self.datetime_formats[0][1]
+        return None
+
+    def profile(self):
+        """
+        Summarize the values seen so far
+
+        Returns:
+            A dict with the number of nulls, an estimate of the number of
+            distinct values, the smallest and largest values (compared as
+            numbers in numeric columns), and the length of the longest value
+        """
+        t = self.type
+        if t == 'int':
+            low, high = self.min_int, self.max_int
+        elif t == 'float':
+            low, high = self.min_number, self.max_number
+        elif t == 'bool':
+            low = high = None
+        else:
+            low, high = self.min_text, self.max_text
+
+        def clean(value):
+            if value is None:
+                return None
+            # repr keeps every digit of a float, str rounds to 12
+            value = repr(value) if isinstance(value, float) else str(value)
+            return value[:MAX_PROFILE_LENGTH]
+
+        return {'null_count': self.null_count,
+                'distinct_count': self.distinct.count() if t else 0,
+                'min_value': clean(low),
+                'max_value': clean(high),
+                'max_length': self.max_length}
+
+    def sql_type(self, sampled=False):
+        """
+        Generate the smallest MySQL column type that holds every value seen:
+        the narrowest integer type that fits the range, a DECIMAL with
+        exactly the digits needed, a native DATE or DATETIME, or a VARCHAR
+        as long as the longest value.
+
+        Args:
+            sampled (bool): Whether the state was built from a sample of the
+            rows. If so, leave headroom on lengths and numbers for the values
+            we didn't look at.
+
+        Returns:
+            A string such as "SMALLINT", "DECIMAL(7,2)" or "VARCHAR(20)"
+        """
+        t = self.type
+        if t == 'bool':
+            return 'BOOLEAN'
+
+        if t == 'int':
+            if not sampled:
+                for name, low, high in INT_TYPES:
+                    if low <= self.min_int and self.max_int <= high:
+                        return name
+            return 'BIGINT'
+
+        if t == 'float':
+            # Values in scientific notation have no fixed number of digits
+            if sampled or self.int_digits is None:
+                return 'DOUBLE'
+            precision = max(self.int_digits + self.scale, 1)
+            if precision > MAX_PRECISION or self.scale > MAX_SCALE:
+                return 'DOUBLE'
+            return 'DECIMAL({},{})'.format(precision, self.scale)
+
+        if t == 'date':
+            return 'DATE'
+
+        if t == 'datetime':
+            return 'DATETIME'
+
+        return text_type(self.max_length, sampled)
+
+
+class TypeInferrer(object):
+    """
+    Infers the type of every column in a CSV in a single pass, streaming
+    rows from disk and keeping only a ColumnState per column in memory.
+
+    Example usage:
+        inferrer = TypeInferrer('my_local_file.csv')
+        for column in inferrer.infer():
+            print(column.name, column.sql_type())
+
+    Args:
+        path (string): The path to a local CSV
+        delimiter (string): The field delimiter
+        sample_size (int): If None, every row is inspected. Otherwise, inspect
+        the first sample_size rows and then every sample_stride'th row
+        sample_stride (int): How often to inspect rows past sample_size
+        progress (function): Called every PROGRESS_ROWS rows with the number
+        of rows and bytes read so far
+    """
+    def __init__(self, path, delimiter=',', sample_size=None,
+                 sample_stride=SAMPLE_STRIDE, progress=None):
+        self.path = path
+        self.delimiter = delimiter
+        self.sample_size = sample_size
+        self.sample_stride = sample_stride
+        self.progress = progress
+        self.row_count = 0
+        self.sampled = False
+
+    def _rows(self):
+        with open(self.path, 'rb') as f:
+            reader = csv.reader(f, delimiter=self.delimiter)
+            headers = next(reader, [])
+            yield headers
+            for i, row in enumerate(reader):
+                # tell() is only accurate to the size of the file's read-ahead
+                # buffer, which is plenty for a progress bar
+                if self.progress and i and not i % PROGRESS_ROWS:
+                    self.progress(i, f.tell())
+                yield row
+
+    def infer(self):
+        """
+        Read the file and build the state for each column
+
+        Returns:
+            columns (ColumnState[]): One ColumnState per column in the header
+        """
+        rows = self._rows()
+        columns = [ColumnState(name) for name in next(rows)]
+        n = len(columns)
+
+        for i, row in enumerate(rows):
+            self.row_count += 1
+
+            if self.sample_size is not None and i >= self.sample_size:
+                self.sampled = True
+                if (i - self.sample_size) % self.sample_stride:
+                    continue
+
+            # Pad short rows with nulls and ignore any extra fields, the same
+            # way LOAD DATA INFILE does
+            if len(row) < n:
+                row = row + [''] * (n - len(row))
+
+            for column, value in zip(columns, row):
+                column.update(value)
+
+        return columns
@@ -0,0 +1,61 @@
+# Stdlib imports
+import json
+
+# Django imports
+from django.core.management.base import BaseCommand, CommandError
+
+# Local imports
+from upload.benchmarks import run, BENCHMARKS, SHAPES, TYPES
+
+
+class Command(BaseCommand):
+    help = ('Time the ingest pipeline against a synthetic CSV, with MySQL '
+            'and S3 replaced by local stand-ins, and print the results as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shape', choices=sorted(SHAPES),
+                            help='Preset row and column counts')
+        parser.add_argument('--rows', type=int,
+                            help='Rows in the synthetic CSV (default 100000)')
+        parser.add_argument('--columns', type=int,
+                            help='Columns in the synthetic CSV (default 12)')
+        parser.add_argument('--types', default=','.join(TYPES),
+                            help='Comma-separated column types to cycle through')
+        parser.add_argument('--quote-rate', type=float, default=0.05,
+                            help='Share of text values that need quoting')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs of each benchmark; the fastest is reported')
+        parser.add_argument('--only', action='append',
+                            choices=[name for name, f in BENCHMARKS],
+                            help='Only run this benchmark')
+        parser.add_argument('--workdir',
+                            help='Where to write the synthetic CSV')
+        parser.add_argument('--output',
+                            help='Write the JSON here instead of to stdout')
+
+    def handle(self, *args, **options):
+        shape = SHAPES.get(options['shape'], {'rows': 100000, 'columns': 12})
+        types = options['types'].split(',')
+        unknown = [t for t in types if t not in TYPES]
+        if unknown:
+            raise CommandError('Unknown column types: {}'.format(', '.join(unknown)))
+
+        report = run(rows=options['rows'] or shape['rows'],
+                     columns=options['columns'] or shape['columns'],
+                     types=types,
+                     quote_rate=options['quote_rate'],
+                     seed=options['seed'],
+                     repeat=options['repeat'],
+                     only=options['only'],
+                     workdir=options['workdir'])
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if any('error' in r for r in report['results']):
+            raise CommandError('Some benchmarks failed')
@@ -0,0 +1,27 @@
+# Django imports
+from django.core.management.base import BaseCommand
+
+# Local imports
+from upload.models import Table
+from upload.tasks import build_indexes
+
+
+class Command(BaseCommand):
+    help = 'Queue FULLTEXT index builds for tables that aren\'t searchable yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Rebuild the indexes of every table')
+        parser.add_argument('--table', action='append', dest='tables',
+                            help='Only build indexes for this table')
+
+    def handle(self, *args, **options):
+        tables = Table.objects.all()
+        if not options['all']:
+            tables = tables.exclude(index_status__in=['ready', 'building'])
+        if options['tables']:
+            tables = tables.filter(table__in=options['tables'])
+
+        for table in tables:
+            build_indexes.delay(table.id)
+            self.stdout.write('Queued index build for {}'.format(table.table))
@@ -0,0 +1,43 @@
+# Standard library imports
+import datetime
+
+# Django imports
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.utils import timezone
+
+# Third-party imports
+import botocore
+
+# Local imports
+from upload.models import Upload
+from upload.utils import S3Manager, UploadWorkspace
+
+
+class Command(BaseCommand):
+    help = ('Abort chunked uploads that were never finished and remove '
+            'workspaces left behind by requests or tasks that died')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int,
+                            default=settings.UPLOAD_EXPIRY,
+                            help='Age in seconds past which an upload is '
+                                 'stale (default UPLOAD_EXPIRY)')
+
+    def handle(self, *args, **options):
+        max_age = options['max_age']
+        cutoff = timezone.now() - datetime.timedelta(seconds=max_age)
+        s3 = S3Manager(None, None, settings.S3_BUCKET)
+
+        for upload in Upload.objects.filter(complete=False,
+                                            start_time__lt=cutoff):
+            # Until it's aborted, S3 keeps (and bills for) every part it got
+            try:
+                s3.abort_multipart_upload(upload.s3_path, upload.multipart_id)
+            except botocore.exceptions.ClientError:
+                pass
+            upload.delete()
+            self.stdout.write('Aborted upload of {}'.format(upload.filename))
+
+        for name in UploadWorkspace.expire(max_age):
+            self.stdout.write('Removed workspace {}'.format(name))
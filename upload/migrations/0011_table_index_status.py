@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0010_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='index_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='table',
+            name='index_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('building', 'Building'), ('ready', 'Ready'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+    ]
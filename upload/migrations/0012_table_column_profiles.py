@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0011_table_index_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='column',
+            name='distinct_count',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='column',
+            name='max_length',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='column',
+            name='max_value',
+            field=models.CharField(max_length=300, null=True),
+        ),
+        migrations.AddField(
+            model_name='column',
+            name='min_value',
+            field=models.CharField(max_length=300, null=True),
+        ),
+        migrations.AddField(
+            model_name='column',
+            name='null_count',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='table',
+            name='preview',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='table',
+            name='profile_sampled',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='table',
+            name='row_count',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0012_table_column_profiles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='task_id',
+            field=models.CharField(max_length=255, null=True, unique=True),
+        ),
+    ]
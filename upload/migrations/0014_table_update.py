@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:18
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('upload', '0013_table_task_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TableUpdate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(max_length=255, unique=True)),
+                ('mode', models.CharField(choices=[('append', 'Append new rows'), ('upsert', 'Update or insert rows on a key')], max_length=20)),
+                ('key_columns', models.CharField(blank=True, max_length=1000)),
+                ('path', models.CharField(max_length=500)),
+                ('update_time', models.DateTimeField(auto_now_add=True)),
+                ('upload_log', models.TextField(blank=True)),
+                ('rows_read', models.BigIntegerField(null=True)),
+                ('rows_inserted', models.BigIntegerField(null=True)),
+                ('rows_updated', models.BigIntegerField(null=True)),
+                ('table', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='upload.Table')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0014_table_update'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TableExport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(choices=[('csv.gz', 'CSV (gzipped)'), ('parquet', 'Parquet')], max_length=20)),
+                ('version', models.IntegerField()),
+                ('path', models.CharField(blank=True, max_length=500)),
+                ('status', models.CharField(choices=[('building', 'Building'), ('ready', 'Ready'), ('failed', 'Failed')], default='building', max_length=20)),
+                ('error', models.TextField(blank=True)),
+                ('rows', models.BigIntegerField(null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(default=django.utils.timezone.now)),
+                ('table', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='upload.Table')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='tableexport',
+            unique_together=set([('table', 'format', 'version')]),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:28
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0015_table_export'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoadTiming',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=300)),
+                ('position', models.IntegerField()),
+                ('wall_seconds', models.FloatField()),
+                ('cpu_seconds', models.FloatField()),
+                ('max_rss_kb', models.BigIntegerField()),
+                ('rss_growth_kb', models.BigIntegerField()),
+                ('bytes', models.BigIntegerField(null=True)),
+                ('rows', models.BigIntegerField(null=True)),
+                ('table', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='upload.Table')),
+            ],
+            options={
+                'ordering': ('position',),
+            },
+        ),
+    ]
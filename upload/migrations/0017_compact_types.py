@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fix_text_columns(apps, schema_editor):
+    # Booleans and datetimes used to be loaded as VARCHAR(10) and
+    # VARCHAR(100), so record what those columns really are
+    Column = apps.get_model('upload', 'Column')
+    Column.objects.filter(mysql_type__in=('boolean', 'datetime')) \
+        .exclude(column_size=None).update(mysql_type='varchar')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0016_load_timing'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='column',
+            name='mysql_type',
+            field=models.CharField(choices=[('varchar', 'VARCHAR'), ('char', 'CHAR'), ('text', 'TEXT'), ('longtext', 'LONGTEXT'), ('decimal', 'DECIMAL'), ('double', 'DOUBLE'), ('float', 'FLOAT'), ('tinyint', 'TINYINT'), ('smallint', 'SMALLINT'), ('mediumint', 'MEDIUMINT'), ('int', 'INT'), ('integer', 'INTEGER'), ('bigint', 'BIGINT'), ('boolean', 'BOOLEAN'), ('date', 'DATE'), ('datetime', 'DATETIME'), ('timestamp', 'TIMESTAMP'), ('json', 'JSON'), ('binary', 'BINARY')], max_length=300),
+        ),
+        migrations.RunPython(fix_text_columns, migrations.RunPython.noop),
+    ]
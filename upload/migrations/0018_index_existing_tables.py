@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction
+from sqlalchemy import exc
+
+
+def index_existing_tables(apps, schema_editor):
+    # Tables loaded before indexes were built in the background came out of
+    # 0011 as "pending", which hides them from search. The ones that already
+    # have their indexes are ready, and the rest get them built
+    Table = apps.get_model('upload', 'Table')
+    tables = list(Table.objects.filter(index_status='pending'))
+    if not tables:
+        return
+
+    from data_import_tool import warehouse
+    from upload.tasks import build_indexes
+    from upload.utils import Index
+
+    unbuilt = []
+    connection = warehouse.connect()
+    try:
+        for table in tables:
+            try:
+                built = Index(table.id, connection).is_built(table.table)
+            except exc.SQLAlchemyError:
+                # e.g. the table is gone from the warehouse. The build
+                # records the error on the table
+                built = False
+
+            if built:
+                Table.objects.filter(pk=table.id).update(index_status='ready')
+            else:
+                unbuilt.append(table.id)
+    finally:
+        connection.close()
+
+    def queue():
+        for table_id in unbuilt:
+            build_indexes.delay(table_id)
+    transaction.on_commit(queue)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0017_compact_types'),
+    ]
+
+    operations = [
+        migrations.RunPython(index_existing_tables, migrations.RunPython.noop),
+    ]
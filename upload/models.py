@@ -1,10 +1,24 @@
 from __future__ import unicode_literals
+import json
+import uuid
 
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 
 class Table(models.Model):
+    # Tables are searchable once their FULLTEXT indexes are built
+    INDEX_STATUS_CHOICES = (
+        ("pending","Pending"),
+        ("building","Building"),
+        ("ready","Ready"),
+        ("failed","Failed")
+    )
+
     user = models.ForeignKey(User)
+    # The load_infile task that loaded the table, so that it's only
+    # registered once however many times the task's result is read
+    task_id = models.CharField(max_length=255, unique=True, null=True)
     table = models.CharField(max_length=300)
     topic = models.CharField(max_length=300, blank=True)
     upload_time = models.DateTimeField(auto_now_add=True)
@@ -12,6 +26,24 @@ class Table(models.Model):
     path = models.CharField(max_length=500)
     source = models.CharField(max_length=300, blank=False, null=False)
     next_update = models.DateField(blank=True, null=True)
+    index_status = models.CharField(choices=INDEX_STATUS_CHOICES, max_length=20, default="pending")
+    index_error = models.TextField(blank=True)
+    # Captured while the table is loaded, so that showing it doesn't mean
+    # querying the warehouse
+    row_count = models.BigIntegerField(null=True)
+    preview = models.TextField(blank=True)  # JSON array of the first rows
+    # Whether the column profiles only cover a sample of the rows, when
+    # INFERENCE_SAMPLE_SIZE is set
+    profile_sampled = models.BooleanField(default=False)
+
+    @property
+    def preview_rows(self):
+        return json.loads(self.preview) if self.preview else []
+
+    @property
+    def data_version(self):
+        # Every update of the table's rows makes a new version
+        return self.tableupdate_set.count()
 
     def __unicode__(self):
         return self.table
@@ -43,7 +75,14 @@ class Column(models.Model):
         ("longtext","LONGTEXT"),
         ("decimal","DECIMAL"),
         ("double","DOUBLE"),
+        ("float","FLOAT"),
+        ("tinyint","TINYINT"),
+        ("smallint","SMALLINT"),
+        ("mediumint","MEDIUMINT"),
         ("int","INT"),
+        ("integer","INTEGER"),
+        ("bigint","BIGINT"),
+        ("boolean","BOOLEAN"),
         ("date","DATE"),
         ("datetime","DATETIME"),
         ("timestamp","TIMESTAMP"),
@@ -56,6 +95,12 @@ class Column(models.Model):
     mysql_type = models.CharField(choices=MYSQL_TYPE_CHOICES, max_length=300, blank=False, null=False)
     column_size = models.CharField(max_length=10, null=True)
     information_type = models.CharField(choices=INFORMATION_TYPE_CHOICES, max_length=30, blank=True, null=True)
+    # Column profile, captured while the table is loaded
+    null_count = models.BigIntegerField(null=True)
+    distinct_count = models.BigIntegerField(null=True)  # HyperLogLog estimate
+    min_value = models.CharField(max_length=300, null=True)
+    max_value = models.CharField(max_length=300, null=True)
+    max_length = models.IntegerField(null=True)
 
     def __unicode__(self):
         return self.column
@@ -78,3 +123,114 @@ class Contact(models.Model):
     def __unicode__(self):
         return self.name
 
+
+
+class TableUpdate(models.Model):
+    """
+    A new version of a file loaded into a table that already exists. Only
+    the rows that are new, or changed on the key, are written to the table.
+    """
+    MODE_CHOICES = (
+        ("append","Append new rows"),
+        ("upsert","Update or insert rows on a key")
+    )
+
+    table = models.ForeignKey(Table)
+    user = models.ForeignKey(User)
+    task_id = models.CharField(max_length=255, unique=True)
+    mode = models.CharField(choices=MODE_CHOICES, max_length=20)
+    key_columns = models.CharField(max_length=1000, blank=True)  # Comma-separated
+    path = models.CharField(max_length=500)
+    update_time = models.DateTimeField(auto_now_add=True)
+    upload_log = models.TextField(blank=True)
+    rows_read = models.BigIntegerField(null=True)
+    rows_inserted = models.BigIntegerField(null=True)
+    rows_updated = models.BigIntegerField(null=True)
+
+    @property
+    def keys(self):
+        return self.key_columns.split(',') if self.key_columns else []
+
+    def __unicode__(self):
+        return '{} ({})'.format(self.table, self.update_time)
+
+
+class TableExport(models.Model):
+    """
+    A copy of a whole table in a file that's quicker to work with than
+    querying the warehouse. Exports are built the first time someone asks for
+    them, and built again once the table's rows have changed.
+    """
+    FORMAT_CHOICES = (
+        ("csv.gz","CSV (gzipped)"),
+        ("parquet","Parquet")
+    )
+
+    STATUS_CHOICES = (
+        ("building","Building"),
+        ("ready","Ready"),
+        ("failed","Failed")
+    )
+
+    table = models.ForeignKey(Table)
+    format = models.CharField(choices=FORMAT_CHOICES, max_length=20)
+    version = models.IntegerField()  # The table's data_version it was built from
+    path = models.CharField(max_length=500, blank=True)
+    status = models.CharField(choices=STATUS_CHOICES, max_length=20, default="building")
+    error = models.TextField(blank=True)
+    rows = models.BigIntegerField(null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(default=timezone.now)  # When the last attempt to build it began
+
+    class Meta:
+        unique_together = ('table', 'format', 'version')
+
+    def __unicode__(self):
+        return '{}.{}'.format(self.table, self.format)
+
+
+class LoadTiming(models.Model):
+    """
+    How long one stage of the load that created a table took, how much CPU
+    and memory it used, and how much data it went through
+    """
+    table = models.ForeignKey(Table)
+    stage = models.CharField(max_length=300)
+    position = models.IntegerField()  # The order the stages ran in
+    wall_seconds = models.FloatField()
+    cpu_seconds = models.FloatField()
+    max_rss_kb = models.BigIntegerField()  # Most memory the worker held during the stage
+    rss_growth_kb = models.BigIntegerField()  # Memory at the end of the stage less the start
+    bytes = models.BigIntegerField(null=True)
+    rows = models.BigIntegerField(null=True)
+
+    class Meta:
+        ordering = ('position',)
+
+    def __unicode__(self):
+        return '{}: {}'.format(self.table, self.stage)
+
+
+class Upload(models.Model):
+    """
+    A file being uploaded in chunks. The chunks are stored as the parts of an
+    S3 multipart upload rather than on the web node that received them, so
+    any node can accept any chunk, and an interrupted upload can be resumed
+    from wherever it left off.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User)
+    filename = models.CharField(max_length=300)
+    size = models.BigIntegerField()
+    chunk_size = models.IntegerField()
+    s3_path = models.CharField(max_length=500)
+    multipart_id = models.CharField(max_length=300)
+    start_time = models.DateTimeField(auto_now_add=True)
+    complete = models.BooleanField(default=False)
+
+    @property
+    def parts(self):
+        return -(-self.size // self.chunk_size)
+
+    def __unicode__(self):
+        return self.filename
@@ -1,22 +1,40 @@
 # Stdlib imports
 from __future__ import absolute_import
 import os
+import json
+import logging
 import re
+import resource
+import shutil
+import tempfile
+import threading
+import time
 import warnings
+import datetime
+import zlib
 
 # Django imports
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 
 # Third party imports
-import sqlalchemy
 from sqlalchemy import exc # error handling
 from celery import shared_task
-import boto3
+from celery.signals import task_postrun
 import botocore
-from csvkit import sql, table
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Local module imports
-from .utils import S3Manager
+from data_import_tool import warehouse
+from data_import_tool.warehouse import ROW_ID, ROW_HASH
+from .utils import S3Manager, CSVSplitter, UploadWorkspace, Index, publish_progress
+from .utils import row_hash_expression, export_key, BLOCK_SIZE
+from .inference import TypeInferrer, NULL_VALUES, TRUE_VALUES, text_type, widen_type
+from .inference import MAX_PROFILE_LENGTH
+from .analyzer import UploadAnalyzer
+from .models import Table, Column, Contact, TableUpdate, TableExport, LoadTiming
+from search.utils import SearchManager, _jsonable
 
 # Constants TODO: these should be set in settings and accessed that way, so
 # they don't have to be imported in every single file the way we're currently
@@ -25,17 +43,152 @@ BUCKET_NAME = settings.S3_BUCKET
 URL = settings.DATA_WAREHOUSE_URL # Where the table will be uploaded
 ACCESS_KEY = settings.AWS_ACCESS_KEY
 SECRET_KEY = settings.AWS_SECRET_KEY
-TOTAL = 8 # Unfortunately we have to hardcode the total number of steps for the progress bar
+TOTAL = 9 # The number of stages in load_infile. Loader adds more as it finds them
+
+# Stage timings are logged here as JSON, one line per stage, for the log
+# pipeline to turn into ingest latency metrics
+metrics = logging.getLogger('upload.metrics')
+
+
+def _current_rss_kb():
+    """
+    The resident set size of this process right now, in kilobytes. This
+    isn't ru_maxrss, which is the most the process has ever held: a celery
+    worker that once loaded a big file would report that for every stage of
+    every task after it. Returns 0 where /proc isn't available.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+class StageTimer(object):
+    """
+    This module measures each stage of a task: its wall time, the CPU time
+    the process spent in it, and the most memory the process held during it,
+    along with the bytes and rows the stage processed. Starting a stage
+    finishes the one before it.
+
+    Memory is the resident set size, sampled when the stage starts and stops
+    and whenever sample() is called in between. rss_growth_kb is how much
+    larger it was at the end of the stage than at the start, and can be
+    negative if the stage freed memory.
+    """
+    def __init__(self):
+        self.stages = []
+        self.current = None
+
+    def _usage(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return (time.time(), usage.ru_utime + usage.ru_stime, _current_rss_kb())
+
+    def start(self, stage):
+        self.stop()
+        usage = self._usage()
+        self.current = {'stage': stage, 'bytes': None, 'rows': None,
+                        'usage': usage, 'peak_rss': usage[2]}
+
+    def sample(self):
+        """
+        Check how much memory the process holds now, so that a peak in the
+        middle of a stage is caught
+        """
+        if self.current is None:
+            return
+        self.current['peak_rss'] = max(self.current['peak_rss'], _current_rss_kb())
+
+    def count(self, bytes=None, rows=None):
+        """
+        Record how much the current stage processed
+        """
+        if self.current is None:
+            return
+        if bytes is not None:
+            self.current['bytes'] = bytes
+        if rows is not None:
+            self.current['rows'] = rows
+
+    def stop(self):
+        if self.current is None:
+            return
+        wall, cpu, rss = self._usage()
+        start_wall, start_cpu, start_rss = self.current.pop('usage')
+        self.current.update(wall_seconds=wall - start_wall,
+                            cpu_seconds=cpu - start_cpu,
+                            max_rss_kb=max(self.current.pop('peak_rss'), rss),
+                            rss_growth_kb=rss - start_rss)
+        self.stages.append(self.current)
+        self.current = None
+
+    def report(self):
+        """
+        Finish the current stage
+
+        Returns:
+            A list with a dict of measurements for each stage so far
+        """
+        self.stop()
+        return list(self.stages)
+
+
+def _log_timings(task_id, table_name, file_size, timings, error=False,
+                 mode='load'):
+    """
+    Log each stage of a load as a JSON metric, with the size of the file so
+    that latency can be broken down by file size. mode tells new tables
+    ("load") apart from updates of existing ones ("append" or "upsert")
+    """
+    for position, timing in enumerate(timings):
+        line = dict(timing, event='ingest.stage', task_id=task_id,
+                    table=table_name, file_bytes=file_size, position=position,
+                    error=error, mode=mode)
+        metrics.info(json.dumps(line, sort_keys=True))
+
+    metrics.info(json.dumps({
+        'event': 'ingest.total', 'task_id': task_id, 'table': table_name,
+        'file_bytes': file_size, 'error': error, 'mode': mode,
+        'wall_seconds': sum(t['wall_seconds'] for t in timings),
+        'cpu_seconds': sum(t['cpu_seconds'] for t in timings),
+        'max_rss_kb': max([t['max_rss_kb'] for t in timings] or [0])
+    }, sort_keys=True))
+
 
 class ProgressTracker(object):
     """
     This module sends messages to the Redis server to update the state of the
     task so that we can have an informative, pretty progress bar
+
+    The bar is split into stages. forward() starts the next one, and
+    advance() reports how far through the current stage the task is, e.g.
+    bytes downloaded or rows loaded, so long stages don't look hung. Stages
+    can be added as the task finds out it has more to do. Updates within a
+    stage are sent at most once every PROGRESS_INTERVAL seconds, since they
+    can come from callbacks that fire for every block of a file.
+
+    Each stage is also timed by a StageTimer, in timer.
+
+    Args:
+        celery (celery.Task): The task to report the progress of
+        total (int): The number of stages the task expects to go through
     """
     def __init__(self, celery, total=TOTAL):
         self.celery = celery
+        self.timer = StageTimer()
         self.total = total
         self.step = 0
+        self.fraction = 0.0
+        self.message = ''
+        self.detail = None
+        self.last_sent = 0
+        self.lock = threading.Lock()
+
+    def add_stages(self, n):
+        self.total += n
 
     def forward(self, message):
         """
@@ -45,12 +198,128 @@ class ProgressTracker(object):
         Arguments:
             message (string): Message you want to display on the progress bar
         """
-        self.step += 1
+        with self.lock:
+            self.step += 1
+            self.total = max(self.total, self.step)
+            self.fraction = 0.0
+            self.detail = None
+            self.timer.start(message)
+        self.update(message)
+
+    def update(self, message):
+        """
+        This method updates the message for the current step without moving
+        the progress bar, e.g. to report how far along a long step is.
+
+        Arguments:
+            message (string): Message you want to display on the progress bar
+        """
+        with self.lock:
+            self.message = message
+            self._send()
+
+    def advance(self, done, size=None, detail=None):
+        """
+        This method moves the progress bar through the current step. It's
+        safe to call from several threads, e.g. boto3's transfer callbacks.
+
+        Arguments:
+            done (int): How much of the step is done, e.g. bytes downloaded
+            size (int): How much there is to do in all, if it's known
+            detail (string): Shown after the step's message, e.g. "10 of 20 MB"
+        """
+        with self.lock:
+            if size:
+                self.fraction = min(float(done) / size, 1.0)
+            self.detail = detail
+            if time.time() - self.last_sent >= settings.PROGRESS_INTERVAL:
+                self._send()
+
+    def _send(self):
+        message = self.message
+        if self.detail:
+            message = '{} ({})'.format(message, self.detail)
+
         meta = {'message': message,
                 'error': False,
-                'current': self.step,
+                'current': min(self.step + self.fraction, self.total),
                 'total': self.total}
         self.celery.update_state(state='PROGRESS', meta=meta)
+        self.last_sent = time.time()
+
+        # Push the update to any browser streaming it, so it doesn't have to
+        # keep asking
+        publish_progress(self.celery.request.id, 'PROGRESS', meta)
+
+        # Updates within a stage are throttled, which makes them a cheap place
+        # to check how much memory the stage is using
+        self.timer.sample()
+
+
+def _megabytes(n):
+    return '{:,.1f}'.format(n / (1024.0 * 1024))
+
+
+def _sql_string(value):
+    """
+    Quote a delimiter or line terminator for a LOAD DATA statement
+    """
+    for raw, escaped in (('\\', '\\\\'), ('"', '\\"'), ('\t', '\\t'),
+                         ('\n', '\\n'), ('\r', '\\r')):
+        value = value.replace(raw, escaped)
+    return '"{}"'.format(value)
+
+
+# Columns of these types are loaded through user variables and converted on
+# the way in, so that null tokens like "NA" become NULL instead of 0, and
+# booleans and dates in other formats are read the way they were inferred
+CONVERTED_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'integer',
+                   'bigint', 'decimal', 'double', 'float', 'boolean', 'date',
+                   'datetime')
+NULL_TOKENS = ', '.join(_sql_string(v) for v in NULL_VALUES)
+TRUE_TOKENS = ', '.join(_sql_string(v) for v in TRUE_VALUES)
+
+
+def _convert(variable, column):
+    """
+    Build the expression that converts a raw value read into a user variable
+    into its column's type
+
+    Args:
+        variable (string): The user variable, e.g. "@c0"
+        column (dict): The column, with its "datatype" and, for dates, the
+            "date_format" to read them with
+
+    Returns:
+        A SQL expression to assign to the column in a LOAD DATA statement
+    """
+    value = 'TRIM({})'.format(variable)
+    datatype = column.get('datatype')
+    if datatype == 'boolean':
+        converted = 'LOWER({}) IN ({})'.format(value, TRUE_TOKENS)
+    elif datatype in ('date', 'datetime') and column.get('date_format'):
+        # The driver fills in query parameters with the % operator, so the
+        # format's own percent signs have to be doubled
+        date_format = _sql_string(column['date_format']).replace('%', '%%')
+        converted = 'STR_TO_DATE({}, {})'.format(value, date_format)
+    else:
+        converted = value
+    return 'IF(LOWER({}) IN ({}), NULL, {})'.format(value, NULL_TOKENS, converted)
+
+
+def _set_type(header, raw_type):
+    """
+    Give a column a MySQL type, split into the type and size the catalog
+    keeps, e.g. "DECIMAL(7,2)" into "decimal" and "7,2"
+    """
+    parsed = re.match(r'(\w+)(?:\(([\d,]+)\))?', raw_type)
+    size = parsed.group(2)
+    if size and ',' not in size:
+        size = int(size)
+
+    header['datatype'] = parsed.group(1).lower()
+    header['raw_type'] = raw_type
+    header['length'] = size
 
 
 class Loader(object):
@@ -58,49 +327,90 @@ class Loader(object):
     This module handles creation of all the queries necessary to create a table
     and load local data into it, all while sending progress updates to a celery
     class instance
+
+    Args:
+        tracker (ProgressTracker): Where to report progress
+        table (string): The name of the table
+        headers (dict[]): The table's columns, in order, each with a "name"
+            and, optionally, a "type" of "text" to keep the column as text
+            whatever its values look like
+        path (string): The path to the CSV
+        analysis (dict): The CSV's UploadAnalyzer summary. Its dialect is
+            used to load the file, and if it covers the whole file, so are
+            its column types. Defaults to a plain comma-separated UTF-8 file
     """
-    def __init__(self, tracker, table, headers, path):
+    def __init__(self, tracker, table, headers, path, analysis=None):
         self.tracker = tracker
         self.path = path
         self.table = table
         self.columns = headers
+        self.row_count = None
+        self.profile_sampled = False
+
+        self.analysis = analysis or {}
+        self.delimiter = self.analysis.get('delimiter') or ','
+        self.quotechar = self.analysis.get('quotechar') or '"'
+        self.line_terminator = self.analysis.get('line_terminator') or '\n'
+        self.charset = self.analysis.get('charset') or 'utf8'
+
+        # Borrow a connection to the data warehouse. Ask for one that will
+        # accept LOAD INFILE statements
+        self.engine = warehouse.get_engine(local_infile=True)
+        self.connection = self.engine.connect()
 
-        # Create a connection to the data warehouse. Pass local_infile as a
-        # parameter so that the connection will accept LOAD INFILE statements
-        engine = sqlalchemy.create_engine(URL + '?local_infile=1')
-        self.connection = engine.connect()
+    def _infer(self):
+        """
+        Get the type and profile of each column, from the analysis if it
+        covered the whole file, or by reading the file otherwise
+
+        Returns:
+            A three-tuple with an array of dicts, one per column, with its
+            MySQL "sql_type", "profile" and date "format", the number of
+            rows, and whether only a sample of them was inspected
+        """
+        if self.analysis.get('complete') and self.analysis.get('columns') is not None:
+            return (self.analysis['columns'], self.analysis['row_count'],
+                    self.analysis['sampled'])
+
+        # Stream the csv through the type inferrer, which only keeps a small
+        # amount of state per column, so memory use doesn't grow with the
+        # size of the file
+        size = os.path.getsize(self.path)
+        def progress(rows, position):
+            self.tracker.advance(position, size, '{:,} rows'.format(rows))
+
+        inferrer = TypeInferrer(self.path, delimiter=self.delimiter,
+                                sample_size=settings.INFERENCE_SAMPLE_SIZE,
+                                progress=progress)
+        inferred = inferrer.infer()
+        columns = [{'sql_type': c.sql_type(sampled=inferrer.sampled),
+                    'profile': c.profile(),
+                    'format': c.date_format} for c in inferred]
+        return (columns, inferrer.row_count, inferrer.sampled)
 
     def _get_column_types(self):
         self.tracker.forward('Inferring datatype of columns')
-        # Load the csv and use csvkit's sql.make_table utility 
-        # to infer the datatypes of the columns.
-        with open(self.path,'r') as f:
-            csv_table = table.Table.from_csv(f, delimiter=',')
-
-        sql_table = sql.make_table(csv_table)
-        for i, column in enumerate(sql_table.columns):
-            # Clean the type and name values
-            raw_type = str(column.type)
-            clean_type = re.sub(re.compile(r'\(\w+\)'), '', raw_type)
-            
-            # Temporary fix for issue #19
-            if raw_type == 'BOOLEAN':
-                raw_type = 'VARCHAR(10)'
-
-            if raw_type == 'DATETIME':
-                # Dumb guess at the maximum length of a datetime field. Find a 
-                # better way!
-                raw_type = 'VARCHAR(100)'
-
-            parsed_length = re.search(re.compile(r'\((\w+)\)'), raw_type)
-            if parsed_length:
-                clean_length = int(parsed_length.group(1))
-            else:
-                clean_length = None
+        inferred, row_count, sampled = self._infer()
+
+        for header, column in zip(self.columns, inferred):
+            raw_type = column['sql_type']
+            date_format = column.get('format')
+            # Users can keep a column as text, e.g. IDs that happen to look
+            # like numbers
+            if header.get('type') == 'text':
+                raw_type = text_type(column['profile']['max_length'], sampled)
+                date_format = None
 
-            self.columns[i]['datatype'] = clean_type.lower()
-            self.columns[i]['raw_type'] = raw_type
-            self.columns[i]['length'] = clean_length
+            _set_type(header, raw_type)
+            header['date_format'] = date_format
+            header['profile'] = column['profile']
+
+        # The profiles are stored with the table, so that viewing it doesn't
+        # mean scanning it again. If only a sample of the rows was inspected
+        # the table says so, since its counts and extremes are estimates
+        self.row_count = row_count
+        self.profile_sampled = sampled
+        self.tracker.timer.count(rows=row_count)
 
     def _make_create_table_q(self):
         """
@@ -111,15 +421,52 @@ class Loader(object):
         # Convert column types back to strings for use in the create table
         # statement
         types= ['{name} {raw_type}'.format(**x) for x in self.columns]
+        types.append('{} BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY'
+                     .format(ROW_ID))
         args = {'table': self.table, 'columns': (', ').join(types)}
         query = 'CREATE TABLE imports.{table} ({columns}) ENGINE=MyISAM;'.format(**args)
 
         return query
 
-    def _make_load_table_q(self):
+    def _column_list(self):
+        return ','.join('`{}`'.format(c['name']) for c in self.columns)
+
+    def _load_targets(self):
+        """
+        Where LOAD DATA should put each field of the file. Text is loaded
+        straight into its column, and everything else into a user variable
+        that's converted into the column's type.
+
+        Returns:
+            A two-tuple with the list of targets and the assignments that
+            convert the user variables
+        """
+        targets = []
+        assignments = []
+        for i, column in enumerate(self.columns):
+            if column.get('datatype') in CONVERTED_TYPES:
+                variable = '@c{}'.format(i)
+                targets.append(variable)
+                assignments.append('`{}` = {}'.format(column['name'],
+                                                      _convert(variable, column)))
+            else:
+                targets.append('`{}`'.format(column['name']))
+        return (','.join(targets), assignments)
+
+    def _make_load_table_q(self, path=None, table=None, ignore_lines=1,
+                           set_clause=None):
         """
         This method generates a LOAD INFILE query
 
+        Args:
+            path (string): The file to load. Defaults to the whole CSV
+            table (string): The table to load it into. Defaults to the table
+            being created
+            ignore_lines (int): The number of header lines to skip
+            set_clause (string): Assignments to other columns computed from
+            the ones loaded, e.g. "_row_hash = MD5(...)". They come after the
+            conversions, so they see the converted values
+
         Returns:
             query (string): A formatted LOAD INFILE query with a path to the
             local file
@@ -128,14 +475,96 @@ class Loader(object):
         # of why we're sanitizing manually instead of passing args to 
         # sqlalchemy's execute method, see:
         # http://stackoverflow.com/q/40249590/4599578
+        # List the columns so that MySQL fills in the row IDs itself
+        # The dialect comes from the analysis of the file
+        targets, assignments = self._load_targets()
+        if set_clause:
+            assignments.append(set_clause)
         query = """
             LOAD DATA LOCAL INFILE "{path}" INTO TABLE imports.{table}
-            FIELDS TERMINATED BY "," LINES TERMINATED BY "\n"
-            IGNORE 1 LINES;
-            """.format(path=self.path, table=self.table)
+            CHARACTER SET {charset}
+            FIELDS TERMINATED BY {delimiter} OPTIONALLY ENCLOSED BY {quotechar}
+            LINES TERMINATED BY {terminator}
+            IGNORE {ignore} LINES ({columns}){set};
+            """.format(path=path or self.path, table=table or self.table,
+                       charset=self.charset,
+                       delimiter=_sql_string(self.delimiter),
+                       quotechar=_sql_string(self.quotechar),
+                       terminator=_sql_string(self.line_terminator),
+                       ignore=ignore_lines, columns=targets,
+                       set=' SET {}'.format(', '.join(assignments)) if assignments else '')
 
         return query
 
+    def _load_chunk(self, i, path):
+        """
+        Load a single chunk into the table over its own connection.
+
+        Returns:
+            A three-tuple with the index of the chunk, its size in bytes and
+            the number of rows loaded from it
+        """
+        size = os.path.getsize(path)
+        connection = self.engine.connect()
+        try:
+            rows = connection.execute(self._make_load_table_q(path, None, 0)).rowcount
+        finally:
+            connection.close()
+            os.remove(path)
+
+        return (i, size, rows)
+
+    def run_parallel_load(self):
+        """
+        Split the CSV into chunks on record boundaries and load them
+        concurrently over several connections, each straight into the table
+        so that every row is only written once. The row IDs follow the order
+        the chunks finish in rather than the order of the file.
+        """
+        size = os.path.getsize(self.path)
+        chunk_size = settings.LOAD_CHUNK_SIZE
+        expected = max(1, -(-size // chunk_size))
+        # The chunks leave out the header, so they add up to less than the file
+        newline = self.line_terminator[-1]
+        with open(self.path, 'rb') as f:
+            header = f.read(BLOCK_SIZE).split(newline, 1)[0]
+        data_size = size - len(header) - 1
+
+        workspace = tempfile.mkdtemp(prefix='load-')
+        splitter = CSVSplitter(self.path, chunk_size, workspace,
+                               quotechar=self.quotechar, newline=newline)
+        futures = []
+        done = set()
+        loaded = {'bytes': 0, 'rows': 0}
+
+        def report():
+            for f in futures:
+                if f.done() and f not in done:
+                    done.add(f)
+                    # Re-raise any error from the worker thread
+                    i, chunk_bytes, rows = f.result()
+                    loaded['bytes'] += chunk_bytes
+                    loaded['rows'] += rows
+                    detail = '{:,} rows, {} of {} chunks'.format(
+                        loaded['rows'], len(done), max(expected, len(futures)))
+                    self.tracker.advance(loaded['bytes'], data_size, detail)
+
+        try:
+            with ThreadPoolExecutor(settings.LOAD_PARALLEL_WORKERS) as pool:
+                # Start loading each chunk as soon as it's written
+                for i, path in splitter.split():
+                    futures.append(pool.submit(self._load_chunk, i, path))
+                    report()
+
+                while len(done) < len(futures):
+                    wait([f for f in futures if f not in done],
+                         return_when=FIRST_COMPLETED)
+                    report()
+
+            self.tracker.timer.count(bytes=data_size, rows=loaded['rows'])
+        finally:
+            shutil.rmtree(workspace, ignore_errors=True)
+
     def run_load_infile(self):
         """
         This method creates a table in the MySQL database and uploads a CSV.
@@ -146,14 +575,22 @@ class Loader(object):
             warnings.simplefilter('always')
 
             create_table_query = self._make_create_table_q()
-            load_data_query = self._make_load_table_q()
 
             self.tracker.forward('Creating table in imports database')
             self.connection.execute(create_table_query)
 
-            # Execute load data infile statement
+            # Big files can be split up and loaded over several connections
+            # at once. Everything else gets a single load data infile statement
             self.tracker.forward('Executing load data infile')
-            self.connection.execute(load_data_query)
+            threshold = settings.LOAD_PARALLEL_THRESHOLD
+            if threshold is not None and os.path.getsize(self.path) >= threshold:
+                self.run_parallel_load()
+            else:
+                # A single LOAD DATA can't report progress as it goes, so
+                # report the rows once it's done
+                rows = self.connection.execute(self._make_load_table_q()).rowcount
+                self.tracker.advance(1, 1, '{:,} rows'.format(rows))
+                self.tracker.timer.count(bytes=os.path.getsize(self.path), rows=rows)
 
             if len(w) > 0:
                 r = re.compile(r'\(.+?\)')
@@ -162,39 +599,411 @@ class Loader(object):
         return (create_table_query, sql_warnings)
 
     def get_preview(self):
-        return self.connection.execute('SELECT * FROM imports.{} LIMIT 5'.format(self.table))
+        return self.connection.execute('SELECT {} FROM imports.{} LIMIT 5'
+                                       .format(self._column_list(), self.table))
 
     def end_connection(self):
         self.connection.close()
 
+class Updater(Loader):
+    """
+    This module loads a new version of a file into a table that already
+    exists, writing only the rows that changed. The file is loaded into a
+    staging table along with a hash of each row, which is compared with the
+    hashes kept in the table:
+
+    - append: rows whose hash isn't in the table yet are inserted
+    - upsert: rows that match a row in the table on the key columns replace
+      it if their hash is different, and the rest are inserted
+
+    Columns were created just wide enough for the first version of the file,
+    so any that are too narrow for the new version are widened first.
+
+    Nothing is deleted. MyISAM keeps the FULLTEXT indexes up to date as rows
+    are written, so they don't have to be built again.
+
+    Args:
+        tracker (ProgressTracker): Where to report progress
+        table (string): The name of the table to update
+        headers (dict[]): The table's columns, in order, each with a "name"
+        path (string): The path to the new version of the file
+        mode (string): "append" or "upsert"
+        key_columns (string[]): The columns to match rows on in an upsert
+        analysis (dict): The file's UploadAnalyzer summary, for its dialect
+            and the formats of its dates
+    """
+    def __init__(self, tracker, table, headers, path, mode, key_columns=None,
+                 analysis=None):
+        super(Updater, self).__init__(tracker, table, headers, path, analysis)
+        # The columns keep the types they were created with, but the dates
+        # are read in whatever format the new file has them in
+        for header, column in zip(self.columns, self.analysis.get('columns') or []):
+            header.setdefault('date_format', column.get('format'))
+        self.mode = mode
+        self.key_columns = key_columns or []
+        self.staging = '{}__update'.format(table)
+        self.lock = 'imports.{}:update'.format(table)
+
+    def _names(self):
+        return [c['name'] for c in self.columns]
+
+    def _match(self):
+        """
+        The join condition between the staging table (s) and the table (t)
+        """
+        if self.mode == 'upsert':
+            # <=> so that NULL keys match each other
+            return ' AND '.join('t.`{0}` <=> s.`{0}`'.format(k) for k in self.key_columns)
+        return 't.`{0}` = s.`{0}`'.format(ROW_HASH)
+
+    def _prepare_table(self):
+        """
+        Make sure the table has a row ID, row hashes and an index on the key
+        """
+        index = Index(0, self.connection)
+        index.add_row_id(self.table)
+        index.add_row_hash(self.table, self._names())
+        if self.mode == 'upsert':
+            index.add_key_index(self.table, self.key_columns)
+
+    def _widen(self):
+        """
+        Change the type of every column whose new values wouldn't fit in it,
+        and hash the rows again, since their values may now read
+        differently. Widened columns are marked so their new types can be
+        saved to the catalog.
+
+        Returns:
+            The names of the columns that were widened
+        """
+        changes = []
+        for header, column in zip(self.columns, self.analysis.get('columns') or []):
+            # Columns with no values in the new file don't need any room
+            if not header.get('raw_type') or not column['profile']['max_length']:
+                continue
+
+            widened = widen_type(header['raw_type'], column['sql_type'],
+                                 column['profile']['max_length'])
+            if widened != header['raw_type']:
+                _set_type(header, widened)
+                header['widened'] = True
+                changes.append('MODIFY `{}` {}'.format(header['name'], widened))
+
+        if changes:
+            self.connection.execute('ALTER TABLE imports.`{}` {};'
+                                    .format(self.table, ', '.join(changes)))
+            self.connection.execute('UPDATE imports.`{}` SET `{}` = {};'.format(
+                self.table, ROW_HASH, row_hash_expression(self._names())))
+
+        return [c['name'] for c in self.columns if c.get('widened')]
+
+    def _stage(self):
+        """
+        Load the file into an empty copy of the table without its indexes
+
+        Returns:
+            The number of rows in the file
+        """
+        self.connection.execute('DROP TABLE IF EXISTS imports.`{}`;'.format(self.staging))
+        self.connection.execute(
+            'CREATE TABLE imports.`{staging}` ENGINE=MyISAM SELECT {columns} FROM imports.`{table}` LIMIT 0;'
+            .format(staging=self.staging, table=self.table, columns=self._column_list()))
+        self.connection.execute('ALTER TABLE imports.`{}` ADD COLUMN `{}` CHAR(32);'
+                                .format(self.staging, ROW_HASH))
+
+        set_clause = '`{}` = {}'.format(ROW_HASH, row_hash_expression(self._names()))
+        query = self._make_load_table_q(table=self.staging, set_clause=set_clause)
+        return self.connection.execute(query).rowcount
+
+    def _update_changed(self):
+        """
+        Overwrite the rows that match a staged row on the key but differ from
+        it. They keep their row IDs, so they stay where they were in search
+        results.
+
+        Returns:
+            The number of rows updated
+        """
+        assignments = ['t.`{0}` = s.`{0}`'.format(c) for c in self._names() + [ROW_HASH]]
+        query = """
+            UPDATE imports.`{table}` t JOIN imports.`{staging}` s ON {match}
+            SET {assignments} WHERE t.`{hash}` <> s.`{hash}`;
+            """.format(table=self.table, staging=self.staging, match=self._match(),
+                       assignments=', '.join(assignments), hash=ROW_HASH)
+        return self.connection.execute(query).rowcount
+
+    def _insert_new(self):
+        """
+        Insert the staged rows that don't match any row in the table
+
+        Returns:
+            The number of rows inserted
+        """
+        columns = self._names() + [ROW_HASH]
+        query = """
+            INSERT INTO imports.`{table}` ({columns})
+            SELECT {staged} FROM imports.`{staging}` s
+            LEFT JOIN imports.`{table}` t ON {match}
+            WHERE t.`{row_id}` IS NULL;
+            """.format(table=self.table, staging=self.staging, match=self._match(),
+                       columns=','.join('`{}`'.format(c) for c in columns),
+                       staged=','.join('s.`{}`'.format(c) for c in columns),
+                       row_id=ROW_ID)
+        return self.connection.execute(query).rowcount
+
+    def _profile(self):
+        """
+        Profile every column of the updated table again. The profiles taken
+        when it was loaded only covered the first version of the file, so
+        they're replaced with ones counted over the whole table, which
+        takes a single scan of it.
+
+        Returns:
+            A list of profile dicts, one per column, like the ones
+            ColumnState.profile() makes
+        """
+        aggregates = []
+        for column in self.columns:
+            name = '`{}`'.format(column['name'])
+            # Booleans don't get a smallest and largest value
+            extremes = ('NULL', 'NULL') if column.get('datatype') == 'boolean' \
+                else ('MIN({})'.format(name), 'MAX({})'.format(name))
+            aggregates.extend(['COUNT(*) - COUNT({})'.format(name),
+                               'COUNT(DISTINCT {})'.format(name),
+                               extremes[0], extremes[1],
+                               'MAX(CHAR_LENGTH({}))'.format(name)])
+        row = self.connection.execute('SELECT {} FROM imports.`{}`;'.format(
+            ', '.join(aggregates), self.table)).first()
+
+        def clean(value):
+            if value is None:
+                return None
+            return str(value)[:MAX_PROFILE_LENGTH]
+
+        profiles = []
+        for i in range(0, len(aggregates), 5):
+            nulls, distinct, low, high, length = row[i:i + 5]
+            profiles.append({'null_count': nulls,
+                             'distinct_count': distinct,
+                             'min_value': clean(low),
+                             'max_value': clean(high),
+                             'max_length': length or 0})
+        return profiles
+
+    def run_update(self):
+        """
+        Load the new version of the file and write the rows that changed.
+        Only one update of a table can run at a time.
+
+        Returns:
+            A two-tuple with (1) a dict with the number of rows read,
+            inserted and updated, and (2) any warnings raised by MySQL
+        """
+        counts = {'read': 0, 'inserted': 0, 'updated': 0}
+        sql_warnings = []
+
+        got_lock = self.connection.execute('SELECT GET_LOCK(%s, 0)', self.lock).scalar()
+        if not got_lock:
+            raise ValueError('Another update of {} is already running'.format(self.table))
+
+        try:
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+
+                self.tracker.forward('Preparing the table for comparison')
+                self._prepare_table()
+                self._widen()
+
+                self.tracker.forward('Loading the file into a staging table')
+                counts['read'] = self._stage()
+                self.tracker.timer.count(bytes=os.path.getsize(self.path),
+                                         rows=counts['read'])
+
+                if self.mode == 'upsert':
+                    self.tracker.forward('Updating changed rows')
+                    counts['updated'] = self._update_changed()
+                    self.tracker.timer.count(rows=counts['updated'])
+
+                self.tracker.forward('Inserting new rows')
+                counts['inserted'] = self._insert_new()
+                self.tracker.timer.count(rows=counts['inserted'])
+
+                if len(w) > 0:
+                    r = re.compile(r'\(.+?\)')
+                    sql_warnings = [r.findall(str(warning))[0] for warning in w]
+        finally:
+            self.connection.execute('DROP TABLE IF EXISTS imports.`{}`;'.format(self.staging))
+            self.connection.execute('SELECT RELEASE_LOCK(%s)', self.lock)
+
+        self.row_count = self.connection.execute(
+            'SELECT COUNT(*) FROM imports.`{}`;'.format(self.table)).scalar()
+
+        # The catalog's profiles and preview describe the table as it was,
+        # so they're taken again now that it has changed
+        self.tracker.forward('Profiling the updated table')
+        for header, profile in zip(self.columns, self._profile()):
+            header['profile'] = profile
+        self.tracker.timer.count(rows=self.row_count)
+        return (counts, sql_warnings)
+
+
+def _download_progress(tracker, size):
+    """
+    Make a boto3 transfer callback that reports bytes downloaded. boto3
+    calls it from each of its transfer threads with the bytes just received.
+    """
+    lock = threading.Lock()
+    received = [0]
+
+    def callback(n):
+        with lock:
+            received[0] += n
+            done = received[0]
+        tracker.advance(done, size, '{} of {} MB'.format(_megabytes(done),
+                                                         _megabytes(size)))
+    return callback
+
+def _download(tracker, s3_path, workspace, analyzer=None):
+    """
+    Download the temporary file from S3 into a directory of its own, so that
+    tasks running side by side can't clobber each other. Compressed uploads
+    are decompressed on the way, and fed to the analyzer if there is one.
+
+    Returns:
+        The local path to the CSV
+    """
+    s3 = S3Manager(None, None, BUCKET_NAME)
+    local_path = workspace.path('data.csv')
+    try:
+        size = s3.client.head_object(Bucket=BUCKET_NAME, Key=s3_path)['ContentLength']
+        s3.download_file(s3_path, local_path,
+                         callback=_download_progress(tracker, size),
+                         analyzer=analyzer)
+        tracker.timer.count(bytes=size)
+    except botocore.exceptions.ClientError:
+        workspace.cleanup()
+        error_message = 'Upload failed. Unable to download temporary file from S3'
+        raise ValueError(error_message)
+    except (zlib.error, ValueError) as e:
+        workspace.cleanup()
+        raise ValueError('Upload failed. Unable to decompress the file: {}'.format(e))
+
+    return local_path
+
+
+def _preview_json(result):
+    """
+    Serialize a task's preview rows to store them with the table. They hold
+    raw values from MySQL, like dates and Decimals, which json can't
+    serialize as they are
+    """
+    return json.dumps([[_jsonable(v) for v in row]
+                       for row in result.get('preview_data', [])])
+
+
+def register_table(task_id, user_id, table_name, headers, result, params):
+    """
+    Write the catalog records for a loaded table: the table, its contact and
+    its columns. This happens once per load, in one transaction. The table is
+    keyed on the ID of the task that loaded it, so running this again for the
+    same task returns the table already registered instead of a duplicate.
+
+    Args:
+        task_id (string): The ID of the load_infile task
+        user_id (int): The ID of the user who uploaded the file
+        table_name (string): The name of the table in the warehouse
+        headers (dict[]): The headers from the loader, with their names,
+            categories, MySQL types and profiles
+        result (dict): The load's final S3 path, warnings, row count,
+            preview data and stage timings
+        params (dict): The metadata the user entered about the table
+
+    Returns:
+        A two-tuple with the Table and whether it was created
+    """
+    preview = _preview_json(result)
+
+    with transaction.atomic():
+        table, created = Table.objects.get_or_create(task_id=task_id, defaults={
+            'table': table_name,
+            'topic': params['topic'],
+            'user_id': user_id,
+            'source': params['source'],
+            'upload_log': result['warnings'],
+            'path': result['final_s3_path'],
+            'next_update': params['next_update'],
+            'row_count': result.get('row_count'),
+            'profile_sampled': result.get('profile_sampled', False),
+            'preview': preview
+        })
+        if not created:
+            return (table, False)
+
+        Contact.objects.create(
+            table=table,
+            name=params['press_contact'],
+            email=params['press_contact_email'],
+            phone=params['press_contact_number'],
+            contact_type=params['press_contact_type']
+        )
+
+        columns = []
+        for header in headers:
+            profile = header.get('profile', {})
+            columns.append(Column(table=table,
+                                  column=header['name'],
+                                  mysql_type=header['datatype'],
+                                  information_type=header['category'],
+                                  column_size=header['length'],
+                                  null_count=profile.get('null_count'),
+                                  distinct_count=profile.get('distinct_count'),
+                                  min_value=profile.get('min_value'),
+                                  max_value=profile.get('max_value'),
+                                  max_length=profile.get('max_length')))
+        Column.objects.bulk_create(columns)
+
+        LoadTiming.objects.bulk_create([
+            LoadTiming(table=table, position=position, **timing)
+            for position, timing in enumerate(result.get('timings', []))
+        ])
+
+        # Build the FULLTEXT indexes search needs in the background, once the
+        # columns they're built from are committed. The table shows up in
+        # search once they're ready
+        transaction.on_commit(lambda: build_indexes.delay(table.id))
+
+    return (table, True)
+
+
 # bind=True gives us access to this celery task instance through the self 
 # parameter
 @shared_task(bind=True)
-def load_infile(self, s3_path, table_name, headers, **kwargs):
+def load_infile(self, s3_path, table_name, headers, user_id, analysis=None,
+                **kwargs):
     """
     A celery task that accesses a database and executes a LOAD DATA INFILE 
-    query to load a CSV into it.
+    query to load a CSV into it, then registers the table in the catalog.
+    analysis is the UploadAnalyzer summary made while the file was uploaded.
+    If it only covers the start of the file, the whole file is analyzed as
+    it's downloaded. The rest of the keyword arguments are the metadata the
+    user entered about the table.
     """
     tracker = ProgressTracker(self)
     tracker.forward('Downloading data from Amazon S3')
 
-    session = boto3.Session(aws_access_key_id=ACCESS_KEY, 
-                            aws_secret_access_key=SECRET_KEY)
-    s3 = session.resource('s3')
-    bucket = s3.Bucket(BUCKET_NAME)
-
-    # Attempt to download the temporary file from S3
-    try:
-        local_path = os.path.join('/', s3_path)
-        bucket.download_file(s3_path, local_path)
-    except botocore.exceptions.ClientError:
-        error_message = 'Upload failed. Unable to download temporary file from S3'
-        raise ValueError(error_message)
+    workspace = UploadWorkspace(self.request.id)
+    analyzer = None
+    if not (analysis and analysis.get('complete')):
+        analyzer = UploadAnalyzer(sample_size=settings.INFERENCE_SAMPLE_SIZE)
+    local_path = _download(tracker, s3_path, workspace, analyzer)
+    if analyzer:
+        analysis = analyzer.finish()
+    file_size = os.path.getsize(local_path)
 
     # Keep track of progress
     tracker.forward('Connecting to MySQL server')
 
-    loader = Loader(tracker, table_name, headers, local_path)
+    loader = Loader(tracker, table_name, headers, local_path, analysis)
     error = False
 
     try:
@@ -204,7 +1013,11 @@ def load_infile(self, s3_path, table_name, headers, **kwargs):
     except exc.SQLAlchemyError as e:
         r = re.compile(r'\(.+?\)')
         error = {'error': True, 'errorMessage': r.findall(str(e))[1]} 
+        _log_timings(self.request.id, table_name, file_size,
+                     tracker.timer.report(), error=True)
         return {'error': error}
+    finally:
+        workspace.cleanup()
 
     # After the file is successfully uploaded to the DB, copy it from the 
     # tmp/ directory to its final home and delete the temporary file
@@ -215,18 +1028,292 @@ def load_infile(self, s3_path, table_name, headers, **kwargs):
     # Return a preview of the top few rows in the table
     # to check that the casting was correct
     tracker.forward('Querying the table for preview data')
-    preview = loader.get_preview()
+    preview = [list(x) for x in loader.get_preview().fetchall()]
+    tracker.timer.count(rows=len(preview))
 
     # End the MySQL connection
     tracker.forward('Closing the connection to the database')
     loader.end_connection()
 
-    return {'error': False,
+    result = {'error': False,
         'table': table_name,
         'final_s3_path': final_s3_path,
-        'preview_data': [list(x) for x in preview.fetchall()],
+        'preview_data': preview,
+        'row_count': loader.row_count,
+        'profile_sampled': loader.profile_sampled,
+        'headers': headers,
+        'warnings': sql_warnings,
+        'query': create_table_query,
+        'timings': tracker.timer.report()
+    }
+    _log_timings(self.request.id, table_name, file_size, result['timings'])
+
+    tracker.forward('Saving the table to the catalog')
+    table, created = register_table(self.request.id, user_id, table_name,
+                                    headers, result, kwargs)
+    result['table_id'] = table.id
+    return result
+
+
+
+def register_update(task_id, user_id, table, mode, key_columns, result):
+    """
+    Record an update of a table once per update task. The table's row count,
+    preview and column profiles are replaced with ones taken after the
+    update, and any columns it widened get their new types.
+
+    Returns:
+        A two-tuple with the TableUpdate and whether it was created
+    """
+    with transaction.atomic():
+        update, created = TableUpdate.objects.get_or_create(task_id=task_id, defaults={
+            'table': table,
+            'user_id': user_id,
+            'mode': mode,
+            'key_columns': ','.join(key_columns),
+            'path': result['final_s3_path'],
+            'upload_log': result['warnings'],
+            'rows_read': result['read'],
+            'rows_inserted': result['inserted'],
+            'rows_updated': result['updated']
+        })
+        if created:
+            # Keep the catalog's column types in step with any columns the
+            # update widened, and its profiles in step with the new rows
+            for header in result['headers']:
+                fields = {}
+                if header.get('widened'):
+                    fields.update(mysql_type=header['datatype'],
+                                  column_size=header['length'])
+                fields.update(header.get('profile', {}))
+                if fields:
+                    table.column_set.filter(column=header['name']).update(**fields)
+
+            # Saving the table invalidates the search cache for it. The
+            # profiles now cover every row
+            table.row_count = result['row_count']
+            table.preview = _preview_json(result)
+            table.profile_sampled = False
+            table.save(update_fields=['row_count', 'preview', 'profile_sampled'])
+
+    return (update, created)
+
+
+@shared_task(bind=True)
+def update_infile(self, s3_path, table_id, mode, key_columns, user_id,
+                  analysis=None):
+    """
+    A celery task that loads a new version of a file into an existing table,
+    appending the rows that are new, or upserting them on the key columns.
+    Only the rows that changed are written. The file is loaded with the
+    dialect in analysis, its UploadAnalyzer summary, which is completed as
+    the file is downloaded if it only covers the start of it.
+    """
+    table = Table.objects.get(pk=table_id)
+    headers = []
+    for c in table.column_set.order_by('id'):
+        header = {'name': c.column}
+        _set_type(header, '{}({})'.format(c.mysql_type, c.column_size)
+                  if c.column_size else c.mysql_type)
+        headers.append(header)
+
+    tracker = ProgressTracker(self, total=9 + (mode == 'upsert'))
+    tracker.forward('Downloading data from Amazon S3')
+    workspace = UploadWorkspace(self.request.id)
+    # The date formats come from the whole file
+    analyzer = None
+    if not (analysis and analysis.get('complete')):
+        analyzer = UploadAnalyzer(sample_size=settings.INFERENCE_SAMPLE_SIZE)
+    local_path = _download(tracker, s3_path, workspace, analyzer)
+    if analyzer:
+        analysis = analyzer.finish()
+    file_size = os.path.getsize(local_path)
+
+    tracker.forward('Connecting to MySQL server')
+    updater = Updater(tracker, table.table, headers, local_path, mode,
+                      key_columns, analysis)
+
+    try:
+        counts, sql_warnings = updater.run_update()
+        tracker.forward('Querying the table for preview data')
+        preview = [list(x) for x in updater.get_preview().fetchall()]
+    except exc.SQLAlchemyError as e:
+        r = re.compile(r'\(.+?\)')
+        error = {'error': True, 'errorMessage': r.findall(str(e))[1]}
+        _log_timings(self.request.id, table.table, file_size,
+                     tracker.timer.report(), error=True, mode=mode)
+        return {'error': error}
+    except ValueError as e:
+        _log_timings(self.request.id, table.table, file_size,
+                     tracker.timer.report(), error=True, mode=mode)
+        return {'error': {'error': True, 'errorMessage': str(e)}}
+    finally:
+        workspace.cleanup()
+        updater.end_connection()
+
+    # Keep the new version of the file alongside the original
+    tracker.forward('Loading the file into S3')
+    s3 = S3Manager(local_path, table.table, BUCKET_NAME)
+    final_s3_path = s3.copy_final(s3_path)
+
+    result = {'error': False,
+        'table': table.table,
+        'table_id': table.id,
+        'mode': mode,
+        'final_s3_path': final_s3_path,
+        'preview_data': preview,
+        'row_count': updater.row_count,
         'headers': headers,
         'warnings': sql_warnings,
-        'query': create_table_query
+        'timings': tracker.timer.report()
     }
+    result.update(counts)
+    _log_timings(self.request.id, table.table, file_size, result['timings'],
+                 mode=mode)
+
+    tracker.forward('Saving the update to the catalog')
+    register_update(self.request.id, user_id, table, mode, key_columns, result)
+    return result
+
+
+def request_export(table, format):
+    """
+    Get the export of a table in a format for the table's current version.
+    If there isn't one yet, or the last attempt to build it failed or has
+    been building for longer than EXPORT_BUILD_TIMEOUT, start building it.
+
+    Args:
+        table (Table): The table to export
+        format (string): "csv.gz" or "parquet"
+
+    Returns:
+        The TableExport, which may not be ready yet
+    """
+    with transaction.atomic():
+        export, created = (TableExport.objects.select_for_update()
+                           .get_or_create(table=table, format=format,
+                                          version=table.data_version))
+        # A worker that was killed never marks its export as failed
+        timeout = timezone.now() - datetime.timedelta(seconds=settings.EXPORT_BUILD_TIMEOUT)
+        stalled = export.status == 'building' and export.started < timeout
+        if not created and (export.status == 'failed' or stalled):
+            export.status = 'building'
+            export.error = ''
+            export.started = timezone.now()
+            export.save(update_fields=['status', 'error', 'started'])
+            created = True
+
+        if created:
+            transaction.on_commit(lambda: export_table.delay(export.id))
+
+    return export
+
+
+@shared_task(bind=True)
+def export_table(self, export_id):
+    """
+    A celery task that writes a whole table to S3 as a gzipped CSV or a
+    Parquet file, next to the original file. Once it's ready, exports of
+    older versions of the table are deleted.
+    """
+    export = TableExport.objects.select_related('table').get(pk=export_id)
+    table = export.table
+    columns = list(table.column_set.order_by('id'))
+
+    tracker = ProgressTracker(self, total=2)
+    tracker.forward('Exporting {} as {}'.format(table.table, export.format))
+    def progress(n):
+        tracker.update('Exported {:,} rows'.format(n))
+
+    query = 'SELECT {} FROM imports.`{}`'.format(
+        ','.join('`{}`'.format(c.column) for c in columns), table.table)
+    key = export_key(table, export.format, export.version)
+    s3 = S3Manager(None, table.table, BUCKET_NAME)
+    try:
+        rows = SearchManager().stream_query(query, kind='export')
+        if export.format == 'parquet':
+            count = s3.write_parquet(rows, key,
+                                     [(c.mysql_type, c.column_size) for c in columns],
+                                     progress=progress)
+        else:
+            url, count = s3.download_query_results(rows, key, progress=progress)
+    except exc.SQLAlchemyError as e:
+        export.status = 'failed'
+        export.error = str(e)
+        export.save(update_fields=['status', 'error'])
+        return {'error': True, 'errorMessage': str(e)}
+    except Exception as e:
+        # Anything else (S3, pyarrow) is a bug or an outage, so let celery
+        # record it, but don't leave the export building forever
+        export.status = 'failed'
+        export.error = repr(e)
+        export.save(update_fields=['status', 'error'])
+        raise
+
+    export.path = key
+    export.rows = count
+    export.status = 'ready'
+    export.save(update_fields=['path', 'rows', 'status'])
+
+    tracker.forward('Removing old exports')
+    stale = TableExport.objects.filter(table=table, format=export.format,
+                                       version__lt=export.version)
+    for old in stale:
+        if old.path:
+            s3.client.delete_object(Bucket=BUCKET_NAME, Key=old.path)
+        old.delete()
+
+    return {'error': False, 'path': key, 'rows': count}
+
+
+@task_postrun.connect
+def publish_finished(sender=None, task_id=None, state=None, **kwargs):
+    """
+    Tell browsers streaming a load's or update's progress that it's over. They fetch the
+    result from check_task_status.
+    """
+    if sender is not None and sender.name in (load_infile.name, update_infile.name):
+        publish_progress(task_id, state)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def build_indexes(self, table_id):
+    """
+    A celery task that builds the FULLTEXT indexes for a table after it's
+    been loaded, one per group of information types. Search skips the table
+    until its index_status is "ready". Lost connections and other
+    operational errors are retried; anything else marks the table "failed".
+    """
+    table = Table.objects.get(pk=table_id)
+    table.index_status = 'building'
+    table.save(update_fields=['index_status'])
+
+    connection = warehouse.connect()
+    error = None
+    try:
+        index = Index(table_id, connection)
+        index.add_row_id(table.table)
+        groups = index.groups()
+        tracker = ProgressTracker(self, total=len(groups))
+        for data_type in groups:
+            tracker.forward('Building {} index'.format(data_type))
+            index.create_index(data_type, table=table.table)
+    except exc.OperationalError as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e)
+        error = e
+    except exc.SQLAlchemyError as e:
+        error = e
+    finally:
+        connection.close()
+
+    if error is not None:
+        table.index_status = 'failed'
+        table.index_error = str(error)
+        table.save(update_fields=['index_status', 'index_error'])
+        return {'error': True, 'errorMessage': str(error)}
 
+    table.index_status = 'ready'
+    table.index_error = ''
+    table.save(update_fields=['index_status', 'index_error'])
+    return {'error': False, 'indexes': list(groups)}
@@ -1,22 +1,55 @@
 # Standard library imports
 import os
 import re
+import csv
+import json
+import shutil
+import codecs
+import hashlib
+import tempfile
+import gzip
+import io
+import zipfile
+import time
+import datetime
+import importlib
+from decimal import Decimal
+from unittest import skipIf
 
 # Django imports
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
 from django.urls import reverse
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, AnonymousUser
 from django.conf import settings
+from django.utils import timezone
+from django.core.management import call_command
+from django.apps import apps as django_apps
 
 # Third party imports
-from mock import patch
+from mock import patch, MagicMock
+from sqlalchemy import exc
+from sqlalchemy.engine.url import make_url
 import botocore
 
 # Local module imports
-from .views import write_to_db, categorize, check_task_status
+from .views import write_to_db, add_metadata, check_task_status
+from .views import task_progress
+from .views import start_direct_upload, sign_direct_upload, complete_direct_upload
+from .views import start_chunked_upload, upload_chunk, complete_chunked_upload
+from .inference import ColumnState, TypeInferrer, widen_type
+from .analyzer import UploadAnalyzer
+from .utils import TableFormatter
+from .utils import CSVSplitter, S3Manager, Decompressor, file_extension, progress_events
+from .utils import pyarrow, UploadWorkspace, Index, _parquet_type
+from .tasks import Loader, Updater, ProgressTracker, build_indexes, register_table
+from .tasks import register_update
+from .tasks import request_export, export_table, StageTimer, update_infile
 # from .utils import TableFormatter
 # from .tasks import load_infile
-from .models import Table
+from .models import Table, Column, Upload, TableUpdate, TableExport
+from .benchmarks import SyntheticCSV
+from . import benchmarks
+from data_import_tool import warehouse
 
 # Constants
 LOCAL_CSV = os.path.join(settings.BASE_DIR, 'upload', 'test_files', 'vote_data.csv')
@@ -115,6 +148,14 @@ class MockSQLAlchemy(object):
     def create_engine(self, *args, **kwargs):
         return {'connect': MockDBConnection()}
 
+def _download_head(key, local_path, size=1000):
+    """
+    Stands in for S3Manager.download_head by copying the start of the test CSV
+    """
+    with open(LOCAL_CSV) as src, open(local_path, 'w') as dest:
+        dest.write(src.read(size))
+    return local_path
+
 # -----------------------------------------------------------------------------
 # END MOCK CLASSES
 # -----------------------------------------------------------------------------
@@ -149,6 +190,1167 @@ class MockSQLAlchemy(object):
 #             self.assertTrue(c in clean_names)
 
 
+class UploadAnalyzerTestCase(TestCase):
+    """
+    Test that the upload analyzer gets everything it collects right in one
+    pass, however the file is split into blocks
+    """
+    def _analyze(self, data, block_size, **kwargs):
+        analyzer = UploadAnalyzer()
+        for i in range(0, len(data), block_size):
+            analyzer.feed(data[i:i + block_size])
+        return analyzer.finish(**kwargs)
+
+    def test_matches_type_inferrer(self):
+        summary = UploadAnalyzer.from_file(LOCAL_CSV)
+        inferrer = TypeInferrer(LOCAL_CSV)
+        columns = inferrer.infer()
+
+        self.assertEqual(summary['headers'], [c.name for c in columns])
+        self.assertEqual([c['sql_type'] for c in summary['columns']],
+                         [c.sql_type() for c in columns])
+        self.assertEqual([c['profile'] for c in summary['columns']],
+                         [c.profile() for c in columns])
+        self.assertEqual(summary['row_count'], inferrer.row_count)
+        self.assertEqual((summary['delimiter'], summary['line_terminator']), (',', '\r\n'))
+        self.assertEqual(len(summary['sample']), 5)
+        with open(LOCAL_CSV, 'rb') as f:
+            self.assertEqual(summary['sha256'], hashlib.sha256(f.read()).hexdigest())
+
+    def test_dialect_and_block_boundaries(self):
+        """
+        Records should come out the same wherever the blocks break, even in
+        the middle of a quoted value with a line break in it
+        """
+        data = ('name;note;votes\r\n'
+                '"Cox, J";"line\r\nbreak ""quoted""";1\r\n'
+                'Kemp;x;2\r\n'
+                'Lee;y;3')
+        for block_size in (1, 2, 5, 16, len(data)):
+            summary = self._analyze(data, block_size)
+            self.assertEqual(summary['delimiter'], ';')
+            self.assertEqual(summary['line_terminator'], '\r\n')
+            self.assertEqual(summary['headers'], ['name', 'note', 'votes'])
+            self.assertEqual(summary['sample'][0], ['Cox, J', 'line\r\nbreak "quoted"', '1'])
+            self.assertEqual(summary['row_count'], 3)
+            self.assertEqual(summary['columns'][2]['sql_type'], 'TINYINT')
+
+    def test_encoding(self):
+        summary = self._analyze(codecs.BOM_UTF8 + 'name\tcity\nJos\xc3\xa9\tAtlanta\n', 4)
+        self.assertEqual((summary['encoding'], summary['charset']), ('utf-8', 'utf8'))
+        self.assertEqual(summary['headers'], ['name', 'city'])
+        self.assertEqual(summary['delimiter'], '\t')
+
+        summary = self._analyze('name|city\nJos\xe9|Atlanta\n', 4)
+        self.assertEqual((summary['encoding'], summary['charset']), ('cp1252', 'latin1'))
+        self.assertEqual(summary['sample'], [[u'Jos\xe9', 'Atlanta']])
+
+    def test_incomplete(self):
+        """
+        The start of a file should leave out the last record, which may have
+        been cut off, and anything that would need the rest of the file. The
+        types of the columns are still proposed
+        """
+        summary = self._analyze('name,votes\nCox,1\nKemp,2\nLe', 8, complete=False)
+        self.assertEqual(summary['sample'], [['Cox', '1'], ['Kemp', '2']])
+        self.assertFalse(summary['complete'])
+        self.assertEqual([c['sql_type'] for c in summary['columns']], ['VARCHAR(4)', 'TINYINT'])
+        self.assertIsNone(summary['row_count'])
+
+        headers, sample = TableFormatter(LOCAL_CSV).get_column_data()
+        self.assertEqual(headers[0], {'name': 'total_income'})
+        self.assertEqual(len(sample), 5)
+
+
+class TypeInferrerTestCase(TestCase):
+    """
+    Test that the streaming type inferrer picks the right types for each
+    column without loading the file into memory
+    """
+    def test_infer_column_types(self):
+        inferrer = TypeInferrer(LOCAL_CSV)
+        columns = inferrer.infer()
+
+        self.assertEqual([c.name for c in columns],
+                         ['total_income', 'precinct_id', 'tract_id', 'race',
+                          'households'])
+        self.assertEqual([c.type for c in columns],
+                         ['float', 'text', 'text', 'text', 'int'])
+        self.assertEqual(columns[4].sql_type(), 'SMALLINT')
+        self.assertTrue(columns[0].nullable)
+        self.assertTrue(columns[2].sql_type().startswith('VARCHAR('))
+        self.assertEqual(inferrer.row_count, 6387)
+        self.assertFalse(inferrer.sampled)
+
+    def test_sampling(self):
+        """
+        Sampling should leave headroom on lengths and integer ranges
+        """
+        inferrer = TypeInferrer(LOCAL_CSV, sample_size=100)
+        columns = inferrer.infer()
+
+        self.assertTrue(inferrer.sampled)
+        self.assertEqual(inferrer.row_count, 6387)
+        self.assertEqual(columns[4].sql_type(sampled=True), 'BIGINT')
+
+    def test_column_state(self):
+        """
+        Check handling of nulls, leading zeros, booleans and mixed values
+        """
+        zips = ColumnState('zip')
+        for value in ['30303', '', '03062']:
+            zips.update(value)
+        self.assertEqual(zips.type, 'text')
+        self.assertTrue(zips.nullable)
+        self.assertEqual(zips.sql_type(), 'VARCHAR(5)')
+
+        flags = ColumnState('flag')
+        for value in ['Yes', 'no', 'TRUE']:
+            flags.update(value)
+        self.assertEqual(flags.type, 'bool')
+
+        empty = ColumnState('empty')
+        empty.update('')
+        self.assertEqual(empty.type, None)
+
+    def _column(self, values):
+        column = ColumnState('x')
+        for value in values:
+            column.update(value)
+        return column
+
+    def test_widen_type(self):
+        """
+        Columns should only be widened when the new values don't fit
+        """
+        self.assertEqual(widen_type('SMALLINT', 'TINYINT'), 'SMALLINT')
+        self.assertEqual(widen_type('tinyint', 'MEDIUMINT'), 'MEDIUMINT')
+        self.assertEqual(widen_type('decimal(5,2)', 'SMALLINT'), 'DECIMAL(7,2)')
+        self.assertEqual(widen_type('DECIMAL(5,2)', 'DECIMAL(4,1)'), 'DECIMAL(5,2)')
+        self.assertEqual(widen_type('INT', 'DECIMAL(4,3)'), 'DECIMAL(13,3)')
+        self.assertEqual(widen_type('DECIMAL(60,2)', 'DECIMAL(10,8)'), 'DOUBLE')
+        self.assertEqual(widen_type('double', 'BIGINT'), 'double')
+        self.assertEqual(widen_type('DATE', 'DATETIME'), 'DATETIME')
+        self.assertEqual(widen_type('varchar(10)', 'VARCHAR(4)', 4), 'varchar(10)')
+        self.assertEqual(widen_type('VARCHAR(10)', 'VARCHAR(30)', 30), 'VARCHAR(30)')
+        self.assertEqual(widen_type('TINYINT', 'VARCHAR(6)', 6), 'VARCHAR(6)')
+        self.assertEqual(widen_type('DATE', 'TINYINT', 3), 'VARCHAR(10)')
+        self.assertEqual(widen_type('TEXT', 'VARCHAR(30)', 30), 'TEXT')
+
+    def test_compact_types(self):
+        """
+        Numbers should get the smallest type that holds every value, and
+        dates should be recognized in the formats we can load them from
+        """
+        self.assertEqual(self._column(['1', '-128', '127']).sql_type(), 'TINYINT')
+        self.assertEqual(self._column(['1', '128']).sql_type(), 'SMALLINT')
+        self.assertEqual(self._column(['1', '40000']).sql_type(), 'MEDIUMINT')
+        self.assertEqual(self._column(['-9000000']).sql_type(), 'INT')
+        self.assertEqual(self._column(['2147483648']).sql_type(), 'BIGINT')
+
+        self.assertEqual(self._column(['9.5', '100.25', '-3']).sql_type(), 'DECIMAL(5,2)')
+        self.assertEqual(self._column(['.5']).sql_type(), 'DECIMAL(1,1)')
+        self.assertEqual(self._column(['9.5', '1e10']).sql_type(), 'DOUBLE')
+        self.assertEqual(self._column(['9.5']).sql_type(sampled=True), 'DOUBLE')
+
+        dates = self._column(['2016-01-02', '2016-12-31'])
+        self.assertEqual((dates.sql_type(), dates.date_format), ('DATE', None))
+        dates = self._column(['1/2/2016', '12/31/2016', ''])
+        self.assertEqual((dates.sql_type(), dates.date_format), ('DATE', '%m/%d/%Y'))
+        # Day first dates can't be read month first
+        self.assertEqual(self._column(['1/2/2016', '31/12/2016']).type, 'text')
+
+        times = self._column(['2016-01-02 15:04:05', '2016-01-02T15:04'])
+        self.assertEqual((times.sql_type(), times.date_format), ('DATETIME', None))
+        times = self._column(['1/2/2016 3:04 PM', '12/31/2016 11:59 am'])
+        self.assertEqual((times.sql_type(), times.date_format),
+                         ('DATETIME', '%m/%d/%Y %h:%i %p'))
+
+    def test_profile(self):
+        """
+        Profiles should compare numbers as numbers and estimate distinct values
+        """
+        amounts = ColumnState('amount')
+        for value in ['9.5', '', '10', '100.25', '9.5']:
+            amounts.update(value)
+        self.assertEqual(amounts.profile(), {'null_count': 1,
+                                             'distinct_count': 3,
+                                             'min_value': '9.5',
+                                             'max_value': '100.25',
+                                             'max_length': 6})
+
+        names = ColumnState('name')
+        for i in range(50000):
+            names.update('name {}'.format(i % 20000))
+        profile = names.profile()
+        self.assertEqual(profile['min_value'], 'name 0')
+        self.assertEqual(profile['max_value'], 'name 9999')
+        self.assertTrue(abs(profile['distinct_count'] - 20000) < 20000 * 0.05)
+
+
+class S3ManagerTestCase(TestCase):
+    """
+    Test the S3Manager methods that stream files to S3
+    """
+    @override_settings(S3_PART_SIZE=1024)
+    @patch('upload.utils.boto3')
+    def test_download_query_results(self, mock_boto):
+        """
+        Results should be gzipped and sent in parts as they're written
+        """
+        client = mock_boto.client.return_value
+        client.create_multipart_upload.return_value = {'UploadId': 'abc'}
+        client.upload_part.side_effect = lambda **kwargs: {'ETag': str(kwargs['PartNumber'])}
+        client.generate_presigned_url.return_value = 'http://test-url.com'
+
+        rows = [['id', 'name']] + [[i, u'Jos\xe9 {}'.format(os.urandom(8).encode('hex'))]
+                                   for i in range(2000)]
+        progress = MagicMock()
+
+        s3 = S3Manager(None, None, 'bucket')
+        url, count = s3.download_query_results(iter(rows), 'exports/x.csv.gz',
+                                               progress=progress)
+
+        self.assertEqual(url, 'http://test-url.com')
+        self.assertEqual(count, 2000)
+        parts = [c[1] for c in client.upload_part.call_args_list]
+        self.assertTrue(len(parts) > 1)
+        self.assertTrue(progress.called)
+
+        # The parts should add up to a single gzipped CSV
+        body = ''.join(p['Body'] for p in parts)
+        csv_rows = list(csv.reader(gzip.GzipFile(fileobj=io.BytesIO(body))))
+        self.assertEqual(csv_rows[0], ['id', 'name'])
+        self.assertEqual(len(csv_rows), 2001)
+        self.assertEqual(csv_rows[1][1].decode('utf-8'), rows[1][1])
+
+        completed = client.complete_multipart_upload.call_args[1]
+        self.assertEqual(len(completed['MultipartUpload']['Parts']), len(parts))
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    @patch('upload.utils.boto3')
+    def test_write_parquet(self, mock_boto):
+        """
+        Rows should be written to Parquet with types from their columns
+        """
+        written = {}
+        def upload_file(path, bucket, key, ExtraArgs=None):
+            written['table'] = pyarrow.parquet.read_table(path).to_pydict()
+        mock_boto.client.return_value.upload_file.side_effect = upload_file
+
+        rows = [['name', 'amount', 'price', 'day', 'seen']]
+        rows += [[u'Jos\xe9', i, Decimal('1.25'), datetime.date(2017, 3, 1),
+                  datetime.datetime(2017, 3, 1, 12, 30)] for i in range(10)]
+        rows += [[None, None, None, '0000-00-00', None]]
+        types = [('varchar', '20'), ('int', None), ('decimal', '5,2'), ('date', None),
+                 ('datetime', None)]
+        s3 = S3Manager(None, None, 'bucket')
+        count = s3.write_parquet(iter(rows), 'x.parquet', types)
+
+        self.assertEqual(count, 11)
+        self.assertEqual(written['table']['amount'], list(range(10)) + [None])
+        self.assertEqual(written['table']['name'][0], u'Jos\xe9')
+        self.assertEqual(written['table']['price'][0], Decimal('1.25'))
+        self.assertEqual(written['table']['day'][0], datetime.date(2017, 3, 1))
+        self.assertEqual(written['table']['day'][-1], None)
+        self.assertEqual(written['table']['seen'][0], datetime.datetime(2017, 3, 1, 12, 30))
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_types(self):
+        """
+        Columns should keep their MySQL types in Parquet where it has them
+        """
+        self.assertEqual(_parquet_type('decimal', '10,2'), pyarrow.decimal128(10, 2))
+        # Parquet decimals can't hold more than 38 digits
+        self.assertEqual(_parquet_type('decimal', '65,2'), pyarrow.string())
+        self.assertEqual(_parquet_type('date'), pyarrow.date32())
+        self.assertEqual(_parquet_type('timestamp'), pyarrow.timestamp('us'))
+
+    @patch('upload.utils.boto3')
+    def test_download_compressed_file(self, mock_boto):
+        """
+        Compressed files should be decompressed as they're downloaded
+        """
+        with open(LOCAL_CSV, 'rb') as f:
+            data = f.read()
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(data)
+
+        client = mock_boto.client.return_value
+        client.get_object.return_value = {'Body': io.BytesIO(buf.getvalue())}
+        callback = MagicMock()
+        local_path = os.path.join(tempfile.mkdtemp(), 'data.csv')
+        try:
+            s3 = S3Manager(None, None, 'bucket')
+            analyzer = UploadAnalyzer()
+            s3.download_file('tmp/x/data.csv.gz', local_path, callback=callback,
+                             analyzer=analyzer)
+            with open(local_path, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            # The CSV is analyzed as it's written
+            self.assertEqual(analyzer.finish()['row_count'], 6387)
+        finally:
+            shutil.rmtree(os.path.dirname(local_path))
+
+        self.assertEqual(sum(c[0][0] for c in callback.call_args_list), len(buf.getvalue()))
+        self.assertFalse(client.download_file.called)
+
+    @patch('upload.utils.boto3')
+    def test_download_query_results_aborted(self, mock_boto):
+        """
+        The multipart upload should be aborted if the query fails
+        """
+        client = mock_boto.client.return_value
+        client.create_multipart_upload.return_value = {'UploadId': 'abc'}
+
+        def rows():
+            yield ['id']
+            raise exc.OperationalError('SELECT', {}, Exception('Lost connection'))
+
+        s3 = S3Manager(None, None, 'bucket')
+        with self.assertRaises(exc.OperationalError):
+            s3.download_query_results(rows(), 'exports/x.csv.gz')
+        self.assertTrue(client.abort_multipart_upload.called)
+        self.assertFalse(client.complete_multipart_upload.called)
+
+
+class DecompressorTestCase(TestCase):
+    """
+    Test that compressed uploads can be read a block at a time
+    """
+    def setUp(self):
+        with open(LOCAL_CSV, 'rb') as f:
+            self.data = f.read()
+
+    def _decompress(self, compressed, extension, block_size=1000):
+        decompressor = Decompressor(extension)
+        out = [decompressor.decompress(compressed[i:i + block_size])
+               for i in range(0, len(compressed), block_size)]
+        return ''.join(out) + decompressor.flush()
+
+    def _zip(self, compression):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', compression) as z:
+            z.writestr('vote_data.csv', self.data)
+            z.writestr('other.csv', 'a,b\n1,2\n')
+        return buf.getvalue()
+
+    def test_gzip(self):
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(self.data)
+        self.assertEqual(self._decompress(buf.getvalue(), '.csv.gz'), self.data)
+
+    def test_multi_member_gzip(self):
+        """
+        Concatenated gzip members should all be read, wherever the blocks
+        break, and zeros padding the end should be ignored
+        """
+        def gz(data):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(data)
+            return buf.getvalue()
+
+        compressed = gz('a,b\n1,2\n') + gz('3,4\n5,6\n') + '\x00' * 16
+        for block_size in (1, 7, len(compressed)):
+            self.assertEqual(self._decompress(compressed, '.csv.gz', block_size),
+                             'a,b\n1,2\n3,4\n5,6\n')
+
+    def test_zip(self):
+        # Only the first file in the archive is read
+        for compression in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+            self.assertEqual(self._decompress(self._zip(compression), '.zip', 7),
+                             self.data)
+
+    def test_head(self):
+        """
+        The start of a compressed file should decompress to the start of
+        the CSV
+        """
+        head = Decompressor('.zip').decompress(self._zip(zipfile.ZIP_DEFLATED)[:2000])
+        self.assertTrue(len(head) > 0)
+        self.assertTrue(self.data.startswith(head))
+
+    def test_not_a_zip(self):
+        with self.assertRaises(ValueError):
+            Decompressor('.zip').decompress(self.data)
+
+    def test_file_extension(self):
+        self.assertEqual(file_extension('Votes.CSV.GZ'), '.csv.gz')
+        self.assertEqual(file_extension('votes.zip'), '.zip')
+        self.assertEqual(file_extension('votes.csv'), '.csv')
+        self.assertEqual(file_extension('votes.xlsx'), None)
+
+
+class CSVSplitterTestCase(TestCase):
+    """
+    Test that CSVSplitter only breaks files on record boundaries, so that the
+    chunks can be loaded in parallel
+    """
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def _read_chunks(self, splitter):
+        rows = []
+        for i, path in splitter.split():
+            with open(path, 'rb') as f:
+                rows.extend(csv.reader(f))
+        return rows
+
+    def test_split(self):
+        splitter = CSVSplitter(LOCAL_CSV, 10000, self.workspace)
+        rows = self._read_chunks(splitter)
+
+        with open(LOCAL_CSV, 'rb') as f:
+            expected = list(csv.reader(f))[1:]
+
+        self.assertEqual(rows, expected)
+        self.assertTrue(len(os.listdir(self.workspace)) > 1)
+
+    def test_quoted_newlines(self):
+        """
+        Line breaks inside quoted fields shouldn't end a chunk
+        """
+        path = os.path.join(self.workspace, 'quoted.csv')
+        expected = [['id', 'note']]
+        expected += [[str(i), 'a "quoted"\nvalue, {}'.format(i)] for i in range(100)]
+        with open(path, 'wb') as f:
+            csv.writer(f).writerows(expected)
+
+        rows = self._read_chunks(CSVSplitter(path, 1, self.workspace))
+        self.assertEqual(rows, expected[1:])
+
+
+class BenchmarkTestCase(TestCase):
+    """
+    Test the synthetic CSVs and the benchmark runner
+    """
+    def test_synthetic_csv(self):
+        workspace = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(workspace, name) for name in ('a.csv', 'b.csv')]
+            for path in paths:
+                SyntheticCSV(rows=500, columns=7, quote_rate=0.5, seed=3).write(path)
+
+            with open(paths[0], 'rb') as a, open(paths[1], 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+            with open(paths[0], 'rb') as f:
+                rows = list(csv.reader(f))
+        finally:
+            shutil.rmtree(workspace)
+
+        # Quoted line breaks don't add rows
+        self.assertEqual(len(rows), 501)
+        self.assertTrue(all(len(row) == 7 for row in rows))
+
+    def test_run(self):
+        report = benchmarks.run(rows=2000, columns=6, only=['infer_types', 'load_infile_parallel'])
+
+        self.assertEqual([r['name'] for r in report['results']],
+                         ['infer_types', 'load_infile_parallel'])
+        for result in report['results']:
+            self.assertNotIn('error', result)
+            self.assertEqual(result['rows'], 2000)
+            self.assertTrue(result['rows_per_second'] > 0)
+            self.assertTrue(result['peak_rss_kb'] > 0)
+        json.dumps(report)
+
+
+class LoaderTestCase(TestCase):
+    """
+    Test the queries Loader sends to the data warehouse
+    """
+    def _headers(self):
+        names = ['total_income', 'precinct_id', 'tract_id', 'race', 'households']
+        return [{'name': n, 'category': None} for n in names]
+
+    def _mock_rowcount(self, mock_warehouse):
+        connection = mock_warehouse.get_engine.return_value.connect.return_value
+        connection.execute.return_value.rowcount = 100
+
+    @patch('upload.tasks.warehouse')
+    def test_single_load(self, mock_warehouse):
+        self._mock_rowcount(mock_warehouse)
+        loader = Loader(MagicMock(), 'votes', self._headers(), LOCAL_CSV)
+        loader.run_load_infile()
+
+        queries = [c[0][0] for c in loader.connection.execute.call_args_list]
+        self.assertTrue(queries[0].startswith('CREATE TABLE imports.votes'))
+        self.assertIn('_row_id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY', queries[0])
+        loads = [q for q in queries if 'LOAD DATA' in q]
+        self.assertEqual(len(loads), 1)
+        # The row IDs are left for MySQL to fill in, and numbers are read
+        # into variables so that null tokens become NULL
+        self.assertIn('(@c0,`precinct_id`,`tract_id`,`race`,@c4) SET `total_income` = '
+                      'IF(LOWER(TRIM(@c0)) IN ("", "na", "n/a", "none", "null", ".", "\\\\n"), '
+                      'NULL, TRIM(@c0)),', loads[0])
+
+    @override_settings(INFERENCE_SAMPLE_SIZE=100)
+    @patch('upload.tasks.warehouse')
+    def test_sampled_profile(self, mock_warehouse):
+        """
+        A load that only inspected a sample of the rows should say that its
+        profiles are estimates
+        """
+        self._mock_rowcount(mock_warehouse)
+        loader = Loader(MagicMock(), 'votes', self._headers(), LOCAL_CSV)
+        loader.run_load_infile()
+        self.assertTrue(loader.profile_sampled)
+        self.assertEqual(loader.row_count, 6387)
+
+    @patch('upload.tasks.TypeInferrer')
+    @patch('upload.tasks.warehouse')
+    def test_load_with_analysis(self, mock_warehouse, mock_inferrer):
+        """
+        The types and dialect found while the file was uploaded should be
+        used instead of reading the file again
+        """
+        self._mock_rowcount(mock_warehouse)
+        analysis = UploadAnalyzer.from_file(LOCAL_CSV)
+        analysis.update(delimiter='\t', line_terminator='\r\n', charset='latin1')
+        loader = Loader(MagicMock(), 'votes', self._headers(), LOCAL_CSV, analysis)
+        loader.run_load_infile()
+
+        self.assertFalse(mock_inferrer.called)
+        self.assertEqual(loader.row_count, 6387)
+        self.assertEqual(loader.columns[4]['datatype'], 'smallint')
+        queries = [c[0][0] for c in loader.connection.execute.call_args_list]
+        load = [q for q in queries if 'LOAD DATA' in q][0]
+        self.assertIn('CHARACTER SET latin1', load)
+        self.assertIn('FIELDS TERMINATED BY "\\t" OPTIONALLY ENCLOSED BY "\\""', load)
+        self.assertIn('LINES TERMINATED BY "\\r\\n"', load)
+
+    @patch('upload.tasks.warehouse')
+    def test_compact_types(self, mock_warehouse):
+        """
+        Booleans and dates should be created as native types and converted
+        as they're loaded, and columns the user asked for as text should
+        stay text
+        """
+        analyzer = UploadAnalyzer()
+        analyzer.feed('zip,flag,day,amount\n'
+                      '30303,yes,1/2/2016,9.50\n'
+                      '30305,no,12/31/2016,NA\n')
+        analysis = analyzer.finish()
+        headers = [{'name': 'zip', 'type': 'text'}, {'name': 'flag'},
+                   {'name': 'day'}, {'name': 'amount', 'type': 'auto'}]
+        loader = Loader(MagicMock(), 'votes', headers, LOCAL_CSV, analysis)
+
+        create = loader._make_create_table_q()
+        self.assertIn('zip VARCHAR(5), flag BOOLEAN, day DATE, amount DECIMAL(3,2),', create)
+        self.assertEqual([c['datatype'] for c in loader.columns],
+                         ['varchar', 'boolean', 'date', 'decimal'])
+        self.assertEqual(loader.columns[3]['length'], '3,2')
+
+        load = loader._make_load_table_q()
+        self.assertIn('(`zip`,@c1,@c2,@c3)', load)
+        self.assertIn('`flag` = IF(LOWER(TRIM(@c1)) IN ("", "na", "n/a", "none", "null", ".", "\\\\n"), '
+                      'NULL, LOWER(TRIM(@c1)) IN ("true", "t", "yes", "y"))', load)
+        self.assertIn('STR_TO_DATE(TRIM(@c2), "%%m/%%d/%%Y")', load)
+
+    @override_settings(LOAD_PARALLEL_THRESHOLD=0, LOAD_CHUNK_SIZE=50000)
+    @patch('upload.tasks.warehouse')
+    def test_parallel_load(self, mock_warehouse):
+        """
+        Big files should be loaded chunk by chunk straight into the table
+        """
+        self._mock_rowcount(mock_warehouse)
+        tracker = MagicMock()
+        loader = Loader(tracker, 'votes', self._headers(), LOCAL_CSV)
+        loader.run_load_infile()
+
+        # The mock engine hands out the same connection every time, so every
+        # query ends up in the same list
+        queries = [c[0][0] for c in loader.connection.execute.call_args_list]
+        loads = [q for q in queries if 'LOAD DATA' in q]
+
+        self.assertTrue(len(loads) > 1)
+        self.assertTrue(all('IGNORE 0 LINES' in q for q in loads))
+        self.assertTrue(all('INTO TABLE imports.votes\n' in q for q in loads))
+        # Nothing is written a second time
+        self.assertFalse([q for q in queries if q.startswith('INSERT INTO')
+                          or 'CREATE TABLE imports.votes__' in q])
+
+        # Progress is reported in bytes and rows as each chunk finishes
+        done, size, detail = tracker.advance.call_args[0]
+        self.assertEqual(done, size)
+        self.assertEqual(detail, '{:,} rows, {} of {} chunks'.format(
+            100 * len(loads), len(loads), len(loads)))
+
+
+class UpdaterTestCase(TestCase):
+    """
+    Test the queries Updater uses to write only the rows that changed
+    """
+    def _headers(self):
+        names = ['total_income', 'precinct_id', 'tract_id', 'race', 'households']
+        return [{'name': n} for n in names]
+
+    def _queries(self, updater):
+        return [' '.join(c[0][0].split()) for c in updater.connection.execute.call_args_list]
+
+    def _mock_profile(self, updater):
+        # One row of five aggregates per column
+        updater.connection.execute.return_value.first.return_value = \
+            [0] * 5 * len(updater.columns)
+
+    @patch('upload.tasks.warehouse')
+    def test_append(self, mock_warehouse):
+        updater = Updater(MagicMock(), 'votes', self._headers(), LOCAL_CSV, 'append')
+        self._mock_profile(updater)
+        updater.run_update()
+        queries = self._queries(updater)
+
+        # Each staged row gets a hash of its values as it's loaded
+        load = [q for q in queries if 'LOAD DATA' in q][0]
+        self.assertIn('INTO TABLE imports.votes__update', load)
+        self.assertIn('SET `_row_hash` = MD5(CONCAT_WS(0x1f, COALESCE(`total_income`, 0x00),', load)
+
+        # Only rows whose hash isn't in the table yet are inserted, and
+        # nothing is updated
+        insert = [q for q in queries if q.startswith('INSERT INTO')][0]
+        self.assertIn('LEFT JOIN imports.`votes` t ON t.`_row_hash` = s.`_row_hash`', insert)
+        self.assertIn('WHERE t.`_row_id` IS NULL', insert)
+        self.assertFalse([q for q in queries if q.startswith('UPDATE')])
+
+        release = queries.index('SELECT RELEASE_LOCK(%s)')
+        self.assertEqual(queries[release - 1], 'DROP TABLE IF EXISTS imports.`votes__update`;')
+
+    @patch('upload.tasks.warehouse')
+    def test_upsert(self, mock_warehouse):
+        updater = Updater(MagicMock(), 'votes', self._headers(), LOCAL_CSV,
+                          'upsert', ['precinct_id', 'tract_id'])
+        self._mock_profile(updater)
+        updater.run_update()
+        queries = self._queries(updater)
+
+        match = 't.`precinct_id` <=> s.`precinct_id` AND t.`tract_id` <=> s.`tract_id`'
+        update = [q for q in queries if q.startswith('UPDATE imports.`votes` t')][0]
+        self.assertIn('JOIN imports.`votes__update` s ON {}'.format(match), update)
+        self.assertIn('t.`households` = s.`households`, t.`_row_hash` = s.`_row_hash`', update)
+        self.assertIn('WHERE t.`_row_hash` <> s.`_row_hash`', update)
+
+        insert = [q for q in queries if q.startswith('INSERT INTO')][0]
+        self.assertIn('ON {}'.format(match), insert)
+        self.assertTrue(queries.index(update) < queries.index(insert))
+
+    @patch('upload.tasks.warehouse')
+    def test_widen(self, mock_warehouse):
+        """
+        Columns too narrow for the new version of the file should be widened
+        before it's loaded, and the rows hashed again
+        """
+        headers = self._headers()
+        types = ['DOUBLE', 'VARCHAR(8)', 'VARCHAR(5)', 'VARCHAR(8)', 'TINYINT']
+        for header, raw_type in zip(headers, types):
+            header['raw_type'] = raw_type
+        updater = Updater(MagicMock(), 'votes', headers, LOCAL_CSV, 'append',
+                          analysis=UploadAnalyzer.from_file(LOCAL_CSV))
+        self._mock_profile(updater)
+        updater.run_update()
+        queries = self._queries(updater)
+
+        alter = [q for q in queries if q.startswith('ALTER TABLE imports.`votes` MODIFY')][0]
+        self.assertEqual(alter, 'ALTER TABLE imports.`votes` MODIFY `tract_id` VARCHAR(20), '
+                                'MODIFY `households` SMALLINT;')
+        rehash = queries.index(alter) + 1
+        self.assertTrue(queries[rehash].startswith('UPDATE imports.`votes` SET `_row_hash` = MD5('))
+        self.assertTrue(rehash < [i for i, q in enumerate(queries) if 'LOAD DATA' in q][0])
+        self.assertEqual([h['name'] for h in headers if h.get('widened')],
+                         ['tract_id', 'households'])
+        self.assertEqual(headers[4]['datatype'], 'smallint')
+
+    @patch('upload.tasks.warehouse')
+    def test_one_update_at_a_time(self, mock_warehouse):
+        """
+        A second update of the same table should give up instead of sharing
+        the staging table
+        """
+        updater = Updater(MagicMock(), 'votes', self._headers(), LOCAL_CSV, 'append')
+        updater.connection.execute.return_value.scalar.return_value = 0
+        with self.assertRaises(ValueError):
+            updater.run_update()
+
+        self.assertFalse([q for q in self._queries(updater) if 'votes__update' in q])
+
+    @patch('upload.tasks.warehouse')
+    def test_profile(self, mock_warehouse):
+        """
+        The columns should be profiled again over the whole updated table
+        """
+        headers = self._headers()[:2]
+        headers[1]['datatype'] = 'boolean'
+        updater = Updater(MagicMock(), 'votes', headers, LOCAL_CSV, 'append')
+        updater.connection.execute.return_value.first.return_value = \
+            (2, 10, Decimal('1.50'), Decimal('99.25'), 5, 0, 2, None, None, 1)
+        updater.run_update()
+
+        query = [q for q in self._queries(updater) if 'COUNT(DISTINCT' in q][0]
+        self.assertIn('COUNT(*) - COUNT(`total_income`), COUNT(DISTINCT `total_income`), '
+                      'MIN(`total_income`), MAX(`total_income`)', query)
+        self.assertIn('NULL, NULL, MAX(CHAR_LENGTH(`precinct_id`))', query)
+        self.assertEqual(headers[0]['profile'], {'null_count': 2, 'distinct_count': 10,
+                                                 'min_value': '1.50', 'max_value': '99.25',
+                                                 'max_length': 5})
+        self.assertEqual(headers[1]['profile']['min_value'], None)
+
+    @patch('upload.tasks.metrics')
+    @patch('upload.tasks.register_update')
+    @patch('upload.tasks.S3Manager')
+    @patch('upload.tasks._download')
+    @patch('upload.tasks.publish_progress')
+    @patch('upload.tasks.warehouse')
+    def test_update_infile_timings(self, mock_warehouse, mock_publish, mock_download,
+                                   mock_s3, mock_register, mock_metrics):
+        """
+        update_infile should time its stages and log them the way load_infile
+        does
+        """
+        user = User.objects.create_user(username='jonathan', password='mock_pw')
+        table = Table.objects.create(table='votes', user=user, source='Test source',
+                                     path='/test/')
+        for name in ['total_income', 'precinct_id', 'tract_id', 'race', 'households']:
+            Column.objects.create(table=table, column=name, mysql_type='varchar',
+                                  column_size='20')
+        mock_download.return_value = LOCAL_CSV
+        connection = mock_warehouse.get_engine.return_value.connect.return_value
+        connection.execute.return_value.rowcount = 100
+        connection.execute.return_value.scalar.return_value = 1
+        connection.execute.return_value.first.return_value = [0] * 25
+
+        with patch.object(update_infile, 'update_state'):
+            result = update_infile.apply(kwargs={
+                's3_path': 'tmp/abc/data.csv', 'table_id': table.id, 'mode': 'append',
+                'key_columns': [], 'user_id': user.id,
+                'analysis': UploadAnalyzer.from_file(LOCAL_CSV)}).get()
+
+        stages = [t['stage'] for t in result['timings']]
+        self.assertEqual(stages[0], 'Downloading data from Amazon S3')
+        self.assertIn('Inserting new rows', stages)
+        self.assertIn('Profiling the updated table', stages)
+        staged = result['timings'][stages.index('Loading the file into a staging table')]
+        self.assertEqual(staged['bytes'], os.path.getsize(LOCAL_CSV))
+        lines = [json.loads(c[0][0]) for c in mock_metrics.info.call_args_list]
+        self.assertEqual(lines[-1]['event'], 'ingest.total')
+        self.assertEqual(lines[-1]['mode'], 'append')
+        self.assertEqual(len(lines), len(stages) + 1)
+
+
+class RegisterUpdateTestCase(TestCase):
+    def test_widened_columns(self):
+        """
+        Columns the update widened should get their new types in the catalog
+        """
+        user = User.objects.create_user(username='jonathan', password='mock_pw')
+        table = Table.objects.create(table='votes', user=user, source='Test source',
+                                     path='/test/')
+        Column.objects.create(table=table, column='race', mysql_type='varchar',
+                              column_size='5')
+        Column.objects.create(table=table, column='households', mysql_type='tinyint')
+        result = {'final_s3_path': '/test/v2', 'warnings': [], 'read': 2,
+                  'inserted': 2, 'updated': 0, 'row_count': 4,
+                  'headers': [{'name': 'race', 'datatype': 'varchar', 'length': 5},
+                              {'name': 'households', 'datatype': 'smallint',
+                               'length': None, 'widened': True}]}
+        register_update('task-1', user.id, table, 'append', [], result)
+
+        self.assertEqual(table.column_set.get(column='households').mysql_type, 'smallint')
+        self.assertEqual(table.column_set.get(column='race').column_size, '5')
+        self.assertEqual(Table.objects.get(pk=table.id).row_count, 4)
+
+    def test_profiles_and_preview(self):
+        """
+        The table's preview and its columns' profiles should describe it as
+        it is after the update
+        """
+        user = User.objects.create_user(username='jonathan', password='mock_pw')
+        table = Table.objects.create(table='votes', user=user, source='Test source',
+                                     path='/test/', row_count=2, profile_sampled=True,
+                                     preview='[["W", 3]]')
+        Column.objects.create(table=table, column='race', mysql_type='varchar',
+                              column_size='5', null_count=0, distinct_count=1,
+                              min_value='W', max_value='W', max_length=1)
+        profile = {'null_count': 1, 'distinct_count': 3, 'min_value': 'A',
+                   'max_value': 'W', 'max_length': 5}
+        result = {'final_s3_path': '/test/v2', 'warnings': [], 'read': 2,
+                  'inserted': 2, 'updated': 0, 'row_count': 4,
+                  'preview_data': [['W', Decimal('3')], ['Asian', Decimal('7')]],
+                  'headers': [{'name': 'race', 'datatype': 'varchar', 'length': 5,
+                               'profile': profile}]}
+        register_update('task-1', user.id, table, 'append', [], result)
+
+        table = Table.objects.get(pk=table.id)
+        self.assertEqual(table.preview_rows, [['W', '3'], ['Asian', '7']])
+        self.assertFalse(table.profile_sampled)
+        column = table.column_set.get(column='race')
+        self.assertEqual((column.null_count, column.distinct_count, column.min_value,
+                          column.max_length), (1, 3, 'A', 5))
+
+
+class UpdateTableViewTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jonathan',
+                                 email='jonathan.cox.c@gmail.com',
+                                 password='mock_pw')
+        self.client.login(username='jonathan', password='mock_pw')
+        self.table = Table.objects.create(table='votes', user=self.user,
+                                          source='Test source', path='/test/')
+        for name in ['total_income', 'precinct_id', 'tract_id', 'race', 'households']:
+            Column.objects.create(table=self.table, column=name, mysql_type='varchar')
+
+        session = self.client.session
+        session['s3_path'] = 'tmp/abc/data.csv'
+        session.save()
+
+    def test_update_page(self):
+        response = self.client.get(reverse('upload:update', args=[self.table.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'value="precinct_id"')
+
+    @patch('upload.views.S3Manager')
+    @patch('upload.views.update_infile')
+    def test_update(self, mock_task, mock_s3):
+        mock_s3.return_value.download_head.side_effect = _download_head
+        mock_task.delay.return_value.id = 'task-1'
+        response = self.client.post(reverse('upload:update', args=[self.table.id]),
+                                    {'mode': 'upsert', 'key_columns': ['precinct_id']})
+
+        self.assertEqual(response.status_code, 200)
+        mock_task.delay.assert_called_once_with(s3_path='tmp/abc/data.csv',
+                                                table_id=self.table.id,
+                                                mode='upsert',
+                                                key_columns=['precinct_id'],
+                                                user_id=self.user.id,
+                                                analysis=self.client.session['analysis'])
+        self.assertEqual(self.client.session['analysis']['delimiter'], ',')
+        self.assertEqual(self.client.session['task_id'], 'task-1')
+
+    @patch('upload.views.update_infile')
+    def test_owner_only(self, mock_task):
+        """
+        Only the user who uploaded a table, or staff, should be able to
+        update it
+        """
+        other = User.objects.create_user(username='other', password='mock_pw')
+        self.client.login(username='other', password='mock_pw')
+        url = reverse('upload:update', args=[self.table.id])
+        self.assertRedirects(self.client.get(url),
+                             reverse('upload:detail', args=[self.table.id]),
+                             fetch_redirect_response=False)
+        self.client.post(url, {'mode': 'append'})
+        self.assertFalse(mock_task.delay.called)
+
+        other.is_staff = True
+        other.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_missing_table(self):
+        response = self.client.get(reverse('upload:update', args=[self.table.id + 1]))
+        self.assertEqual(response.status_code, 404)
+
+    @patch('upload.views.update_infile')
+    def test_upsert_needs_key(self, mock_task):
+        response = self.client.post(reverse('upload:update', args=[self.table.id]),
+                                    {'mode': 'upsert'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(mock_task.delay.called)
+
+    @patch('upload.views.S3Manager')
+    @patch('upload.views.update_infile')
+    def test_columns_must_match(self, mock_task, mock_s3):
+        mock_s3.return_value.download_head.side_effect = _download_head
+        Column.objects.filter(column='race').delete()
+        response = self.client.post(reverse('upload:update', args=[self.table.id]),
+                                    {'mode': 'append'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(mock_task.delay.called)
+
+
+class ProgressTestCase(TestCase):
+    """
+    Test that task progress is pushed to the browser as it happens
+    """
+    @patch('upload.tasks.publish_progress')
+    def test_tracker_publishes(self, mock_publish):
+        task = MagicMock()
+        task.request.id = 'abc'
+        tracker = ProgressTracker(task, total=2)
+        tracker.forward('Downloading data from Amazon S3')
+
+        meta = {'message': 'Downloading data from Amazon S3', 'error': False,
+                'current': 1, 'total': 2}
+        task.update_state.assert_called_with(state='PROGRESS', meta=meta)
+        mock_publish.assert_called_with('abc', 'PROGRESS', meta)
+
+    @override_settings(PROGRESS_INTERVAL=60)
+    @patch('upload.tasks.publish_progress')
+    def test_tracker_throttles(self, mock_publish):
+        """
+        Progress within a stage should be sent at most once per interval, and
+        new stages should be sent right away
+        """
+        task = MagicMock()
+        tracker = ProgressTracker(task, total=2)
+        tracker.forward('Downloading data from Amazon S3')
+        for n in range(1, 101):
+            tracker.advance(n, 100, '{} of 100 MB'.format(n))
+        self.assertEqual(task.update_state.call_count, 1)
+
+        tracker.add_stages(1)
+        tracker.forward('Merging chunks')
+        meta = task.update_state.call_args[1]['meta']
+        self.assertEqual((meta['current'], meta['total']), (2, 3))
+
+        tracker.last_sent = 0
+        tracker.advance(50, 100, 'chunk 1 of 2')
+        meta = task.update_state.call_args[1]['meta']
+        self.assertEqual(meta['current'], 2.5)
+        self.assertEqual(meta['message'], 'Merging chunks (chunk 1 of 2)')
+
+    def test_stage_timer(self):
+        """
+        Each stage should be timed from its start to the start of the next,
+        with the amount of data it went through
+        """
+        timer = StageTimer()
+        timer.count(rows=5)  # Nothing to count before the first stage
+        timer.start('Downloading data from Amazon S3')
+        timer.count(bytes=1024)
+        timer.start('Loading the file into MySQL')
+        timer.count(bytes=1000, rows=10)
+        stages = timer.report()
+
+        self.assertEqual([s['stage'] for s in stages],
+                         ['Downloading data from Amazon S3', 'Loading the file into MySQL'])
+        self.assertEqual((stages[0]['bytes'], stages[0]['rows']), (1024, None))
+        self.assertEqual((stages[1]['bytes'], stages[1]['rows']), (1000, 10))
+        for stage in stages:
+            self.assertGreaterEqual(stage['wall_seconds'], 0)
+            self.assertGreaterEqual(stage['cpu_seconds'], 0)
+            self.assertGreater(stage['max_rss_kb'], 0)
+            self.assertIn('rss_growth_kb', stage)
+        self.assertEqual(timer.report(), stages)
+
+    @patch('upload.tasks._current_rss_kb')
+    def test_stage_timer_memory(self, mock_rss):
+        """
+        A stage's memory should be the most the process held while it ran,
+        not the most it has ever held
+        """
+        mock_rss.side_effect = [1000, 5000, 1500, 1200, 1200, 1100]
+        timer = StageTimer()
+        timer.start('Loading the file into MySQL')
+        timer.sample()
+        timer.sample()
+        timer.start('Closing the connection to the database')
+        stages = timer.report()
+
+        self.assertEqual((stages[0]['max_rss_kb'], stages[0]['rss_growth_kb']), (5000, 200))
+        # Memory freed during a stage shows up as negative growth
+        self.assertEqual((stages[1]['max_rss_kb'], stages[1]['rss_growth_kb']), (1200, -100))
+
+    @patch('upload.utils.AsyncResult')
+    @patch('upload.utils.get_redis')
+    def test_progress_events(self, mock_redis, mock_result):
+        """
+        The stream should start with the current state and end when the task
+        does
+        """
+        mock_result.return_value.state = 'PROGRESS'
+        mock_result.return_value.info = {'current': 1, 'total': 8}
+        pubsub = mock_redis.return_value.pubsub.return_value
+        pubsub.get_message.side_effect = [
+            None,
+            {'data': json.dumps({'status': 'PROGRESS', 'result': {'current': 2, 'total': 8}})},
+            {'data': json.dumps({'status': 'SUCCESS', 'result': None})},
+            {'data': json.dumps({'status': 'PROGRESS', 'result': {'current': 3, 'total': 8}})}
+        ]
+
+        events = list(progress_events('abc'))
+
+        pubsub.subscribe.assert_called_with('task-progress:abc')
+        data = [json.loads(e[len('data: '):]) for e in events if e.startswith('data: ')]
+        self.assertEqual([d['status'] for d in data], ['PROGRESS', 'PROGRESS', 'SUCCESS'])
+        self.assertEqual(data[0]['result'], {'current': 1, 'total': 8})
+        self.assertTrue(pubsub.close.called)
+
+    @patch('upload.utils.AsyncResult')
+    @patch('upload.utils.get_redis')
+    def test_progress_events_finished(self, mock_redis, mock_result):
+        """
+        A task that finished before the browser connected should end the
+        stream straight away
+        """
+        mock_result.return_value.state = 'SUCCESS'
+        events = list(progress_events('abc'))
+        self.assertEqual(json.loads(events[-1][len('data: '):]),
+                         {'status': 'SUCCESS', 'result': None})
+        pubsub = mock_redis.return_value.pubsub.return_value
+        self.assertFalse(pubsub.get_message.called)
+
+
+class BuildIndexesTestCase(TestCase):
+    """
+    Test the task that makes loaded tables searchable
+    """
+    def setUp(self):
+        user = User.objects.create_user(username='jonathan', password='mock_pw')
+        self.table = Table.objects.create(table='contracts', user=user,
+                                          source='test')
+        columns = [('company', 'organization_name'), ('city', 'city_add'),
+                   ('amount', None), ('ceo', 'corp_or_person_name'),
+                   ('street', 'street_add')]
+        for name, information_type in columns:
+            Column.objects.create(table=self.table, column=name,
+                                  mysql_type='varchar',
+                                  information_type=information_type)
+
+    @patch('upload.tasks.ProgressTracker')
+    @patch('upload.tasks.warehouse')
+    def test_build_indexes(self, mock_warehouse, mock_tracker):
+        """
+        One index should be built per information type, and the table marked
+        ready
+        """
+        connection = mock_warehouse.connect.return_value
+        connection.execute.return_value.fetchall.return_value = []
+
+        result = build_indexes.apply(args=[self.table.id]).get()
+
+        queries = [c[0][0].strip() for c in connection.execute.call_args_list]
+        alters = [q for q in queries if q.startswith('ALTER')]
+        self.assertEqual(alters, [
+            'ALTER TABLE imports.`contracts` ADD COLUMN `_row_id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY',
+            'ALTER TABLE imports.`contracts` ADD FULLTEXT INDEX `name_index` (`company`,`ceo`)',
+            'ALTER TABLE imports.`contracts` ADD FULLTEXT INDEX `add_index` (`city`,`street`)'
+        ])
+        self.assertEqual(result, {'error': False, 'indexes': ['name', 'add']})
+        self.assertEqual(Table.objects.get(pk=self.table.id).index_status, 'ready')
+        self.assertTrue(connection.close.called)
+
+    @patch('upload.tasks.ProgressTracker')
+    @patch('upload.tasks.warehouse')
+    def test_build_indexes_failed(self, mock_warehouse, mock_tracker):
+        """
+        Errors should be recorded on the table instead of leaving it building
+        """
+        connection = mock_warehouse.connect.return_value
+        connection.execute.side_effect = exc.ProgrammingError(
+            'ALTER', {}, Exception('Column cannot be part of FULLTEXT index'))
+
+        result = build_indexes.apply(args=[self.table.id]).get()
+
+        table = Table.objects.get(pk=self.table.id)
+        self.assertTrue(result['error'])
+        self.assertEqual(table.index_status, 'failed')
+        self.assertIn('FULLTEXT', table.index_error)
+
+    def _execute(self, query):
+        """
+        Stands in for the warehouse: contracts has its row ID and both of its
+        indexes, and every other table has neither
+        """
+        result = MagicMock()
+        if query == "SHOW COLUMNS FROM imports.`contracts` WHERE Field='_row_id'":
+            result.fetchall.return_value = [{'Field': '_row_id'}]
+        elif query == 'SHOW INDEX FROM imports.`contracts`':
+            indexes = [('PRIMARY', 'BTREE', '_row_id'),
+                       ('name_index', 'FULLTEXT', 'company'),
+                       ('name_index', 'FULLTEXT', 'ceo'),
+                       ('add_index', 'FULLTEXT', 'city'),
+                       ('add_index', 'FULLTEXT', 'street')]
+            result.__iter__.return_value = [
+                {'Key_name': k, 'Index_type': t, 'Column_name': c} for k, t, c in indexes]
+        else:
+            result.fetchall.return_value = []
+            result.__iter__.return_value = []
+        return result
+
+    def test_is_built(self):
+        connection = MagicMock()
+        connection.execute.side_effect = self._execute
+        self.assertTrue(Index(self.table.id, connection).is_built('contracts'))
+
+        # An index on a different set of columns doesn't count
+        Column.objects.filter(column='amount').update(information_type='contract_add')
+        self.assertFalse(Index(self.table.id, connection).is_built('contracts'))
+
+    @patch('django.db.transaction.on_commit', side_effect=lambda f: f())
+    @patch('upload.tasks.build_indexes')
+    @patch('data_import_tool.warehouse.connect')
+    def test_index_existing_tables(self, mock_connect, mock_build_indexes, mock_on_commit):
+        """
+        Tables from before index_status existed should stay searchable if
+        they're already indexed, and have their indexes built otherwise
+        """
+        mock_connect.return_value.execute.side_effect = self._execute
+        legacy = Table.objects.create(table='votes', user=self.table.user, source='test')
+        built = Table.objects.create(table='donors', user=self.table.user, source='test',
+                                     index_status='ready')
+
+        migration = importlib.import_module('upload.migrations.0018_index_existing_tables')
+        migration.index_existing_tables(django_apps, None)
+
+        self.assertEqual(Table.objects.get(pk=self.table.id).index_status, 'ready')
+        mock_build_indexes.delay.assert_called_once_with(legacy.id)
+        self.assertEqual(Table.objects.get(pk=built.id).index_status, 'ready')
+        self.assertTrue(mock_connect.return_value.close.called)
+
+
+class WarehouseRegistryTestCase(TestCase):
+    """
+    Test that engines for the data warehouse are built once per process
+    """
+    def setUp(self):
+        warehouse.reset()
+
+    def tearDown(self):
+        warehouse.reset()
+
+    @patch('data_import_tool.warehouse.event')
+    @patch('data_import_tool.warehouse.sqlalchemy')
+    def test_get_engine(self, mock_sqlalchemy, mock_event):
+        mock_sqlalchemy.create_engine.side_effect = lambda *a, **kw: MagicMock()
+
+        engine = warehouse.get_engine()
+        self.assertIs(warehouse.get_engine(), engine)
+        self.assertIsNot(warehouse.get_engine(local_infile=True), engine)
+        self.assertEqual(mock_sqlalchemy.create_engine.call_count, 2)
+
+        kwargs = mock_sqlalchemy.create_engine.call_args[1]
+        self.assertEqual(kwargs['pool_recycle'], settings.WAREHOUSE_POOL_RECYCLE)
+
+    @override_settings(DATA_WAREHOUSE_URL='mysql://user:pass@db/imports?charset=utf8')
+    @patch('data_import_tool.warehouse.event')
+    @patch('data_import_tool.warehouse.sqlalchemy')
+    def test_local_infile_url(self, mock_sqlalchemy, mock_event):
+        """
+        Options already in the URL should be kept alongside local_infile
+        """
+        warehouse.get_engine(local_infile=True)
+
+        url = make_url(mock_sqlalchemy.create_engine.call_args[0][0])
+        self.assertEqual(url.query, {'charset': 'utf8', 'local_infile': '1'})
+        self.assertEqual(url.database, 'imports')
+
+    @patch('data_import_tool.warehouse.event')
+    @patch('data_import_tool.warehouse.sqlalchemy')
+    def test_new_process(self, mock_sqlalchemy, mock_event):
+        """
+        A forked process shouldn't reuse its parent's connections
+        """
+        mock_sqlalchemy.create_engine.side_effect = lambda *a, **kw: MagicMock()
+
+        engine = warehouse.get_engine()
+        with patch('data_import_tool.warehouse.os.getpid', return_value=-1):
+            self.assertIsNot(warehouse.get_engine(), engine)
+
+
 class UploadFileViewTestCase(TestCase):
     """
     Test the upload_file view to ensure that it blocks invalid POST data,
@@ -170,9 +1372,9 @@ class UploadFileViewTestCase(TestCase):
         response = self.client.get(reverse('upload:index'))
         self.assertEqual(response.status_code, 200)
 
-    @patch('upload.forms.sqlalchemy')
-    @patch('upload.views.write_tempfile_to_s3', return_value=LOCAL_CSV)
-    def test_index_view_post(self, MockSQLAlchemy, _upload_mock):
+    @patch('upload.forms.warehouse')
+    @patch('upload.views.S3Manager')
+    def test_index_view_post(self, _upload_mock, MockSQLAlchemy):
         """
         Test that a POST request populated with legal data succeeds.
         Ensure that the list of headers populated by the function also
@@ -189,30 +1391,45 @@ class UploadFileViewTestCase(TestCase):
             'press_contact_type': 'pio'
         }
 
+        _upload_mock.return_value.write_file.return_value = 'tmp/test.csv'
+        _upload_mock.return_value.download_head.side_effect = _download_head
+
+        # The file is posted first, then the metadata about it
         path = LOCAL_CSV
         with open(path) as f:
-            test_data['data_file'] = f
-            response = self.client.post(reverse('upload:index'), test_data)
+            response = self.client.post(reverse('upload:upload_file'),
+                                        {'data_file': f})
+        self.assertEqual(response.status_code, 200)
+        # The local copy is removed once it's on S3
+        local_path = _upload_mock.call_args_list[0][0][0]
+        self.assertFalse(os.path.exists(os.path.dirname(local_path)))
+        # Only the start of the file is analyzed here, and the load task
+        # analyzes the rest
+        analysis = self.client.session['analysis']
+        self.assertFalse(analysis['complete'])
+        self.assertIsNone(analysis['row_count'])
+        response = self.client.post(reverse('upload:add_metadata'), test_data)
 
         # Check that the server responded with a success header
         self.assertEqual(response.status_code, 200)
 
         # Check that all the column headers are appended to the header list
         session = self.client.session
-        rheaders = session.get('headers')
+        rheaders = session['table_params']['headers']
         headers = ['total_income', 'precinct_id', 'tract_id', 'race', 'households']
 
         self.assertTrue([x['name'] for x in rheaders] == headers)
         self.assertTrue(len(rheaders) == 5)
 
         # Check that sample data is correct
-        self.assertTrue(re.match(re.compile(r'68810444'), rheaders[0]['sample_data'][0]))
-        self.assertTrue(re.match(re.compile(r'131'), rheaders[1]['sample_data'][0]))
-        self.assertTrue(re.match(re.compile(r'Census Tract 303.09'), rheaders[2]['sample_data'][0]))
-        self.assertTrue(re.match(re.compile(r'white'), rheaders[3]['sample_data'][0]))
-        self.assertTrue(re.match(re.compile(r'660'), rheaders[4]['sample_data'][0]))
-
-    @patch('upload.forms.sqlalchemy')
+        sample_data = json.loads(response.content)['sample_data']
+        self.assertTrue(re.match(re.compile(r'68810444'), sample_data[0][0]))
+        self.assertTrue(re.match(re.compile(r'131'), sample_data[0][1]))
+        self.assertTrue(re.match(re.compile(r'Census Tract 303.09'), sample_data[0][2]))
+        self.assertTrue(re.match(re.compile(r'white'), sample_data[0][3]))
+        self.assertTrue(re.match(re.compile(r'660'), sample_data[0][4]))
+
+    @patch('upload.forms.warehouse')
     def test_index_view_post_illegal(self, MockSQLAlchemy):
         """
         Test that a POST requests populated with possible SQL injection
@@ -228,19 +1445,195 @@ class UploadFileViewTestCase(TestCase):
             'press_contact_number': '123 456 7890',
         }
 
-        path = LOCAL_CSV
+        response = self.client.post(reverse('upload:add_metadata'), test_data)
 
-        with open(path) as f:
-            test_data['data_file'] = f
-            response = self.client.post(reverse('upload:index'), test_data)
+        self.assertEqual(response.status_code, 400)
+
+
+class DirectUploadViewTestCase(TestCase):
+    """
+    Test the views that let the browser upload a file straight to S3
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(username='jonathan',
+                                             email='jonathan.cox.c@gmail.com',
+                                             password='mock_pw')
+
+    def _post(self, view, data, session):
+        request = self.factory.post('/', data)
+        request.user = self.user
+        request.session = session
+        return view(request)
+
+    @patch('upload.views.S3Manager')
+    def test_start(self, mock_s3):
+        mock_s3.return_value.create_multipart_upload.return_value = 'abc'
+        session = {}
+        size = 20 * 1024 * 1024
+        response = self._post(start_direct_upload,
+                              {'filename': 'votes 2016.csv', 'size': size},
+                              session)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session['direct_upload']['upload_id'], 'abc')
+        self.assertEqual(session['direct_upload']['parts'], 3)
+        self.assertTrue(session['direct_upload']['key'].endswith('/votes_2016.csv'))
+
+    @patch('upload.views.S3Manager')
+    def test_start_illegal(self, mock_s3):
+        response = self._post(start_direct_upload,
+                              {'filename': 'votes.xlsx', 'size': 100}, {})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(mock_s3.return_value.create_multipart_upload.called)
+
+    @patch('upload.views.S3Manager')
+    def test_sign_rejects_unknown_parts(self, mock_s3):
+        session = {'direct_upload': {'key': 'tmp/x.csv', 'upload_id': 'abc',
+                                     'parts': 2}}
+        response = self._post(sign_direct_upload, {'part': ['1', '3']}, session)
+        self.assertEqual(response.status_code, 400)
+
+    @patch('upload.views.S3Manager')
+    def test_complete(self, mock_s3):
+        mock_s3.return_value.download_head.side_effect = _download_head
+
+        session = {'direct_upload': {'key': 'tmp/x.csv', 'upload_id': 'abc',
+                                     'parts': 1}}
+        parts = '[{"PartNumber": 1, "ETag": "etag"}]'
+        response = self._post(complete_direct_upload, {'parts': parts}, session)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session['s3_path'], 'tmp/x.csv')
+        self.assertIsNone(session['direct_upload'])
+        self.assertEqual(json.loads(response.content)['headers'][0], 'total_income')
+        head = mock_s3.return_value.download_head.call_args[0][1]
+        self.assertFalse(os.path.exists(os.path.dirname(head)))
 
+
+class ChunkedUploadViewTestCase(TestCase):
+    """
+    Test the resumable upload views, which store each chunk as a part of an
+    S3 multipart upload
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(username='jonathan',
+                                             email='jonathan.cox.c@gmail.com',
+                                             password='mock_pw')
+        self.upload = Upload.objects.create(user=self.user,
+                                            filename='votes.csv',
+                                            size=10,
+                                            chunk_size=4,
+                                            s3_path='tmp/x/data.csv',
+                                            multipart_id='abc')
+
+    def _post(self, view, data, session=None):
+        request = self.factory.post('/', data)
+        request.user = self.user
+        request.session = session if session is not None else {}
+        return view(request)
+
+    def _chunk(self, part, body, checksum=None):
+        f = tempfile.NamedTemporaryFile()
+        f.write(body)
+        f.seek(0)
+        data = {'id': self.upload.id.hex, 'part': part, 'chunk': f,
+                'sha256': checksum or hashlib.sha256(body).hexdigest()}
+        return self._post(upload_chunk, data)
+
+    @patch('upload.views.S3Manager')
+    def test_start(self, mock_s3):
+        mock_s3.return_value.create_multipart_upload.return_value = 'xyz'
+        response = self._post(start_chunked_upload,
+                              {'filename': 'votes.csv', 'size': 100})
+
+        upload = Upload.objects.get(pk=json.loads(response.content)['id'])
+        self.assertEqual(upload.multipart_id, 'xyz')
+        self.assertEqual(upload.parts, 1)
+
+    @patch('upload.views.S3Manager')
+    def test_upload_chunk(self, mock_s3):
+        mock_s3.return_value.upload_part.return_value = '"etag"'
+        response = self._chunk(1, 'abcd')
+
+        self.assertEqual(response.status_code, 200)
+        mock_s3.return_value.upload_part.assert_called_with('tmp/x/data.csv',
+                                                            'abc', 1, 'abcd')
+
+    @patch('upload.views.S3Manager')
+    def test_upload_chunk_rejects_bad_chunks(self, mock_s3):
+        """
+        Chunks that don't match their checksum or have the wrong size should
+        be rejected so the browser sends them again
+        """
+        self.assertEqual(self._chunk(1, 'abcd', checksum='0' * 64).status_code, 400)
+        self.assertEqual(self._chunk(1, 'abc').status_code, 400)
+        self.assertEqual(self._chunk(4, 'ab').status_code, 400)
+        self.assertFalse(mock_s3.return_value.upload_part.called)
+
+    @patch('upload.views.S3Manager')
+    def test_complete(self, mock_s3):
+        parts = [{'PartNumber': n, 'ETag': str(n), 'Size': 4} for n in (1, 2, 3)]
+        mock_s3.return_value.list_parts.return_value = parts[:2]
+        response = self._post(complete_chunked_upload, {'id': self.upload.id.hex})
         self.assertEqual(response.status_code, 400)
 
+        mock_s3.return_value.list_parts.return_value = parts
+        mock_s3.return_value.download_head.side_effect = _download_head
+        session = {}
+        response = self._post(complete_chunked_upload,
+                              {'id': self.upload.id.hex}, session)
 
-class CategorizeViewTestCase(TestCase):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session['s3_path'], 'tmp/x/data.csv')
+        self.assertTrue(Upload.objects.get(pk=self.upload.id).complete)
+        head = mock_s3.return_value.download_head.call_args[0][1]
+        self.assertFalse(os.path.exists(os.path.dirname(head)))
+
+
+class ExpireUploadsTestCase(TestCase):
     """
-    Test that the categorize view renders correctly when passed headers through
-    session storage
+    Test that expire_uploads aborts stale chunked uploads and removes the
+    workspaces that were left behind
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='jonathan',
+                                             password='mock_pw')
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    @patch('upload.management.commands.expire_uploads.S3Manager')
+    def test_expire_uploads(self, mock_s3):
+        stale = Upload.objects.create(user=self.user, filename='old.csv',
+                                      size=10, chunk_size=4,
+                                      s3_path='tmp/old/data.csv',
+                                      multipart_id='old')
+        Upload.objects.filter(pk=stale.pk).update(
+            start_time=timezone.now() - datetime.timedelta(days=2))
+        Upload.objects.create(user=self.user, filename='new.csv', size=10,
+                              chunk_size=4, s3_path='tmp/new/data.csv',
+                              multipart_id='new')
+
+        with self.settings(UPLOAD_WORKSPACE_ROOT=self.root):
+            old, new = UploadWorkspace('old'), UploadWorkspace('new')
+            an_hour_ago = time.time() - 60 * 60
+            os.utime(old.root, (an_hour_ago, an_hour_ago))
+            call_command('expire_uploads', max_age=60 * 30, stdout=io.BytesIO())
+
+        mock_s3.return_value.abort_multipart_upload.assert_called_once_with(
+            'tmp/old/data.csv', 'old')
+        self.assertEqual([u.filename for u in Upload.objects.all()], ['new.csv'])
+        self.assertFalse(os.path.exists(old.root))
+        self.assertTrue(os.path.exists(new.root))
+
+
+class AddMetadataViewTestCase(TestCase):
+    """
+    Test that the add_metadata view renders correctly when passed the file
+    through session storage
     """
     def setUp(self):
         # Create a mock user so that we can access restricted pages
@@ -251,13 +1644,36 @@ class CategorizeViewTestCase(TestCase):
                                  email='jonathan.cox.c@gmail.com',
                                  password='mock_pw')
 
-    def test_categorize_view_get(self):
-        request = self.factory.get(reverse('upload:categorize'))
+    def test_add_metadata_view_get(self):
+        request = self.factory.get(reverse('upload:add_metadata'))
+        request.user = self.user
+        request.session = {'local_path': LOCAL_CSV}
+
+        response = add_metadata(request)
+        self.assertEqual(response.status_code, 200)
+
+    @patch('upload.forms.warehouse')
+    def test_add_metadata_view_post(self, mock_warehouse):
+        """
+        The cleaned headers should be sent back with the type proposed for
+        each column
+        """
+        request = self.factory.post(reverse('upload:add_metadata'), {
+            'table_name': 'voter_dist_data_2016',
+            'source': 'Secretary of State',
+            'topic': 'Elections',
+            'press_contact_type': 'pio'
+        })
         request.user = self.user
-        request.session = {'headers': ['col_1', 'col_2', 'col_3']}
+        request.session = {'analysis': UploadAnalyzer.from_file(LOCAL_CSV, complete=False)}
 
-        response = categorize(request)
+        response = add_metadata(request)
         self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual([h['name'] for h in data['headers']],
+                         ['total_income', 'precinct_id', 'tract_id', 'race', 'households'])
+        self.assertEqual(data['headers'][4]['proposed_type'], 'SMALLINT')
+        self.assertEqual(request.session['table_params']['table_name'], 'voter_dist_data_2016')
 
 
 class WriteToDBTestCase(TestCase):
@@ -300,19 +1716,19 @@ class WriteToDBTestCase(TestCase):
 
         test_s3_path = LOCAL_CSV
 
+        test_headers = [{'name': 'income', 'category': None}, 
+                        {'name': 'precinct_id', 'category': None}]
         test_table_params = {
             'topic': 'Test topic',
             'db_name': 'import_tool_test',
             'source': 'Test source',
-            'table_name': 'test_table_name'
+            'table_name': 'test_table_name',
+            'headers': test_headers
         }
-        test_headers = [{'name': 'income', 'category': None}, 
-                        {'name': 'precinct_id', 'category': None}]
 
         session_data = {
             'table_params': test_table_params,
-            's3_path': test_s3_path,
-            'headers': test_headers
+            's3_path': test_s3_path
         }
 
         # Create the request object manually, since session handling for
@@ -338,6 +1754,33 @@ class WriteToDBTestCase(TestCase):
         self.assertTrue(_celery_mock.called)
         self.assertEqual(response.status_code, 200)
 
+    @patch('upload.views.load_infile.delay')
+    def test_write_to_db_keeps_text_columns(self, _celery_mock):
+        """
+        Columns the user asked to keep as text should be passed to the load
+        task that way
+        """
+        request = self.factory.get(reverse('upload:write_to_db'))
+        request.user = self.user
+        request.session = {
+            'table_params': {'topic': 'Test topic',
+                             'source': 'Test source',
+                             'table_name': 'test_table_name',
+                             'headers': [{'name': 'income', 'category': None},
+                                         {'name': 'precinct_id', 'category': None}]},
+            's3_path': LOCAL_CSV
+        }
+        request.method = 'POST'
+        request.POST = {'income': 'first_name',
+                        'precinct_id': 'last_name',
+                        'type:precinct_id': 'text'}
+
+        response = write_to_db(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(_celery_mock.call_args[1]['headers'],
+                         [{'name': 'income', 'category': 'first_name'},
+                          {'name': 'precinct_id', 'category': 'last_name', 'type': 'text'}])
+
 # class LoadInfileTestCase(TestCase):
 #     @patch('upload.tasks.boto3.Session')
 #     @patch('upload.tasks.sqlalchemy')
@@ -363,6 +1806,142 @@ class WriteToDBTestCase(TestCase):
 #         query = 'CREATE TABLE test (total_income FLOAT, precinct_id VARCHAR(5), tract_id VARCHAR(20), race VARCHAR(8), households INTEGER);'
 #         self.assertEqual(data.result['create_table_query'], query)
 
+class TableDetailViewTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jonathan',
+                                             password='mock_pw')
+        self.client.login(username='jonathan', password='mock_pw')
+
+    @patch('upload.views.SearchManager')
+    def test_table_detail(self, mock_manager):
+        """
+        Tables with a stored profile should be shown without querying the
+        warehouse
+        """
+        table = Table.objects.create(table='donors', user=self.user,
+                                     source='test', row_count=6387,
+                                     preview=json.dumps([['Cox', 100]]))
+        Column.objects.create(table=table, column='name', mysql_type='varchar',
+                              null_count=2, distinct_count=4000,
+                              min_value='Aaron', max_value='Zed', max_length=30)
+        Column.objects.create(table=table, column='amount', mysql_type='int')
+
+        response = self.client.get(reverse('upload:detail', args=[table.id]))
+
+        self.assertFalse(mock_manager.called)
+        self.assertEqual(response.context['num_rows'], 6387)
+        self.assertEqual(response.context['preview'],
+                         {'headers': ['name', 'amount'], 'data': [['Cox', 100]]})
+        self.assertContains(response, '4,000')
+        self.assertNotContains(response, 'estimated from a sample')
+
+        table.profile_sampled = True
+        table.save()
+        response = self.client.get(reverse('upload:detail', args=[table.id]))
+        self.assertContains(response, 'estimated from a sample')
+
+
+class TableExportTestCase(TransactionTestCase):
+    """
+    Test that whole-table exports are built once per version of a table
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='jonathan',
+                                             password='mock_pw')
+        self.table = Table.objects.create(table='donors', user=self.user,
+                                          source='test', row_count=10,
+                                          path='2017-03-01_donors/original/donors.csv')
+        Column.objects.create(table=self.table, column='name', mysql_type='varchar')
+        Column.objects.create(table=self.table, column='amount', mysql_type='int')
+
+    @patch('upload.tasks.export_table')
+    def test_request_export(self, mock_task):
+        export = request_export(self.table, 'csv.gz')
+        self.assertEqual((export.status, export.version), ('building', 0))
+        mock_task.delay.assert_called_once_with(export.id)
+
+        # Asking again while it's being built doesn't build it twice
+        self.assertEqual(request_export(self.table, 'csv.gz').id, export.id)
+        self.assertEqual(mock_task.delay.call_count, 1)
+
+        # Changing the table's rows makes a new version
+        TableUpdate.objects.create(table=self.table, user=self.user,
+                                   task_id='task-1', mode='append', path='/test/')
+        export = request_export(self.table, 'csv.gz')
+        self.assertEqual(export.version, 1)
+        self.assertEqual(mock_task.delay.call_count, 2)
+
+    @patch('upload.tasks.export_table')
+    def test_request_stalled_export(self, mock_task):
+        """
+        An export whose worker died while building it should be built again
+        """
+        started = timezone.now() - datetime.timedelta(seconds=settings.EXPORT_BUILD_TIMEOUT + 1)
+        export = TableExport.objects.create(table=self.table, format='csv.gz',
+                                            version=0, started=started)
+        self.assertEqual(request_export(self.table, 'csv.gz').id, export.id)
+        mock_task.delay.assert_called_once_with(export.id)
+        export.refresh_from_db()
+        self.assertTrue(export.started > started)
+
+    @patch('upload.tasks.ProgressTracker')
+    @patch('upload.tasks.S3Manager')
+    @patch('upload.tasks.SearchManager')
+    def test_export_table_fails(self, mock_manager, mock_s3, mock_tracker):
+        """
+        Any error should mark the export failed, so that it's built again
+        """
+        export = TableExport.objects.create(table=self.table, format='csv.gz', version=0)
+        mock_s3.return_value.download_query_results.side_effect = IOError('Broken pipe')
+
+        with self.assertRaises(IOError):
+            export_table.apply(args=[export.id]).get()
+
+        export.refresh_from_db()
+        self.assertEqual(export.status, 'failed')
+        self.assertIn('Broken pipe', export.error)
+
+    @patch('upload.tasks.ProgressTracker')
+    @patch('upload.tasks.S3Manager')
+    @patch('upload.tasks.SearchManager')
+    def test_export_table(self, mock_manager, mock_s3, mock_tracker):
+        old = TableExport.objects.create(table=self.table, format='csv.gz',
+                                         version=0, status='ready',
+                                         path='2017-03-01_donors/exports/v0/donors.csv.gz')
+        TableUpdate.objects.create(table=self.table, user=self.user,
+                                   task_id='task-1', mode='append', path='/test/')
+        export = TableExport.objects.create(table=self.table, format='csv.gz',
+                                            version=1)
+        mock_s3.return_value.download_query_results.return_value = ('http://test-url.com', 10)
+
+        result = export_table.apply(args=[export.id]).get()
+
+        key = '2017-03-01_donors/exports/v1/donors.csv.gz'
+        self.assertEqual(result, {'error': False, 'path': key, 'rows': 10})
+        mock_manager.return_value.stream_query.assert_called_with(
+            'SELECT `name`,`amount` FROM imports.`donors`', kind='export')
+
+        export.refresh_from_db()
+        self.assertEqual((export.status, export.path, export.rows), ('ready', key, 10))
+        # The export of the old version is deleted
+        self.assertFalse(TableExport.objects.filter(pk=old.pk).exists())
+        mock_s3.return_value.client.delete_object.assert_called_with(Bucket=settings.S3_BUCKET,
+                                                                     Key=old.path)
+
+    @patch('upload.views.S3Manager')
+    def test_export_view(self, mock_s3):
+        mock_s3.return_value.get_presigned_url.return_value = 'http://test-url.com'
+        TableExport.objects.create(table=self.table, format='csv.gz', version=0,
+                                   status='ready', path='x.csv.gz')
+        self.client.login(username='jonathan', password='mock_pw')
+
+        response = self.client.get(reverse('upload:export', args=[self.table.id, 'csv.gz']))
+        self.assertRedirects(response, 'http://test-url.com', fetch_redirect_response=False)
+
+        response = self.client.get(reverse('upload:detail', args=[self.table.id]))
+        self.assertContains(response, 'href="http://test-url.com"')
+
+
 class CheckTaskStatusTestCase(TestCase):
     def setUp(self):
         self.factory = RequestFactory()
@@ -371,40 +1950,78 @@ class CheckTaskStatusTestCase(TestCase):
                                  password='mock_pw')
 
     @patch('upload.views.AsyncResult')
-    def test_generate_metadata_models(self, mock_response):
-        # Create some mock data about the columns and add it to the session
-        test_header_1 = {'name': 'company',
-                         'category': 'organization_name',
-                         'datatype': 'varchar',
-                         'length': 10}
-
-        test_header_2 = {'name': 'CEO',
-                         'category': 'corp_or_person_name',
-                         'datatype': 'varchar',
-                         'length': 20}
-
-        test_headers = [test_header_1, test_header_2]
-
-        # Mock return values for AsyncResult
+    def test_check_status_is_read_only(self, mock_response):
+        """
+        Polling a finished task should return its result without writing
+        anything to the catalog, however many times it's polled
+        """
         mock_response.return_value.status = 'SUCCESS'
         mock_response.return_value.result = {'table': 'govt_contract_llcs',
-                                             'url': 'http://test-url.com',
-                                             'error': None,
+                                             'table_id': 1,
+                                             'error': False,
                                              'final_s3_path': '/test/',
                                              'warnings': '',
-                                             'headers': [test_header_1, test_header_2]}
+                                             'headers': []}
 
-
-        # Set some basic parameters for the request
         request = self.factory.get(reverse('upload:check_status'))
         request.user = self.user
-        request.method = 'POST'
+        request.session = {'task_id': '000'}
 
-        test_headers = [test_header_1, test_header_2]
+        for i in range(2):
+            response = check_task_status(request)
+            self.assertEqual(response._headers['content-type'][1], 'application/json')
+            self.assertEqual(json.loads(response.content)['result']['table_id'], 1)
 
-        test_table_params = {
+        self.assertFalse(Table.objects.exists())
+
+    def test_no_task(self):
+        """
+        Asking for progress before a load has started should be a 404, not a
+        KeyError
+        """
+        for view, name in ((check_task_status, 'upload:check_status'),
+                           (task_progress, 'upload:task_progress')):
+            request = self.factory.get(reverse(name))
+            request.user = self.user
+            request.session = {}
+            response = view(request)
+            self.assertEqual(response.status_code, 404)
+
+    def test_progress_requires_login(self):
+        """
+        The progress stream should only be open to logged in users
+        """
+        request = self.factory.get(reverse('upload:task_progress'))
+        request.user = AnonymousUser()
+        request.session = {'task_id': '000'}
+        response = task_progress(request)
+        self.assertEqual(response.status_code, 302)
+
+
+class RegisterTableTestCase(TransactionTestCase):
+    """
+    Test that the load_infile task writes a table to the catalog once, in a
+    single transaction, and queues its indexes after the transaction commits
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='jonathan',
+                                 email='jonathan.cox.c@gmail.com',
+                                 password='mock_pw')
+        self.headers = [{'name': 'company',
+                         'category': 'organization_name',
+                         'datatype': 'varchar',
+                         'length': 10,
+                         'profile': {'null_count': 0, 'distinct_count': 2}},
+                        {'name': 'CEO',
+                         'category': 'corp_or_person_name',
+                         'datatype': 'varchar',
+                         'length': 20}]
+        self.result = {'final_s3_path': '/test/',
+                       'warnings': '',
+                       'row_count': 2,
+                       'preview_data': [['Acme', 'Wile E. Coyote']]}
+        self.params = {
             'topic': 'Companies with government contracts',
-            'db_name': 'user_jcox',
             'source': 'FEC',
             'press_contact_type': 'pio',
             'press_contact': 'Brian Kemp',
@@ -413,26 +2030,78 @@ class CheckTaskStatusTestCase(TestCase):
             'next_update': None
         }
 
-        session_data = {
-            'table_params': test_table_params,
-            'headers': test_headers,
-            'task_id': 000
-        }
-
-        request.session = session_data
+    @patch('upload.tasks.build_indexes')
+    def test_register_table(self, mock_build_indexes):
+        args = ('task-1', self.user.id, 'govt_contract_llcs', self.headers,
+                self.result, self.params)
+        table, created = register_table(*args)
+        self.assertTrue(created)
 
-        # Send the request to the view function so the models are generated and
-        # ensure that the server returns a response as JSON
-        response = check_task_status(request)
-        self.assertEqual(response._headers['content-type'][1], 'application/json')
-
-        # Check that the correct models are created
         x = Table.objects.get(table='govt_contract_llcs')
         y = x.column_set.get(column='company')
-
         self.assertEqual(x.source, 'FEC')
         self.assertEqual(x.topic, 'Companies with government contracts')
+        self.assertEqual(x.row_count, 2)
+        self.assertEqual(x.preview_rows, [['Acme', 'Wile E. Coyote']])
+        self.assertEqual(x.contact_set.get().name, 'Brian Kemp')
         self.assertEqual(len(x.column_set.all()), 2)
         self.assertEqual(y.information_type, 'organization_name')
         self.assertEqual(y.mysql_type, 'varchar')
+        self.assertEqual(y.distinct_count, 2)
+        mock_build_indexes.delay.assert_called_once_with(x.id)
+
+        # Registering the same task again changes nothing
+        table, created = register_table(*args)
+        self.assertFalse(created)
+        self.assertEqual(table.id, x.id)
+        self.assertEqual(Table.objects.count(), 1)
+        self.assertEqual(Column.objects.count(), 2)
+        self.assertEqual(mock_build_indexes.delay.call_count, 1)
+
+    @patch('upload.tasks.build_indexes')
+    def test_register_typed_preview(self, mock_build_indexes):
+        """
+        Dates and decimals in the preview should be stored as text
+        """
+        self.result['preview_data'] = [['Acme', datetime.date(2016, 1, 2), Decimal('9.50')]]
+        table, created = register_table('task-1', self.user.id, 'govt_contract_llcs',
+                                        self.headers, self.result, self.params)
+
+        self.assertTrue(created)
+        self.assertEqual(Table.objects.get(pk=table.id).preview_rows,
+                         [['Acme', '2016-01-02', '9.50']])
+
+    @patch('upload.tasks.build_indexes')
+    def test_register_sampled_profile(self, mock_build_indexes):
+        self.result['profile_sampled'] = True
+        table, created = register_table('task-1', self.user.id, 'govt_contract_llcs',
+                                        self.headers, self.result, self.params)
+        self.assertTrue(Table.objects.get(pk=table.id).profile_sampled)
+
+    @patch('upload.tasks.build_indexes')
+    def test_register_timings(self, mock_build_indexes):
+        timing = {'wall_seconds': 1.5, 'cpu_seconds': 0.5, 'max_rss_kb': 2048,
+                  'rss_growth_kb': 0, 'bytes': None, 'rows': None}
+        self.result['timings'] = [dict(timing, stage='Downloading data from Amazon S3', bytes=100),
+                                  dict(timing, stage='Loading the file into MySQL', rows=2)]
+        table, created = register_table('task-1', self.user.id, 'govt_contract_llcs',
+                                        self.headers, self.result, self.params)
+
+        timings = list(table.loadtiming_set.all())
+        self.assertEqual([t.stage for t in timings],
+                         ['Downloading data from Amazon S3', 'Loading the file into MySQL'])
+        self.assertEqual((timings[0].bytes, timings[1].rows), (100, 2))
+        self.assertEqual(timings[1].wall_seconds, 1.5)
+
+    @patch('upload.tasks.build_indexes')
+    def test_register_table_rolls_back(self, mock_build_indexes):
+        """
+        A failure partway through shouldn't leave half a table in the catalog
+        """
+        del self.headers[1]['datatype']
+        with self.assertRaises(KeyError):
+            register_table('task-1', self.user.id, 'govt_contract_llcs',
+                           self.headers, self.result, self.params)
 
+        self.assertFalse(Table.objects.exists())
+        self.assertFalse(mock_build_indexes.delay.called)
@@ -7,10 +7,21 @@ app_name = 'upload'
 urlpatterns = [
     url(r'^$', views.upload, name='index'),
     url(r'^upload-file/$', views.upload_file, name='upload_file'),
+    url(r'^start-direct-upload/$', views.start_direct_upload, name='start_direct_upload'),
+    url(r'^sign-direct-upload/$', views.sign_direct_upload, name='sign_direct_upload'),
+    url(r'^complete-direct-upload/$', views.complete_direct_upload, name='complete_direct_upload'),
+    url(r'^abort-direct-upload/$', views.abort_direct_upload, name='abort_direct_upload'),
+    url(r'^start-chunked-upload/$', views.start_chunked_upload, name='start_chunked_upload'),
+    url(r'^upload-chunk/$', views.upload_chunk, name='upload_chunk'),
+    url(r'^chunked-upload-status/$', views.chunked_upload_status, name='chunked_upload_status'),
+    url(r'^complete-chunked-upload/$', views.complete_chunked_upload, name='complete_chunked_upload'),
     url(r'^add-metadata/$', views.add_metadata, name='add_metadata'),
     url(r'^write-to-db/$', views.write_to_db, name='write_to_db'),
     url(r'^check-task-status/$', views.check_task_status, name='check_status'),
+    url(r'^task-progress/$', views.task_progress, name='task_progress'),
     url(r'^tables/(?P<id>[0-9]+)/$', views.table_detail, name='detail'),
+    url(r'^tables/(?P<id>[0-9]+)/update/$', views.update_table, name='update'),
+    url(r'^tables/(?P<id>[0-9]+)/export/(?P<format>[\w.]+)/$', views.table_export, name='export'),
     url(r'^login/$', auth_views.login, name='login'),
     url(r'^logout/$', views.logout_user, name='logout')
 ]
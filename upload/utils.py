@@ -3,6 +3,18 @@ import os
 from datetime import date
 import re
 import csv
+import uuid
+import shutil
+import base64
+import hashlib
+import json
+import time
+import gzip
+import io
+import struct
+import zlib
+from collections import OrderedDict
+from decimal import Decimal
 
 # Django imports
 from django.conf import settings
@@ -10,9 +22,316 @@ from django.conf import settings
 # Third party imports
 import boto3
 import botocore
+import redis
+from celery import states
+from celery.result import AsyncResult
+
+# Parquet exports are only offered if pyarrow is installed
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Local imports
+from data_import_tool.warehouse import ROW_ID, ROW_HASH
+from .models import Table, Column, TableExport
+from .analyzer import UploadAnalyzer
 
 # Constants
 BUCKET_NAME = settings.S3_BUCKET
+BLOCK_SIZE = 1024 * 1024  # Read files 1MB at a time when splitting them
+URL_EXPIRY = 60 * 60 * 6  # Presigned upload URLs are good for six hours
+PARQUET_BATCH_SIZE = 100000  # Rows per Parquet row group
+# The kinds of files that can be uploaded, and their MIME types
+CONTENT_TYPES = OrderedDict([('.csv.gz', 'application/gzip'),
+                             ('.zip', 'application/zip'),
+                             ('.csv', 'text/csv')])
+
+_redis = None
+
+
+def get_redis():
+    """
+    Get a client for the Redis server that task progress is published to
+    """
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.PROGRESS_REDIS_URL)
+    return _redis
+
+
+def progress_channel(task_id):
+    return 'task-progress:{}'.format(task_id)
+
+
+def publish_progress(task_id, status, result=None):
+    """
+    Tell anyone streaming a task's progress that it has moved on. This is
+    best effort: if Redis is unavailable, clients fall back to polling.
+
+    Args:
+        task_id (string): The ID of the celery task
+        status (string): A celery state, e.g. PROGRESS or SUCCESS
+        result (dict): The progress metadata, if any
+    """
+    message = json.dumps({'status': status, 'result': result})
+    try:
+        get_redis().publish(progress_channel(task_id), message)
+    except redis.RedisError:
+        pass
+
+
+def progress_events(task_id, timeout=None, heartbeat=None):
+    """
+    Generate server-sent events with the progress of a celery task, as it's
+    published. The task's current state is sent first, in case it moved on
+    before we started listening. The stream ends when the task finishes or
+    after timeout seconds, when the browser reconnects on its own.
+
+    Args:
+        task_id (string): The ID of the celery task
+        timeout (int): How long to keep the stream open
+        heartbeat (int): How often to send a comment to keep it open
+
+    Returns:
+        A generator of strings formatted as server-sent events
+    """
+    timeout = timeout or settings.PROGRESS_STREAM_TIMEOUT
+    heartbeat = heartbeat or settings.PROGRESS_HEARTBEAT
+
+    def event(data):
+        return 'data: {}\n\n'.format(data)
+
+    # Subscribe before reading the current state, so nothing is missed in
+    # between
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(progress_channel(task_id))
+    try:
+        # Ask the browser to reconnect quickly when the stream times out
+        yield 'retry: 1000\n\n'
+
+        current = AsyncResult(task_id)
+        state = current.state
+        result = current.info if state == 'PROGRESS' else None
+        yield event(json.dumps({'status': state, 'result': result}))
+        if state in states.READY_STATES:
+            return
+
+        deadline = time.time() + timeout
+        last_sent = time.time()
+        while time.time() < deadline:
+            message = pubsub.get_message(timeout=1.0)
+            if message is None:
+                if time.time() - last_sent >= heartbeat:
+                    yield ': keepalive\n\n'
+                    last_sent = time.time()
+                continue
+
+            yield event(message['data'])
+            last_sent = time.time()
+            if json.loads(message['data'])['status'] in states.READY_STATES:
+                return
+    finally:
+        pubsub.close()
+
+def export_formats():
+    """
+    Returns:
+        The (format, label) pairs of the table exports we can build
+    """
+    return [(f, label) for f, label in TableExport.FORMAT_CHOICES
+            if f != 'parquet' or pyarrow is not None]
+
+
+def export_key(table, format, version):
+    """
+    Exports are stored next to the original file, with a directory for each
+    version of the table
+
+    Args:
+        table (Table): The table being exported
+        format (string): "csv.gz" or "parquet"
+        version (int): The table's data_version
+
+    Returns:
+        The key to store the export under
+    """
+    stem = table.path.split('/original/')[0] if '/original/' in table.path else table.table
+    return '{stem}/exports/v{version}/{table}.{format}'.format(
+        stem=stem, version=version, table=table.table, format=format)
+
+
+# The Column.mysql_type of each kind of number
+INTEGER_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint')
+REAL_TYPES = ('double', 'float')
+DATETIME_TYPES = ('datetime', 'timestamp')
+# The most digits a Parquet decimal can hold. Wider MySQL DECIMALs are
+# written as strings
+MAX_PARQUET_PRECISION = 38
+
+
+def _decimal_size(column_size):
+    """
+    Get the precision and scale of a DECIMAL column from its column_size,
+    e.g. "10,2", or None if Parquet can't hold it
+    """
+    try:
+        precision, scale = [int(n) for n in (column_size or '').split(',')]
+    except ValueError:
+        return None
+    if precision > MAX_PARQUET_PRECISION:
+        return None
+    return (precision, scale)
+
+
+def _parquet_type(mysql_type, column_size=None):
+    if mysql_type in INTEGER_TYPES:
+        return pyarrow.int64()
+    if mysql_type in REAL_TYPES:
+        return pyarrow.float64()
+    if mysql_type == 'decimal' and _decimal_size(column_size):
+        return pyarrow.decimal128(*_decimal_size(column_size))
+    if mysql_type == 'boolean':
+        return pyarrow.bool_()
+    if mysql_type == 'date':
+        return pyarrow.date32()
+    if mysql_type in DATETIME_TYPES:
+        return pyarrow.timestamp('us')
+    return pyarrow.string()
+
+
+def _parquet_value(value, mysql_type, column_size=None):
+    """
+    Convert a value from MySQL into one pyarrow accepts for its column's type
+    """
+    if value is None:
+        return None
+    if mysql_type in INTEGER_TYPES:
+        return int(value)
+    if mysql_type in REAL_TYPES:
+        return float(value)
+    if mysql_type == 'decimal' and _decimal_size(column_size):
+        return value if isinstance(value, Decimal) else Decimal(str(value))
+    if mysql_type == 'boolean':
+        return bool(value)
+    if mysql_type == 'date' or mysql_type in DATETIME_TYPES:
+        # Zero dates like 0000-00-00 come back from MySQL as strings, and
+        # Parquet has no way to write them
+        return value if isinstance(value, date) else None
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+def file_extension(name):
+    """
+    Get the extension of an uploaded file, if it's a kind we accept
+
+    Returns:
+        ".csv", ".csv.gz", ".zip" or None
+    """
+    for extension in CONTENT_TYPES:
+        if name.lower().endswith(extension):
+            return extension
+    return None
+
+
+class Decompressor(object):
+    """
+    This module decompresses an uploaded file a block at a time as it's
+    read, so that a compressed upload never has to be unpacked in memory or
+    stored twice. Plain CSVs are passed through untouched. Only the first
+    file in a zip archive is read, straight from its local header, so an
+    archive can be read from the start without seeking to the directory at
+    the end. Gzipped files can have several members one after the other, as
+    pigz, bgzip and cat make them, and they're read as one file.
+
+    Example usage:
+        decompressor = Decompressor('.csv.gz')
+        for block in blocks:
+            out.write(decompressor.decompress(block))
+
+    Args:
+        extension (string): The extension of the file, from file_extension()
+    """
+    ZIP_HEADER = struct.Struct('<IHHHHHIIIHH')
+    ZIP_SIGNATURE = 0x04034b50
+
+    def __init__(self, extension):
+        self.extension = extension
+        self.buffer = ''
+        self.remaining = None  # Bytes left in a zip member that isn't compressed
+        self.decompressor = None
+        if extension == '.csv.gz':
+            # 16 tells zlib to expect a gzip header
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _read_zip_header(self):
+        """
+        Parse the local header of the first file in a zip archive once enough
+        of it has arrived
+
+        Returns:
+            Whatever follows the header, or None if it's still incomplete
+        """
+        size = self.ZIP_HEADER.size
+        if len(self.buffer) < size:
+            return None
+
+        (signature, version, flags, method, mtime, mdate, crc, compressed,
+         uncompressed, name_length, extra_length) = self.ZIP_HEADER.unpack(self.buffer[:size])
+        if signature != self.ZIP_SIGNATURE:
+            raise ValueError('The file is not a zip archive')
+
+        start = size + name_length + extra_length
+        if len(self.buffer) < start:
+            return None
+
+        if method == 8:
+            # Raw deflate, without a zlib header
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == 0 and not flags & 0x08:
+            self.remaining = compressed
+        else:
+            raise ValueError('Unsupported zip compression method')
+
+        data, self.buffer = self.buffer[start:], ''
+        return data
+
+    def decompress(self, data):
+        """
+        Returns:
+            The decompressed bytes that data completes
+        """
+        if self.extension == '.zip' and self.decompressor is None and self.remaining is None:
+            self.buffer += data
+            data = self._read_zip_header()
+            if data is None:
+                return ''
+
+        if self.extension == '.csv.gz':
+            return self._gunzip(data)
+        if self.decompressor is not None:
+            return self.decompressor.decompress(data)
+        if self.remaining is not None:
+            data, self.remaining = data[:self.remaining], max(self.remaining - len(data), 0)
+        return data
+
+    def _gunzip(self, data):
+        out = []
+        while True:
+            out.append(self.decompressor.decompress(data))
+            # Whatever follows the end of a member is the next member, or
+            # zeros some tools pad the end of the file with
+            data = self.decompressor.unused_data.lstrip('\x00')
+            if not data:
+                return ''.join(out)
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def flush(self):
+        return self.decompressor.flush() if self.decompressor is not None else ''
+
 
 class S3Manager(object):
     """
@@ -55,7 +374,8 @@ class S3Manager(object):
             self.client.head_object(Bucket=self.bucket, Key=key)
 
             i += 1
-            key_stub = key[:-4]
+            extension = file_extension(key) or '.csv'
+            key_stub = key[:-len(extension)]
 
             # If there's already a number appended to the end of the key, strip it
             # out so we can append the new number
@@ -64,7 +384,7 @@ class S3Manager(object):
                 key_stub = re.sub(r, '', key_stub)
 
             # Recursive call to check with updated filename suffix
-            return self._check_duplicates('{}({}).csv'.format(key_stub, str(i)), i)
+            return self._check_duplicates('{}({}){}'.format(key_stub, str(i), extension), i)
 
         except botocore.exceptions.ClientError:
             return key
@@ -82,8 +402,10 @@ class S3Manager(object):
         today = date.today().isoformat()
         stem = '{today}_{table}'.format(table=self.table_name, today=today)
 
-        path = '{stem}/original/{table}.csv'.format(stem=stem,
-                                                         table=self.table_name)
+        # Compressed uploads stay compressed
+        path = '{stem}/original/{table}{extension}'.format(
+            stem=stem, table=self.table_name,
+            extension=file_extension(tmp_path) or '.csv')
 
         # Check if a directory with the same name already exists in the
         # S3 bucket, and if so change the key.
@@ -96,38 +418,354 @@ class S3Manager(object):
 
         return unique_path
 
-    def write_file(self):
+    def write_file(self, key=None):
         """
         Write a file to the S3 server. This is used for uploading temporary
         files, either when a user is in the process of loading to the database
         or when they want to download search results after running a query.
 
         Args:
-            local_path (string): Path to local CSV file
-            table_name (string): The name of the table
+            key (string): Where to write the file. Defaults to a unique key
+            in tmp/ named after the table
 
         Returns:
             s3_path (string): The path to the temporary file on S3
         """
-        s3_path = self._check_duplicates('tmp/{}.csv'.format(self.table_name))
-        with open(self.local_path, 'r') as f:
+        s3_path = key or self._check_duplicates('tmp/{}.csv'.format(self.table_name))
+        with open(self.local_path, 'rb') as f:
             self.client.put_object(Bucket=self.bucket, Key=s3_path, Body=f)
 
         return s3_path
 
-    def get_presigned_url(self, key):
+    def create_multipart_upload(self, key, content_type=None):
+        """
+        Start a multipart upload that the browser can send parts to directly
+
+        Args:
+            key (string): The key the assembled file will be stored under
+            content_type (string): The MIME type of the assembled file.
+            Defaults to the type of the key's extension
+
+        Returns:
+            upload_id (string): The ID S3 assigned to the upload
+        """
+        content_type = content_type or CONTENT_TYPES.get(file_extension(key), 'text/csv')
+        response = self.client.create_multipart_upload(Bucket=self.bucket,
+                                                       Key=key,
+                                                       ContentType=content_type)
+        return response['UploadId']
+
+    def sign_upload_parts(self, key, upload_id, part_numbers):
+        """
+        Generate presigned URLs that let the browser PUT parts of a multipart
+        upload straight to S3 without sending the bytes through Django
+
+        Args:
+            key (string): The key of the multipart upload
+            upload_id (string): The ID of the multipart upload
+            part_numbers (int[]): The parts to sign URLs for (1-10,000)
+
+        Returns:
+            urls (dict): A map of part numbers to presigned URLs
+        """
+        urls = {}
+        for n in part_numbers:
+            p = {'Bucket': self.bucket, 'Key': key, 'UploadId': upload_id,
+                 'PartNumber': n}
+            urls[n] = self.client.generate_presigned_url(ClientMethod='upload_part',
+                                                         Params=p,
+                                                         ExpiresIn=URL_EXPIRY)
+        return urls
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        """
+        Assemble the parts of a multipart upload into a single object
+
+        Args:
+            key (string): The key of the multipart upload
+            upload_id (string): The ID of the multipart upload
+            parts (dict[]): The PartNumber and ETag of every part
+        """
+        parts = sorted(parts, key=lambda p: p['PartNumber'])
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key,
+                                              UploadId=upload_id,
+                                              MultipartUpload={'Parts': parts})
+
+    def abort_multipart_upload(self, key, upload_id):
+        """
+        Cancel a multipart upload and delete any parts that were uploaded
+        """
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=key,
+                                           UploadId=upload_id)
+
+    def upload_part(self, key, upload_id, part_number, body):
+        """
+        Send one part of a multipart upload from the server. S3 checks the
+        part against the MD5 we send with it, so a chunk corrupted between
+        here and S3 is rejected instead of silently assembled.
+
+        Args:
+            key (string): The key of the multipart upload
+            upload_id (string): The ID of the multipart upload
+            part_number (int): The number of the part (1-10,000)
+            body (string): The bytes of the part
+
+        Returns:
+            etag (string): The ETag S3 assigned to the part
+        """
+        md5 = base64.b64encode(hashlib.md5(body).digest())
+        response = self.client.upload_part(Bucket=self.bucket, Key=key,
+                                           UploadId=upload_id,
+                                           PartNumber=part_number,
+                                           ContentMD5=md5, Body=body)
+        return response['ETag']
+
+    def list_parts(self, key, upload_id):
+        """
+        List the parts of a multipart upload that S3 has received
+
+        Returns:
+            parts (dict[]): The PartNumber, ETag and Size of every part
+        """
+        parts = []
+        kwargs = {'Bucket': self.bucket, 'Key': key, 'UploadId': upload_id}
+        while True:
+            response = self.client.list_parts(**kwargs)
+            parts.extend({'PartNumber': p['PartNumber'], 'ETag': p['ETag'],
+                          'Size': p['Size']} for p in response.get('Parts', []))
+            if not response.get('IsTruncated'):
+                return parts
+            kwargs['PartNumberMarker'] = response['NextPartNumberMarker']
+
+    def download_head(self, key, local_path, size=65536):
+        """
+        Download the first few bytes of a file so that we can read its headers
+        and some sample rows without downloading the whole thing. Compressed
+        files are decompressed as far as the bytes go.
+
+        Args:
+            key (string): The key of the file on S3
+            local_path (string): Where to write the decompressed bytes
+            size (int): How many bytes to download
+
+        Returns:
+            local_path (string): The path the bytes were written to
+        """
+        response = self.client.get_object(Bucket=self.bucket, Key=key,
+                                          Range='bytes=0-{}'.format(size - 1))
+        decompressor = Decompressor(file_extension(key) or '.csv')
+        with open(local_path, 'wb') as f:
+            f.write(decompressor.decompress(response['Body'].read()))
+
+        return local_path
+
+    def download_file(self, key, local_path, callback=None, analyzer=None):
+        """
+        Download a whole file. Compressed files are decompressed as they're
+        downloaded, so only the decompressed CSV is written to disk.
+
+        Args:
+            key (string): The key of the file on S3
+            local_path (string): Where to write the CSV
+            callback (function): Called with the number of bytes received as
+            each block arrives, like a boto3 transfer callback
+            analyzer (UploadAnalyzer): If set, fed the decompressed CSV as
+            it's written, so it doesn't have to be read again
+        """
+        extension = file_extension(key) or '.csv'
+        if extension == '.csv' and analyzer is None:
+            # boto3 downloads plain files in parallel ranges
+            self.client.download_file(self.bucket, key, local_path,
+                                      Callback=callback)
+            return
+
+        body = self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+        decompressor = Decompressor(extension)
+        with open(local_path, 'wb') as f:
+            def write(data):
+                f.write(data)
+                if analyzer:
+                    analyzer.feed(data)
+
+            for block in iter(lambda: body.read(BLOCK_SIZE), ''):
+                write(decompressor.decompress(block))
+                if callback:
+                    callback(len(block))
+            write(decompressor.flush())
+
+    def write_parquet(self, rows, key, types, progress=None):
+        """
+        Write rows to S3 as a Parquet file, a row group at a time so that
+        only one group is held in memory. The file is built on local disk
+        and then uploaded, since Parquet's footer can't be written until
+        every row has been.
+
+        Args:
+            rows (iterable): The column names, followed by each row
+            key (string): Where to store the file on S3
+            types (tuple[]): The Column.mysql_type and column_size of each
+            column
+            progress (function): Called with the number of rows written so far
+            after each row group
+
+        Returns:
+            The number of rows written, not counting the headers
+        """
+        rows = iter(rows)
+        headers = next(rows)
+        schema = pyarrow.schema([pyarrow.field(h, _parquet_type(*t))
+                                 for h, t in zip(headers, types)])
+
+        workspace = UploadWorkspace()
+        local_path = workspace.path('export.parquet')
+        count = 0
+        try:
+            writer = pyarrow.parquet.ParquetWriter(local_path, schema,
+                                                   compression='snappy')
+            try:
+                while True:
+                    batch = [row for _, row in zip(range(PARQUET_BATCH_SIZE), rows)]
+                    if not batch:
+                        break
+                    arrays = [pyarrow.array([_parquet_value(row[i], *t) for row in batch],
+                                            type=_parquet_type(*t))
+                              for i, t in enumerate(types)]
+                    writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+                    count += len(batch)
+                    if progress:
+                        progress(count)
+            finally:
+                writer.close()
+
+            self.client.upload_file(local_path, self.bucket, key,
+                                    ExtraArgs={'ContentType': 'application/octet-stream'})
+        finally:
+            workspace.cleanup()
+
+        return count
+
+    def get_presigned_url(self, key, expires=URL_EXPIRY):
         p = {'Bucket': self.bucket, 'Key': key}
-        url = self.client.generate_presigned_url(ClientMethod='get_object', Params=p)
+        url = self.client.generate_presigned_url(ClientMethod='get_object',
+                                                 Params=p, ExpiresIn=expires)
         return url
 
-    def download_query_results(self):
+    def download_query_results(self, rows, key, progress=None):
         """
-        Generate a CSV from search results, write it to the /tmp directory in
-        the S3 bucket, and generate a temporary presigned URL so the user can
-        download the dataset
+        Write search results to S3 as a gzipped CSV, and generate a temporary
+        presigned URL so the user can download the dataset. The CSV is
+        compressed and sent as the parts of a multipart upload as the rows
+        come in, so no more than one part is ever held in memory.
+
+        Args:
+            rows (iterable): The column names, followed by every row
+            key (string): Where to store the file in the bucket
+            progress (function): Called with the number of rows written so far
+            each time a part is uploaded
+
+        Returns:
+            A two-tuple with a presigned URL for the file, and the number of
+            rows in it (not counting the header)
         """
+        upload_id = self.create_multipart_upload(key, content_type='application/gzip')
+        parts = []
+        count = -1  # The first row is the header
+
+        def flush(buf):
+            part_number = len(parts) + 1
+            etag = self.upload_part(key, upload_id, part_number, buf.getvalue())
+            parts.append({'PartNumber': part_number, 'ETag': etag})
+            buf.seek(0)
+            buf.truncate()
+
+        try:
+            buf = io.BytesIO()
+            gz = gzip.GzipFile(fileobj=buf, mode='wb')
+            writer = csv.writer(gz)
+            for row in rows:
+                # The csv module in python 2 only writes bytes
+                writer.writerow([v.encode('utf-8') if isinstance(v, unicode) else v
+                                 for v in row])
+                count += 1
+                if buf.tell() >= settings.S3_PART_SIZE:
+                    flush(buf)
+                    if progress:
+                        progress(count)
+
+            # Closing the gzip file writes its trailer, and the last part is
+            # allowed to be smaller than the rest
+            gz.close()
+            flush(buf)
+            self.complete_multipart_upload(key, upload_id, parts)
+        except Exception:
+            self.abort_multipart_upload(key, upload_id)
+            raise
+
+        return (self.get_presigned_url(key, expires=settings.EXPORT_URL_EXPIRY),
+                max(count, 0))
 
 
+class UploadWorkspace(object):
+    """
+    A scratch directory for a single upload or task, so that concurrent
+    uploads never read or overwrite each other's files. Anything that has to
+    outlive the request that created it, or be visible to other web nodes,
+    belongs on S3 instead.
+
+    Example usage:
+        workspace = UploadWorkspace()
+        local_path = workspace.path('data.csv')
+        ...
+        workspace.cleanup()
+
+    Args:
+        name (string): The name of an existing workspace. If None, a new one
+        is created with a random name.
+    """
+    def __init__(self, name=None):
+        # Names end up in paths, so don't allow anything but word characters
+        # and dashes (UUIDs and celery task IDs)
+        self.name = re.sub(r'[^\w-]', '', name or uuid.uuid4().hex)
+        self.root = os.path.join(settings.UPLOAD_WORKSPACE_ROOT, self.name)
+
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            if not os.path.isdir(self.root):
+                raise
+
+    def path(self, filename):
+        return os.path.join(self.root, os.path.basename(filename))
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    @staticmethod
+    def expire(max_age):
+        """
+        Remove the workspaces that haven't been touched in max_age seconds,
+        which were left behind by requests or tasks that died before they
+        could clean up after themselves
+
+        Args:
+            max_age (int): The age in seconds past which a workspace is stale
+
+        Returns:
+            names (string[]): The names of the workspaces that were removed
+        """
+        root = settings.UPLOAD_WORKSPACE_ROOT
+        if not os.path.isdir(root):
+            return []
+
+        cutoff = time.time() - max_age
+        names = []
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name)
+            if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                names.append(name)
+        return names
+
 
 class TableFormatter(object):
     """
@@ -138,7 +776,7 @@ class TableFormatter(object):
 
     Example usage:
         formatter = TableFormatter('my_local_file.csv')
-        column_names = formatter.get_column_names()
+        headers, sample_data = formatter.get_column_data()
     """
     def __init__(self, path):
         self.filepath = path
@@ -181,34 +819,154 @@ class TableFormatter(object):
 
         return clean_names
 
-    def get_column_data(self):
+    def get_column_data(self, analysis=None):
         """
         Get column names and sample data from a CSV without loading the whole
         file into memory
 
+        Args:
+            analysis (dict): The file's UploadAnalyzer summary, if it's
+            already been analyzed. Otherwise the file is analyzed here
+
         Returns:
             A two-tuple containing (1) A list of sanitized column headers with
             a nested list of sample data and (2) A list of sample rows
         """
-        with open(self.filepath, 'r') as f:
-            reader = csv.reader(f)
-            raw_headers = f.next().split(',')
-            sample_data = []
-            for i in range(5):
-                try:
-                    sample_data.append(reader.next())
-                except StopIteration:
-                    break
+        if analysis is None:
+            analysis = UploadAnalyzer.from_file(self.filepath, complete=False)
 
         # Clean the column names to prevent SQL injection
-        clean_headers = self._clean(raw_headers)
-        return (clean_headers, sample_data)
+        clean_headers = self._clean(analysis['headers'])
+        return (clean_headers, analysis['sample'])
+
+
+class CSVSplitter(object):
+    """
+    This module splits a CSV into smaller files so that they can be loaded in
+    parallel. It only ever breaks the file at a line break that falls outside
+    a quoted field, so a value with newlines in it is never cut in half. The
+    file is read as a stream and each chunk is yielded as soon as it's
+    written, so loading can begin before the whole file has been split.
+
+    Example usage:
+        splitter = CSVSplitter('my_local_file.csv', 64 * 1024 * 1024, '/tmp/x')
+        for i, chunk_path in splitter.split():
+            load(chunk_path)
+
+    Args:
+        path (string): The path to a local CSV
+        chunk_size (int): The approximate size of each chunk in bytes
+        workspace (string): A directory to write the chunks to
+        skip_header (bool): Whether to leave the header row out of the chunks
+        quotechar (string): The character used to quote fields
+        newline (string): The last character of the line terminator
+    """
+    def __init__(self, path, chunk_size, workspace, skip_header=True,
+                 quotechar='"', newline='\n'):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.workspace = workspace
+        self.skip_header = skip_header
+        self.quotechar = quotechar
+        self.newline = newline
+
+    def _boundary(self, block, lo, start, quoted):
+        """
+        Find the first line break at or after start that isn't inside a quoted
+        field. Quotes are counted from lo, where the quote state is quoted.
+        Escaped quotes ("") flip the state twice, so they cancel out.
+
+        Returns:
+            A two-tuple with the index of the line break (-1 if there isn't
+            one) and the quote state at that index, or at the end of the block
+            if there was no line break.
+        """
+        q = self.quotechar
+        while True:
+            i = block.find(self.newline, start)
+            if i == -1:
+                return (-1, quoted ^ bool(block.count(q, lo) & 1))
+
+            quoted ^= bool(block.count(q, lo, i) & 1)
+            if not quoted:
+                return (i, quoted)
+
+            lo = i
+            start = i + 1
+
+    def _chunk_path(self, i):
+        return os.path.join(self.workspace, 'chunk-{:05d}.csv'.format(i))
+
+    def split(self):
+        """
+        Split the file
+
+        Returns:
+            A generator of (index, path) two-tuples, one for each chunk
+        """
+        quoted = False
+        skipping = self.skip_header
+        i = 0
+        written = 0
+        out = None if skipping else open(self._chunk_path(i), 'wb')
+
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), ''):
+                pos = 0
+                while pos < len(block):
+                    need = 0 if skipping else max(self.chunk_size - written, 0)
+                    end, quoted_at = self._boundary(block, pos, pos + need,
+                                                    quoted)
+                    if end == -1:
+                        if out:
+                            out.write(block[pos:])
+                            written += len(block) - pos
+                        quoted = quoted_at
+                        break
+
+                    if skipping:
+                        skipping = False
+                    else:
+                        out.write(block[pos:end + 1])
+                        out.close()
+                        yield (i, self._chunk_path(i))
+                        i += 1
+
+                    out = open(self._chunk_path(i), 'wb')
+                    written = 0
+                    quoted = False
+                    pos = end + 1
+
+        if out:
+            out.close()
+            if written:
+                yield (i, self._chunk_path(i))
+            else:
+                os.remove(self._chunk_path(i))
+
+
+def row_hash_expression(columns):
+    """
+    Build a SQL expression for the hash of a row. NULLs are hashed as a zero
+    byte so that they don't match empty strings, and values are separated by
+    a unit separator so that ("ab", "c") doesn't match ("a", "bc").
+
+    Args:
+        columns (string[]): The names of the columns to hash, in order
+
+    Returns:
+        A MD5(...) expression to use in a SELECT, UPDATE or LOAD DATA
+    """
+    values = ','.join('COALESCE(`{}`, 0x00)'.format(c) for c in columns)
+    return 'MD5(CONCAT_WS(0x1f, {}))'.format(values)
 
 
 class Index(object):
     """
-    This module handles creation of a query to generate an index for a given
-    column in a MySQL table
+    This module builds the FULLTEXT indexes that search needs on a MySQL
+    table. Columns are grouped by the last part of their information type,
+    the same way search groups them, so all of a table's "_name" columns
+    share one index and all of its "_add" columns share another.
 
     Args:
         table_id (string): The UniqueID of a table in the Django DB
@@ -219,42 +977,166 @@ class Index(object):
         self.table_id = int(table_id)
         self.connection = connection
 
-    def _get_columns(self, data_type):
-        query = """
-        SELECT CONCAT_WS('.','imports',t.`table`) AS data_table,
-            CONCAT('`',GROUP_CONCAT(c.`column` SEPARATOR '`,`'),'`') AS index_fields
-        FROM data_import_tool.`upload_table` t
-        JOIN data_import_tool.`upload_column` c
-        ON t.`id`=c.`table_id`
-        WHERE c.`information_type`='{type}'
-        AND t.`id`={id}
-        GROUP BY 1;
-        """.format(id=self.table_id, type=data_type)
+    def groups(self):
+        """
+        Find the columns that belong in each index
 
-        columns = self.connection.execute(query).fetchall()
-        return columns
+        Returns:
+            An OrderedDict mapping each data type (e.g. "name") to the
+            columns of that type, in the table's order
+        """
+        groups = OrderedDict()
+        columns = (Column.objects.filter(table_id=self.table_id)
+                   .exclude(information_type__isnull=True)
+                   # Uncategorized columns can come through as "None"
+                   .exclude(information_type__in=['', 'None'])
+                   .order_by('id')
+                   .values_list('column', 'information_type'))
+        for column, information_type in columns:
+            data_type = information_type.split('_')[-1]
+            groups.setdefault(data_type, []).append(column)
+        return groups
+
+    def add_row_id(self, table):
+        """
+        Give a table loaded before tables had a primary key the hidden row ID
+        that search pages through results with. Tables that already have one
+        are left alone.
+
+        Args:
+            table(string): The name of the table
+
+        Returns:
+            True if the column was added
+        """
+        query = "SHOW COLUMNS FROM imports.`{}` WHERE Field='{}'".format(table, ROW_ID)
+        if self.connection.execute(query).fetchall():
+            return False
+
+        self.connection.execute(
+            'ALTER TABLE imports.`{}` ADD COLUMN `{}` BIGINT UNSIGNED NOT NULL '
+            'AUTO_INCREMENT PRIMARY KEY'.format(table, ROW_ID))
+        return True
+
+    def add_row_hash(self, table, columns):
+        """
+        Give a table the row hashes that incremental updates compare new
+        rows with, and index them. Tables that already have them are left
+        alone; the update keeps them current after that.
+
+        Args:
+            table(string): The name of the table
+            columns(string[]): The table's columns, in order
 
-    def create_index(self, data_type):
+        Returns:
+            True if the column was added
+        """
+        query = "SHOW COLUMNS FROM imports.`{}` WHERE Field='{}'".format(table, ROW_HASH)
+        if self.connection.execute(query).fetchall():
+            return False
+
+        # Fill in the hashes before indexing them, so the index is built in
+        # one pass instead of a row at a time
+        self.connection.execute('ALTER TABLE imports.`{}` ADD COLUMN `{}` CHAR(32)'
+                                .format(table, ROW_HASH))
+        self.connection.execute('UPDATE imports.`{}` SET `{}` = {}'
+                                .format(table, ROW_HASH, row_hash_expression(columns)))
+        self.connection.execute('ALTER TABLE imports.`{0}` ADD INDEX `{1}_index` (`{1}`)'
+                                .format(table, ROW_HASH))
+        return True
+
+    def add_key_index(self, table, columns):
+        """
+        Index the columns that an upsert matches rows on. An index on a
+        different key is replaced. TEXT columns can only be indexed on a
+        prefix, so they're indexed on their first 255 characters.
+
+        Args:
+            table(string): The name of the table
+            columns(string[]): The key columns
+
+        Returns:
+            True if an index was created
+        """
+        name = '_key_index'
+        rows = self.connection.execute(
+            "SHOW INDEX FROM imports.`{}` WHERE Key_name='{}'".format(table, name)).fetchall()
+        if [r['Column_name'] for r in rows] == list(columns):
+            return False
+        if rows:
+            self.connection.execute('ALTER TABLE imports.`{}` DROP INDEX `{}`'
+                                    .format(table, name))
+
+        types = dict((r['Field'], r['Type'].lower()) for r in
+                     self.connection.execute('SHOW COLUMNS FROM imports.`{}`'.format(table)))
+        parts = []
+        for c in columns:
+            prefix = '(255)' if re.search(r'text|blob', types.get(c, '')) else ''
+            parts.append('`{}`{}'.format(c, prefix))
+
+        self.connection.execute('ALTER TABLE imports.`{}` ADD INDEX `{}` ({})'
+                                .format(table, name, ','.join(parts)))
+        return True
+
+    def is_built(self, table):
+        """
+        Check whether a table already has everything search needs: the
+        hidden row ID, and a FULLTEXT index on exactly the columns of each
+        group. Tables loaded before indexes were built in the background may
+        have been indexed by hand.
+
+        Args:
+            table(string): The name of the table
+
+        Returns:
+            True if building the indexes would add nothing
+        """
+        query = "SHOW COLUMNS FROM imports.`{}` WHERE Field='{}'".format(table, ROW_ID)
+        if not self.connection.execute(query).fetchall():
+            return False
+
+        fulltext = {}
+        for row in self.connection.execute('SHOW INDEX FROM imports.`{}`'.format(table)):
+            if row['Index_type'] == 'FULLTEXT':
+                fulltext.setdefault(row['Key_name'], set()).add(row['Column_name'])
+        return all(set(columns) in fulltext.values()
+                   for columns in self.groups().values())
+
+    def _exists(self, table, name):
+        query = "SHOW INDEX FROM imports.`{}` WHERE Key_name='{}'".format(table, name)
+        return len(self.connection.execute(query).fetchall()) > 0
+
+    def create_index(self, data_type, table=None):
         """
         Generate the SQL query to create an index, connect to the MySQL,
-        database, and create the index
+        database, and create the index. An index left over from an earlier
+        attempt is dropped first, so this is safe to retry.
 
         Args:
             data_type(string): The AJC datatype (eg "name", "address") used
                                to categorize columns
+            table(string): The name of the table. Looked up if not given
+
+        Returns:
+            True if an index was created, False if the table has no columns
+            of the given type
         """
-        indexer = self._get_columns(data_type)
-        if indexer:
-            args = {
-                'table': indexer[0]['data_table'],
-                'columns': indexer[0]['index_fields']
-            }
-            query = """
-                ALTER TABLE {table} ADD FULLTEXT INDEX `name_index` ({columns})
-                """.format(**args)
-
-            self.connection.execute(query)
-            return True
-        else:
+        columns = self.groups().get(data_type)
+        if not columns:
             return False
 
+        if table is None:
+            table = Table.objects.get(pk=self.table_id).table
+
+        name = '{}_index'.format(data_type)
+        if self._exists(table, name):
+            self.connection.execute('ALTER TABLE imports.`{}` DROP INDEX `{}`'
+                                    .format(table, name))
+
+        query = """
+            ALTER TABLE imports.`{table}` ADD FULLTEXT INDEX `{name}` ({columns})
+            """.format(table=table, name=name,
+                       columns=','.join('`{}`'.format(c) for c in columns))
+
+        self.connection.execute(query)
+        return True
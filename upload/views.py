@@ -1,9 +1,12 @@
 # Standard library imports
-import os
+import re
+import json
+import uuid
+import hashlib
 
 # Django imports
-from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import JsonResponse, StreamingHttpResponse
 from django.conf import settings
 from django.urls import reverse
 from django.contrib import messages
@@ -14,14 +17,17 @@ from django.contrib.auth.decorators import login_required
 # import sqlalchemy
 from celery.result import AsyncResult
 from kombu.exceptions import OperationalError
+import botocore
 
 # Local imports
-from .forms import MetadataForm, FileForm
-from .models import Column, Table, Contact
-from .utils import S3Manager, TableFormatter
+from .forms import MetadataForm, FileForm, DirectUploadForm, UpdateForm
+from .models import Column, Table, Upload, TableExport
+from .utils import S3Manager, TableFormatter, UploadWorkspace, progress_events
+from .utils import Decompressor, file_extension, export_formats
+from .analyzer import UploadAnalyzer, SNIFF_SIZE
 from search.utils import SearchManager
 # Have to do an absolute import below because of how celery resolves paths :(
-from upload.tasks import load_infile
+from upload.tasks import load_infile, update_infile, request_export
 
 # Constants
 BUCKET_NAME = settings.S3_BUCKET
@@ -41,23 +47,38 @@ def upload_file(request):
     if request.method == 'POST':
         if form.is_valid():
             input_file = request.FILES['data_file']
-            local_path = '/tmp/data-upload.csv'
+            # Give every upload its own directory so that concurrent uploads
+            # can't overwrite each other
+            workspace = UploadWorkspace()
+            extension = file_extension(input_file.name)
+            local_path = workspace.path('data' + extension)
+            # Only analyze the start of the file here, for its dialect,
+            # headers and sample rows. Reading every value would hold up the
+            # request, so the load task analyzes the rest as it downloads it
+            decompressor = Decompressor(extension)
+            analyzer = UploadAnalyzer()
             try:
-                os.remove(local_path)
-            except OSError:
-                pass
-            with open(local_path, 'wb+') as f:
-                # Use chunks so as not to overflow system memory
-                for i, chunk in enumerate(input_file.chunks()):
-                    if (i == 0):
-                        # TODO: should also handle splitting on \r\n like Windows
-                        first_row = chunk.split('\n')[0]
-                    f.write(chunk)
-
-            request.session['local_path']= local_path
+                with open(local_path, 'wb+') as f:
+                    # Use chunks so as not to overflow system memory
+                    for chunk in input_file.chunks():
+                        if analyzer.size < SNIFF_SIZE:
+                            analyzer.feed(decompressor.decompress(chunk))
+                        f.write(chunk)
+                analysis = analyzer.finish(complete=False)
+
+                # Copy the file to S3 right away, so that the rest of the
+                # upload doesn't depend on landing on this web node again.
+                # Compressed files are stored compressed
+                s3 = S3Manager(local_path, None, BUCKET_NAME)
+                s3_path = 'tmp/{}/data{}'.format(workspace.name, extension)
+                request.session['s3_path'] = s3.write_file(key=s3_path)
+            finally:
+                # The local copy isn't needed once it's on S3
+                workspace.cleanup()
+            request.session['analysis'] = analysis
 
             return JsonResponse(
-                {'headers': first_row.split(',')},
+                {'headers': analysis['headers']},
                 status=200
             )
 
@@ -72,6 +93,288 @@ def upload_file(request):
                 safe=False
             )
 
+def _s3_error(message):
+    """
+    Format an error the same way as form errors so that the client can show
+    it with the rest of them
+    """
+    errors = {'__all__': [{'message': message, 'code': ''}]}
+    return JsonResponse(json.dumps(errors), status=400, safe=False)
+
+
+def _get_analysis(request):
+    """
+    Get the UploadAnalyzer summary of the file being uploaded. Only the start
+    of the file is analyzed on the web side, from the first few rows
+    downloaded from S3; the load task analyzes all of it as it downloads it.
+    """
+    analysis = request.session.get('analysis')
+    if analysis is None:
+        workspace = UploadWorkspace()
+        try:
+            s3 = S3Manager(None, None, BUCKET_NAME)
+            local_path = s3.download_head(request.session['s3_path'],
+                                          workspace.path('head.csv'))
+            analysis = UploadAnalyzer.from_file(local_path, complete=False)
+        finally:
+            workspace.cleanup()
+        request.session['analysis'] = analysis
+
+    return analysis
+
+
+def _uploaded_to_s3(request, s3_path):
+    """
+    Finish an upload that went straight to S3: download the first few rows
+    and send back the headers, the same way upload_file does. The rest of
+    the file is analyzed as the load task downloads it.
+    """
+    request.session['s3_path'] = s3_path
+    request.session['analysis'] = None
+
+    analysis = _get_analysis(request)
+    return JsonResponse({'headers': analysis['headers']}, status=200)
+
+
+@login_required
+def start_direct_upload(request):
+    """
+    Start a multipart upload that the browser sends straight to S3, so that
+    the bytes never pass through Django. Returns the size of each part; the
+    browser then asks sign_direct_upload for URLs to PUT the parts to.
+    """
+    if request.method != 'POST':
+        return redirect(reverse('upload:index'))
+
+    form = DirectUploadForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse(
+            form.errors.as_json(escape_html=True),
+            status=400,
+            safe=False
+        )
+
+    size = form.cleaned_data['size']
+    part_size = max(settings.S3_PART_SIZE, -(-size // settings.S3_MAX_PARTS))
+    filename = re.sub(r'[^\w.-]', '_', form.cleaned_data['filename'])
+    key = 'tmp/{}/{}'.format(uuid.uuid4().hex, filename)
+
+    try:
+        s3 = S3Manager(None, None, BUCKET_NAME)
+        upload_id = s3.create_multipart_upload(key)
+    except botocore.exceptions.ClientError:
+        return _s3_error('Unable to start the upload to Amazon S3')
+
+    request.session['direct_upload'] = {'key': key,
+                                        'upload_id': upload_id,
+                                        'parts': -(-size // part_size)}
+
+    return JsonResponse({'part_size': part_size,
+                         'parts': request.session['direct_upload']['parts']})
+
+
+@login_required
+def sign_direct_upload(request):
+    """
+    Sign URLs for a batch of parts of the direct upload in progress
+    """
+    upload = request.session.get('direct_upload')
+    if request.method != 'POST' or not upload:
+        return _s3_error('There is no upload in progress')
+
+    try:
+        part_numbers = [int(n) for n in request.POST.getlist('part')]
+    except ValueError:
+        return _s3_error('Invalid part number')
+
+    if not all(1 <= n <= upload['parts'] for n in part_numbers):
+        return _s3_error('Invalid part number')
+
+    s3 = S3Manager(None, None, BUCKET_NAME)
+    urls = s3.sign_upload_parts(upload['key'], upload['upload_id'], part_numbers)
+    return JsonResponse({'urls': urls})
+
+
+@login_required
+def complete_direct_upload(request):
+    """
+    Assemble the parts the browser sent to S3, then download the first few
+    rows so that we can show the user the headers, the same way upload_file
+    does
+    """
+    upload = request.session.get('direct_upload')
+    if request.method != 'POST' or not upload:
+        return _s3_error('There is no upload in progress')
+
+    try:
+        parts = [{'PartNumber': int(p['PartNumber']), 'ETag': p['ETag']}
+                 for p in json.loads(request.POST.get('parts', '[]'))]
+    except (ValueError, KeyError, TypeError):
+        return _s3_error('Invalid list of parts')
+
+    if len(parts) != upload['parts']:
+        return _s3_error('Some parts of the file are missing')
+
+    s3 = S3Manager(None, None, BUCKET_NAME)
+    try:
+        s3.complete_multipart_upload(upload['key'], upload['upload_id'], parts)
+    except botocore.exceptions.ClientError:
+        return _s3_error('Unable to finish the upload to Amazon S3')
+
+    request.session['direct_upload'] = None
+    return _uploaded_to_s3(request, upload['key'])
+
+
+@login_required
+def abort_direct_upload(request):
+    """
+    Cancel the direct upload in progress and delete any parts S3 received
+    """
+    upload = request.session.get('direct_upload')
+    if request.method == 'POST' and upload:
+        s3 = S3Manager(None, None, BUCKET_NAME)
+        try:
+            s3.abort_multipart_upload(upload['key'], upload['upload_id'])
+        except botocore.exceptions.ClientError:
+            pass
+        request.session['direct_upload'] = None
+
+    return JsonResponse({})
+
+
+@login_required
+def start_chunked_upload(request):
+    """
+    Start a resumable upload that the browser sends through Django one chunk
+    at a time. This is the fallback for when the browser can't upload to S3
+    directly. Each chunk is checked and stored as a part of an S3 multipart
+    upload, so the upload's state lives in the database and on S3 rather than
+    on whichever web node received the chunk.
+    """
+    if request.method != 'POST':
+        return redirect(reverse('upload:index'))
+
+    form = DirectUploadForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse(
+            form.errors.as_json(escape_html=True),
+            status=400,
+            safe=False
+        )
+
+    size = form.cleaned_data['size']
+    upload = Upload(user=request.user,
+                    filename=form.cleaned_data['filename'],
+                    size=size,
+                    chunk_size=max(settings.S3_PART_SIZE,
+                                   -(-size // settings.S3_MAX_PARTS)))
+    upload.s3_path = 'tmp/{}/data{}'.format(upload.id.hex,
+                                            file_extension(upload.filename))
+
+    try:
+        s3 = S3Manager(None, None, BUCKET_NAME)
+        upload.multipart_id = s3.create_multipart_upload(upload.s3_path)
+    except botocore.exceptions.ClientError:
+        return _s3_error('Unable to start the upload to Amazon S3')
+
+    upload.save()
+    return JsonResponse({'id': upload.id.hex,
+                         'chunk_size': upload.chunk_size,
+                         'parts': upload.parts})
+
+
+def _get_upload(request, upload_id):
+    try:
+        return Upload.objects.get(pk=upload_id, user=request.user,
+                                  complete=False)
+    except (Upload.DoesNotExist, ValueError):
+        return None
+
+
+@login_required
+def upload_chunk(request):
+    """
+    Receive one chunk of a resumable upload. If the browser sent a SHA-256
+    checksum, the chunk is rejected when it doesn't match, so the browser can
+    send it again.
+    """
+    upload = _get_upload(request, request.POST.get('id'))
+    if request.method != 'POST' or not upload or 'chunk' not in request.FILES:
+        return _s3_error('There is no upload in progress')
+
+    try:
+        part_number = int(request.POST.get('part'))
+    except (TypeError, ValueError):
+        return _s3_error('Invalid part number')
+
+    if not 1 <= part_number <= upload.parts:
+        return _s3_error('Invalid part number')
+
+    body = request.FILES['chunk'].read()
+    checksum = request.POST.get('sha256')
+    if checksum and hashlib.sha256(body).hexdigest() != checksum.lower():
+        return _s3_error('Chunk {} was corrupted in transit'.format(part_number))
+
+    # Every chunk except the last has to be exactly chunk_size bytes, or the
+    # parts won't add up to the file
+    expected = min(upload.chunk_size,
+                   upload.size - (part_number - 1) * upload.chunk_size)
+    if len(body) != expected:
+        return _s3_error('Chunk {} is the wrong size'.format(part_number))
+
+    s3 = S3Manager(None, None, BUCKET_NAME)
+    try:
+        etag = s3.upload_part(upload.s3_path, upload.multipart_id,
+                              part_number, body)
+    except botocore.exceptions.ClientError:
+        return _s3_error('Unable to send chunk {} to Amazon S3'.format(part_number))
+
+    return JsonResponse({'part': part_number, 'etag': etag})
+
+
+@login_required
+def chunked_upload_status(request):
+    """
+    List the chunks S3 has received, so that an interrupted upload can pick
+    up where it left off instead of starting over
+    """
+    upload = _get_upload(request, request.GET.get('id'))
+    if not upload:
+        return _s3_error('There is no upload in progress')
+
+    s3 = S3Manager(None, None, BUCKET_NAME)
+    parts = s3.list_parts(upload.s3_path, upload.multipart_id)
+    return JsonResponse({'chunk_size': upload.chunk_size,
+                         'parts': upload.parts,
+                         'received': [p['PartNumber'] for p in parts]})
+
+
+@login_required
+def complete_chunked_upload(request):
+    """
+    Assemble the chunks of a resumable upload once S3 has all of them
+    """
+    upload = _get_upload(request, request.POST.get('id'))
+    if request.method != 'POST' or not upload:
+        return _s3_error('There is no upload in progress')
+
+    s3 = S3Manager(None, None, BUCKET_NAME)
+    parts = s3.list_parts(upload.s3_path, upload.multipart_id)
+    if len(parts) != upload.parts:
+        return _s3_error('Some parts of the file are missing')
+
+    try:
+        s3.complete_multipart_upload(upload.s3_path, upload.multipart_id,
+                                     [{'PartNumber': p['PartNumber'],
+                                       'ETag': p['ETag']} for p in parts])
+    except botocore.exceptions.ClientError:
+        return _s3_error('Unable to finish the upload to Amazon S3')
+
+    upload.complete = True
+    upload.save()
+    return _uploaded_to_s3(request, upload.s3_path)
+
+
 @login_required
 def add_metadata(request):
     """
@@ -83,12 +386,8 @@ def add_metadata(request):
 
     if request.method == 'POST':
         if form.is_valid():
-            # Write the table to a temporary file in S3 that we can retrieve
-            # later
             table_name = form.cleaned_data['table_name']
-            local_path = request.session.get('local_path')
-            s3 = S3Manager(local_path, table_name, BUCKET_NAME)
-            request.session['s3_path'] = s3.write_file()
+            analysis = _get_analysis(request)
 
             request.session['table_params'] = {
                 'topic': form.cleaned_data['topic'],
@@ -102,8 +401,12 @@ def add_metadata(request):
             }
 
             # Sanitize the column headers
-            formatter = TableFormatter(local_path)
-            headers, sample_data = formatter.get_column_data()
+            formatter = TableFormatter(None)
+            headers, sample_data = formatter.get_column_data(analysis)
+            # Show the user the type each column will get, so they can keep
+            # the ones that only look like numbers or dates as text
+            for header, column in zip(headers, analysis['columns'] or []):
+                header['proposed_type'] = column['sql_type']
             request.session['table_params']['headers'] = headers
 
             data = {'headers': headers,
@@ -151,13 +454,20 @@ def write_to_db(request):
                     updated_headers[i] = {'name': key, 'category': data[key]}
                     break
 
+        # Each column's type is either inferred from its values or, if the
+        # user asked for it, text. Anything else is ignored
+        for header in updated_headers:
+            if header and data.get('type:' + header['name']) == 'text':
+                header['type'] = 'text'
+
         table_params['headers'] = updated_headers
         table_params['s3_path'] = request.session['s3_path']
+        table_params['analysis'] = request.session.get('analysis')
 
         # Launch an asynchronous task for the potentially time-intensive job
         # of executing the LOAD DATA INFILE statement
         try:
-            task = load_infile.delay(**table_params)
+            task = load_infile.delay(user_id=request.user.id, **table_params)
         # TODO : should also handle the ValueError for failing to connect to S3
         except OperationalError:
             message = '''
@@ -178,21 +488,79 @@ def write_to_db(request):
 
 
 @login_required
-def check_task_status(request):
+def update_table(request, id):
     """
-    Polls the server to check the completion status of celery task. Performs
-    one of the following:
-    
-    Update task progress
+    Load a new version of a file into an existing table. GET requests show
+    the upload page for the table. Once the file is uploaded, the update
+    options are POSTed here and the update_infile task is started. Only the
+    user who uploaded the table, or staff, can update it.
+    """
+    table = get_object_or_404(Table, pk=id)
+    if table.user_id != request.user.id and not request.user.is_staff:
+        message = '''
+            Only the user who uploaded <strong>{}</strong> can update it.
+        '''.format(table.table)
+        messages.add_message(request, messages.ERROR, message)
+        return redirect(reverse('upload:detail', args=[id]))
+
+    columns = [c.column for c in table.column_set.order_by('id')]
+    form = UpdateForm(columns, request.POST or None)
+
+    if request.method != 'POST':
+        uploads = Table.objects.order_by('-upload_time')[:5]
+        context = {'table': table, 'update_form': form, 'file_form': FileForm(),
+                   'uploads': uploads}
+        return render(request, 'upload/upload.html', context)
+
+    if not form.is_valid():
+        for errors in form.errors.values():
+            messages.add_message(request, messages.ERROR, errors[0])
+        return redirect(reverse('upload:update', args=[id]))
+
+    # Rows are compared column by column, so the new version of the file has
+    # to have the same columns in the same order
+    analysis = _get_analysis(request)
+    headers, sample_data = TableFormatter(None).get_column_data(analysis)
+    if [h['name'] for h in headers] != columns:
+        message = '''
+            The columns in this file don't match the columns in
+            <strong>{}</strong>. Update canceled.
+        '''.format(table.table)
+        messages.add_message(request, messages.ERROR, message)
+        return redirect(reverse('upload:update', args=[id]))
+
+    try:
+        task = update_infile.delay(s3_path=request.session['s3_path'],
+                                   table_id=table.id,
+                                   mode=form.cleaned_data['mode'],
+                                   key_columns=form.cleaned_data['key_columns'],
+                                   user_id=request.user.id,
+                                   analysis=analysis)
+    except OperationalError:
+        message = '''
+            Unable to connect to the Redis server at address 
+            <strong>{}</strong>. Update canceled.
+        '''.format(settings.BROKER_URL)
+        messages.add_message(request, messages.ERROR, message)
+        return redirect(reverse('upload:update', args=[id]))
+
+    request.session['task_id'] = task.id
+    return render(request, 'upload/write-to-db.html', {'table': table.table})
 
-    If the task succeeded, return a sample of the data, and write metadata
-    about the table and columns to Django DB.
 
-    If the task failed, return error message.
+@login_required
+def check_task_status(request):
+    """
+    Polls the server to check the completion status of celery task. Returns
+    the task's progress, or a sample of the data if the task succeeded, or
+    an error message if it failed. The task registers the table in the
+    catalog itself, so this only ever reads.
     """
     # Use the ID of the async task saved in session storage to check the task
     # status
-    p_id = request.session['task_id']
+    p_id = request.session.get('task_id')
+    if p_id is None:
+        return _no_task()
     response = AsyncResult(p_id)
 
     data = {
@@ -200,53 +568,6 @@ def check_task_status(request):
         'result': response.result
     }
 
-    # If the task is successful, write information about the upload to the
-    # Django DB.
-    if data['status'] == 'SUCCESS' and not data['result']['error']:
-        # Create a new table record in the Django DB
-        params = request.session['table_params']
-        t = Table(
-            table=data['result']['table'],
-            topic=params['topic'],
-            user=request.user,
-            source=params['source'],
-            upload_log=data['result']['warnings'],
-            path=data['result']['final_s3_path'],
-            next_update=params['next_update']
-        )
-        t.save()
-
-        # Create a new column record in the Django DB for each column in
-        # the table
-        c = Contact(
-            table=t,
-            name=params['press_contact'],
-            email=params['press_contact_email'],
-            phone=params['press_contact_number'],
-            contact_type=params['press_contact_type']
-        )
-        c.save()
-
-        # engine = sqlalchemy.create_engine(URL)
-        # connection = engine.connect()
-
-        # index = Index(table_id=t.id, connection=connection)
-
-        # Create column objects for each column in the table, and create an
-        # index for the ones we're interested in
-        for i, column in enumerate(request.session['table_params']['headers']):
-            task_header = data['result']['headers'][i]
-            c = Column(table=t,
-                       column=column['name'],
-                       mysql_type=task_header['datatype'],
-                       information_type=column['category'],
-                       column_size=task_header['length'])
-            c.save()
-            # Need to fix this so that it's stored as None
-            # if c.information_type != 'None':
-            #     index.create_index(c.information_type)
-
-
     # If response isn't JSON serializable then it's an error message.
     # Convert it to a string and return it
     try:
@@ -255,23 +576,106 @@ def check_task_status(request):
         data['result'] = str(data['result'])
         return JsonResponse(data)
 
+
+@login_required
+def task_progress(request):
+    """
+    Stream the progress of the load_infile task to the browser as
+    server-sent events, pushed as the task publishes them, so that the
+    progress bar doesn't have to poll check_task_status
+    """
+    p_id = request.session.get('task_id')
+    if p_id is None:
+        return _no_task()
+    response = StreamingHttpResponse(progress_events(p_id),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Don't let nginx buffer the events
+    return response
+
+
+def _no_task():
+    """
+    The response for a progress request from a session that hasn't started
+    loading a table
+    """
+    return JsonResponse({'error': True,
+                         'message': 'No table is being loaded'}, status=404)
+
+
+def _exports(table):
+    """
+    List the formats a table can be exported in, with a presigned link to
+    each export that's ready for the table's current version
+    """
+    ready = dict(TableExport.objects.filter(table=table, version=table.data_version,
+                                            status='ready')
+                 .values_list('format', 'path'))
+    s3 = S3Manager(None, None, BUCKET_NAME) if ready else None
+
+    exports = []
+    for format, label in export_formats():
+        url = None
+        if format in ready:
+            url = s3.get_presigned_url(ready[format], expires=settings.EXPORT_URL_EXPIRY)
+        exports.append({'format': format, 'label': label, 'url': url})
+    return exports
+
+
+@login_required
+def table_export(request, id, format):
+    """
+    Send the user to a whole-table export. If it hasn't been built for the
+    table's current version yet, start building it and send them back to the
+    table, where it's linked once it's ready.
+    """
+    table = Table.objects.get(pk=id)
+    if format not in dict(export_formats()):
+        return redirect(reverse('upload:detail', args=[id]))
+
+    export = request_export(table, format)
+    if export.status == 'ready':
+        s3 = S3Manager(None, None, BUCKET_NAME)
+        return redirect(s3.get_presigned_url(export.path,
+                                             expires=settings.EXPORT_URL_EXPIRY))
+
+    message = '''
+        The {} export of {} is being built. Reload this
+        page in a few minutes to download it.
+    '''.format(dict(export_formats())[format], table.table)
+    messages.add_message(request, messages.INFO, message)
+    return redirect(reverse('upload:detail', args=[id]))
+
+
 @login_required
 def table_detail(request, id):
     context = {}
     table = Table.objects.get(pk=id)
+    columns = table.column_set.order_by('id')
     context['table'] = table
+    context['columns'] = columns
+    context['updates'] = table.tableupdate_set.order_by('update_time')
+    context['exports'] = _exports(table)
+
+    # Tables loaded since we started profiling them have their row count and
+    # a preview stored with them, so the warehouse isn't touched
+    if table.row_count is not None:
+        context['preview'] = {'headers': [c.column for c in columns],
+                              'data': table.preview_rows}
+        context['num_rows'] = table.row_count
+        return render(request, 'upload/detail.html', context)
 
     # Get column names and sample data to generate a table
     searchManager = SearchManager()
-    select_query = 'SELECT * FROM imports.{} LIMIT 5;'.format(table.table)
-    data = searchManager.simple_query(select_query)
-    keys = data.keys()
-    sample_rows = data.fetchall()
+    # List the columns so the hidden row ID isn't shown
+    select_query = 'SELECT {} FROM imports.{} LIMIT 5;'.format(
+        ','.join('`{}`'.format(c.column) for c in columns), table.table)
+    keys, sample_rows = searchManager.simple_query(select_query)
     context['preview'] = {'headers': keys, 'data': sample_rows}
 
     # Get the number of rows in the table
-    n = searchManager.simple_query('SELECT COUNT(*) FROM imports.{}'.format(table.table))
-    context['num_rows'] = n.first()[0]
+    headers, n = searchManager.simple_query('SELECT COUNT(*) FROM imports.{}'.format(table.table))
+    context['num_rows'] = n[0][0]
 
     return render(request, 'upload/detail.html', context)
 